@@ -0,0 +1,386 @@
+#! /usr/bin/python3
+"""Content addressed archive of EEPROM and firmware images.
+
+Every unique image is stored once under objects/, named by its SHA-256
+hash.  Each index is a JSON lines file with one record per time an
+image was seen, so the same image captured a hundred times takes up
+128 bytes once and a hundred short lines in the index.
+
+The modules index has a record for each sampling head EEPROM with the
+model, serial number, capture time and slot.  It can be queried for
+the history of a module and shows which words of the unknown
+calibration area 0x00..0x6d changed between snapshots.
+
+The firmware index has a record for each EPROM image in the backup of
+a mainframe, with the unit it came from and where it is mapped.  Most
+units with the same firmware version have identical images, so they
+are only stored once and backup.py can use a known image instead of
+dumping it again.
+
+The NVRAM index has a record for each snapshot of an NVRAM, taken with
+backup.py --snapshot.  The NVRAM is split into blocks and only the
+blocks which differ from the last snapshot of the same NVRAM in the
+same unit are stored, so a snapshot where a few calibration constants
+drifted takes a few kilobytes.
+
+    ./archive.py import MODULES-*
+    ./archive.py history SD-24 B020024
+    ./archive.py diff 3f2a
+    ./archive.py snapshots
+    ./archive.py snapshot 81c0 nvram.bin
+"""
+
+import os
+import sys
+import json
+import struct
+import hashlib
+import threading
+import datetime
+from optparse import OptionParser
+
+ARCHIVE_DIR = 'ARCHIVE'
+
+MODULES_INDEX = 'modules'
+FIRMWARE_INDEX = 'firmware'
+NVRAM_INDEX = 'nvram'
+
+# Size of the blocks NVRAM snapshots are compared in
+SNAPSHOT_BLOCK = 0x400
+
+# Size of the unknown calibration area at the start of a module EEPROM
+CAL_SIZE = 0x6e
+
+class Archive():
+    def __init__(self, path = ARCHIVE_DIR):
+        self.path = path
+        self.indexes = {}
+        self.seen = {}
+
+    def object_fn(self, h):
+        return os.path.join(self.path, 'objects', h[:2], h)
+
+    def put(self, data):
+        """Store data, returns its hash"""
+
+        h = hashlib.sha256(data).hexdigest()
+        fn = self.object_fn(h)
+        if not os.path.exists(fn):
+            os.makedirs(os.path.dirname(fn), exist_ok = True)
+            # fleet.py can store the same object from several threads
+            tmp_fn = '%s.%u.tmp' % (fn, threading.get_ident())
+            with open(tmp_fn, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_fn, fn)
+        return h
+
+    def get(self, h):
+        with open(self.object_fn(h), 'rb') as f:
+            return f.read()
+
+    def resolve(self, prefix):
+        """Find the full hash from a unique prefix"""
+
+        d = os.path.join(self.path, 'objects', prefix[:2])
+        try:
+            matches = [ _ for _ in os.listdir(d) if _.startswith(prefix) and
+                        not _.endswith('.tmp') ]
+        except OSError:
+            matches = []
+        if len(matches) != 1:
+            raise KeyError("%s matches %u objects" % (prefix, len(matches)))
+        return matches[0]
+
+    def index_fn(self, index):
+        return os.path.join(self.path, index + '.jsonl')
+
+    def records(self, index):
+        """All records in an index, oldest first"""
+
+        if index not in self.indexes:
+            records = []
+            try:
+                with open(self.index_fn(index)) as f:
+                    for line in f:
+                        try:
+                            records.append(json.loads(line))
+                        except ValueError:
+                            # A partial line from an interrupted write
+                            pass
+            except OSError:
+                pass
+            self.indexes[index] = records
+            self.seen[index] = set(json.dumps(_, sort_keys = True)
+                                   for _ in records)
+        return self.indexes[index]
+
+    def record(self, index, **fields):
+        """Add a record to an index unless it is already there"""
+
+        records = self.records(index)
+        line = json.dumps(fields, sort_keys = True)
+        if line in self.seen[index]:
+            return False
+        os.makedirs(self.path, exist_ok = True)
+        with open(self.index_fn(index), 'a') as f:
+            f.write(line + '\n')
+        records.append(fields)
+        self.seen[index].add(line)
+        return True
+
+def module_info(data):
+    model = data[0x6e:0x76].decode('ASCII', errors = 'replace').strip()
+    serial = data[0x76:0x7e].decode('ASCII', errors = 'replace').strip()
+    return model, serial
+
+def add_module(archive, data, time = None, slot = None, source = None):
+    """Add a sampling head EEPROM image to the archive"""
+
+    if time is None:
+        time = datetime.datetime.now()
+    model, serial = module_info(data)
+    h = archive.put(data)
+    archive.record(MODULES_INDEX, hash = h, model = model, serial = serial,
+                   time = time.isoformat(timespec = 'minutes'),
+                   slot = slot, source = source)
+    return h
+
+def module_history(archive, model = None, serial = None):
+    """Records for a module, oldest first"""
+
+    records = [ _ for _ in archive.records(MODULES_INDEX)
+                if (model is None or _['model'] == model) and
+                (serial is None or _['serial'] == serial) ]
+    return sorted(records, key = lambda _: _['time'])
+
+def cal_diff(old, new):
+    """Words of the calibration area which differ.
+
+    Returns a list of (offset, old word, new word).
+    """
+
+    n = CAL_SIZE // 2
+    a = struct.unpack('>%uH' % n, old[:n * 2])
+    b = struct.unpack('>%uH' % n, new[:n * 2])
+    return [ (i * 2, x, y) for i, (x, y) in enumerate(zip(a, b)) if x != y ]
+
+def add_firmware(archive, data, fn, subsystem, start, count, version, unit):
+    """Add an image from the backup of a mainframe to the archive"""
+
+    h = archive.put(data)
+    archive.record(FIRMWARE_INDEX, hash = h, file = fn,
+                   subsystem = subsystem, start = start, count = count,
+                   version = version, unit = unit)
+    return h
+
+def find_firmware(archive, fn, subsystem, start, count):
+    """Find an image from another backup with the same name and location.
+
+    The name includes the EPROM and the version of the firmware.
+    Returns the hash of the most recently added image, or None.
+    """
+
+    for record in reversed(archive.records(FIRMWARE_INDEX)):
+        if (record['file'] == fn and record['subsystem'] == subsystem and
+            record['start'] == start and record['count'] == count):
+            return record['hash']
+    return None
+
+def snapshot_history(archive, unit = None, subsystem = None, start = None):
+    """NVRAM snapshot records, oldest first"""
+
+    records = [ _ for _ in archive.records(NVRAM_INDEX)
+                if (unit is None or _['unit'] == unit) and
+                (subsystem is None or _['subsystem'] == subsystem) and
+                (start is None or _['start'] == start) ]
+    return sorted(records, key = lambda _: _['time'])
+
+def rebuild_snapshots(archive, records):
+    """Apply the blocks of the snapshots of one NVRAM in order.
+
+    Yields each record with the image as it was then.
+    """
+
+    data = None
+    for record in records:
+        if data is None or len(data) != record['count']:
+            data = bytearray(record['count'])
+        for offset, h in record['blocks']:
+            block = archive.get(h)
+            data[offset:offset + len(block)] = block
+        if hashlib.sha256(data).hexdigest() != record['hash']:
+            raise ValueError("snapshot %s does not add up" % record['hash'])
+        yield record, bytes(data)
+
+def add_snapshot(archive, data, unit, subsystem, start, time = None,
+                 block_size = SNAPSHOT_BLOCK):
+    """Add a snapshot of an NVRAM to the archive.
+
+    Only blocks which differ from the last snapshot of the same NVRAM
+    in the same unit are stored.  Returns the record.
+    """
+
+    if time is None:
+        time = datetime.datetime.now()
+
+    last = None
+    for record, last in rebuild_snapshots(
+            archive, snapshot_history(archive, unit, subsystem, start)):
+        pass
+    if last is not None and len(last) != len(data):
+        last = None
+
+    blocks = []
+    for offset in range(0, len(data), block_size):
+        block = data[offset:offset + block_size]
+        if last is None or last[offset:offset + block_size] != block:
+            blocks.append([ offset, archive.put(block) ])
+
+    record = dict(hash = hashlib.sha256(data).hexdigest(), unit = unit,
+                  subsystem = subsystem, start = start, count = len(data),
+                  time = time.isoformat(timespec = 'seconds'),
+                  block_size = block_size, blocks = blocks)
+    archive.record(NVRAM_INDEX, **record)
+    return record
+
+def import_dirs(archive, paths):
+    """Import MODULES-date-time directories written by backup.py"""
+
+    n = len(archive.records(MODULES_INDEX))
+    for path in paths:
+        name = os.path.basename(os.path.normpath(path))
+        try:
+            time = datetime.datetime.strptime(name, 'MODULES-%Y%m%d-%H%M')
+        except ValueError:
+            time = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+        for fn in sorted(os.listdir(path)):
+            if not fn.endswith('.bin'):
+                continue
+            with open(os.path.join(path, fn), 'rb') as f:
+                data = f.read()
+            if len(data) != 128:
+                print("%s: not a module image" % fn, file = sys.stderr)
+                continue
+            add_module(archive, data, time, source = os.path.join(name, fn))
+    return len(archive.records(MODULES_INDEX)) - n
+
+def show_history(archive, model = None, serial = None):
+    last = {}
+    for record in module_history(archive, model, serial):
+        h = record['hash']
+        key = (record['model'], record['serial'])
+        changes = ''
+        if key in last and last[key] != h:
+            diff = cal_diff(archive.get(last[key]), archive.get(h))
+            changes = '  %u words changed' % len(diff)
+        slot = record.get('slot')
+        print("%-16s %-6s %-8s %-4s %s%s" % (
+            record['time'], record['model'], record['serial'],
+            slot if slot is not None else '-', h[:12], changes))
+        last[key] = h
+
+def show_diff(archive, old, new):
+    for offset, x, y in cal_diff(archive.get(old), archive.get(new)):
+        print("0x%02x  %04x -> %04x  %+d" % (offset, x, y, y - x))
+
+def show_snapshots(archive, unit = None):
+    last = {}
+    for record in snapshot_history(archive, unit):
+        key = (record['unit'], record['subsystem'], record['start'])
+        if key in last:
+            changes = '%u changed' % len(record['blocks'])
+            if record['blocks']:
+                changes += ' at ' + ' '.join('%x' % _[0]
+                                             for _ in record['blocks'])
+        else:
+            changes = 'first'
+        print("%-19s %-24s %s %06x %s  %s" % (
+            record['time'], record['unit'], record['subsystem'],
+            record['start'], record['hash'][:12], changes))
+        last[key] = record
+
+def write_snapshot(archive, prefix, fn):
+    """Write the image of the snapshot with a hash starting with prefix"""
+
+    matches = [ _ for _ in archive.records(NVRAM_INDEX)
+                if _['hash'].startswith(prefix) ]
+    if len(set(_['hash'] for _ in matches)) != 1:
+        raise KeyError("%s matches %u snapshots" % (prefix, len(matches)))
+    target = matches[0]
+
+    records = snapshot_history(archive, target['unit'], target['subsystem'],
+                               target['start'])
+    for record, data in rebuild_snapshots(archive, records):
+        if record['hash'] == target['hash']:
+            break
+    with open(fn, 'wb') as f:
+        f.write(data)
+
+def main():
+    parser = OptionParser(
+        usage = "%prog [options] import DIR...\n"
+        "       %prog [options] history [MODEL [SERIAL]]\n"
+        "       %prog [options] diff HASH [HASH]\n"
+        "       %prog [options] snapshots [UNIT]\n"
+        "       %prog [options] snapshot HASH FILE")
+    parser.add_option('-a', '--archive', dest = 'archive',
+                      default = ARCHIVE_DIR,
+                      help = "archive directory (default %s)" % ARCHIVE_DIR,
+                      metavar = "DIR")
+
+    (options, args) = parser.parse_args()
+
+    if not args:
+        parser.error("expected a command")
+
+    archive = Archive(options.archive)
+    cmd, args = args[0], args[1:]
+
+    if cmd == 'import':
+        n = import_dirs(archive, args)
+        print("imported %u new snapshots" % n, file = sys.stderr)
+
+    elif cmd == 'history':
+        if len(args) > 2:
+            parser.error("expected at most a model and a serial number")
+        show_history(archive, *args)
+
+    elif cmd == 'diff':
+        if len(args) not in (1, 2):
+            parser.error("expected one or two hashes")
+        try:
+            hashes = [ archive.resolve(_) for _ in args ]
+        except KeyError as e:
+            parser.error(e.args[0])
+        if len(hashes) == 1:
+            # Compare with the snapshot before it of the same module
+            new = hashes[0]
+            model, serial = module_info(archive.get(new))
+            old = None
+            for record in module_history(archive, model, serial):
+                if record['hash'] == new:
+                    break
+                old = record['hash']
+            if old is None:
+                parser.error("no earlier snapshot of %s %s" % (model, serial))
+            hashes = [ old, new ]
+        show_diff(archive, *hashes)
+
+    elif cmd == 'snapshots':
+        if len(args) > 1:
+            parser.error("expected at most a unit")
+        show_snapshots(archive, *args)
+
+    elif cmd == 'snapshot':
+        if len(args) != 2:
+            parser.error("expected a hash and a file name")
+        try:
+            write_snapshot(archive, *args)
+        except KeyError as e:
+            parser.error(e.args[0])
+
+    else:
+        parser.error("unknown command %s" % repr(cmd))
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,27 @@ import os
 import struct
 import time
 import re
+import gzip
+import json
+import zlib
+import queue
+import threading
 import serial
 import pexpect
-import pexpect_serial
 import datetime
-
-from romtool import *
+import random
+import hashlib
+import math
+from optparse import OptionParser
+
+from rmdecode import RMDecoder
+from screen import Screen
+from serialreader import SerialReader, ReaderSpawn
+from capture import Capture
+from archive import (Archive, add_module, add_firmware, find_firmware,
+                     add_snapshot)
+from dumpplan import (find_plan, load_plan, schedule, fit, estimate, group,
+                      describe, DEFAULT_RATE)
 
 # Order to try baudrates for main console
 MAIN_BAUDRATES = [ 9600 ] # , 19200 ]
@@ -20,6 +35,94 @@ TEST_BAUDRATE = 38400
 
 HOME_PAT = '\033\\[2K'
 
+# Names of the subsystems in the "(1) Subsystem" menu
+SUBSYSTEM_NAMES = {
+    'a' : 'Executive',
+    'b' : 'Display',
+    'c' : 'Time Base',
+    'd' : 'Main Acq',
+}
+
+# Names of the subsystems in the response to ID?
+SUBSYSTEM_IDS = {
+    'a' : [ 'EXP' ],
+    'b' : [ 'DSY' ],
+    'c' : [ 'TBC' ],
+    'd' : [ 'ACQM1', 'ACQM2' ],
+}
+
+ESC_PAT = '\033'
+
+# Block and area with the ROM checksum tests of each subsystem, the
+# key to select them and their names in the menus
+ROM_CHECKSUM_MENUS = {
+    'a' : ('a', 'Exec Control', 'b', 'ROM Checksum'),
+    'b' : ('a', 'Dsy Control', 'b', 'ROM Checksum'),
+    'c' : ('a', 'Tbc Control', 'b', 'ROM Checksum'),
+    'd' : ('a', 'Acq 1', 'b', 'ROM'),
+}
+
+# How long to wait for the next result of the ROM checksum tests
+ROM_CHECKSUM_TIMEOUT = 30
+
+# Delays between keystrokes which are known to work, used when the
+# instrument seems to drop keys.  "menu" is the time to let the screen
+# settle after an update, "digit" is the time between hex digits and
+# "test" is the time from "TEST MAN" until the menu has been drawn.
+PACE_CONSERVATIVE = { 'menu' : 1.0, 'digit' : 0.1, 'test' : 5.0 }
+
+# Where to start when nothing has been learned about an instrument
+PACE_INITIAL = { 'menu' : 0.0, 'digit' : 0.0, 'test' : 1.0 }
+
+# How long to wait for a response to a key before assuming that the
+# key was dropped and how many times to try
+KEY_TIMEOUT = 2
+KEY_RETRIES = 3
+
+# What is known about each instrument from earlier sessions
+SESSION_FN = 'session.json'
+
+# Size of one RM line from the debugger in 16 bit mode
+ROW_SIZE = 16
+
+# Commit dumped data to disk every CHECKPOINT_SIZE bytes or
+# CHECKPOINT_INTERVAL seconds, whichever comes first
+CHECKPOINT_SIZE = 0x4000
+CHECKPOINT_INTERVAL = 5.0
+
+# Give up on a memory dump after this many attempts in a row to
+# restart it after a lost address sync or a timeout without getting
+# any more data
+RESYNC_RETRIES = 5
+
+# After a dump read about this fraction of the rows again, in windows
+# of VERIFY_WINDOW rows, and compare them with the image.  A window
+# with a row that doesn't match is read again VERIFY_ESCALATE times as
+# wide, up to VERIFY_MAX_WINDOW rows.
+VERIFY_SAMPLE = 0.01
+VERIFY_WINDOW = 8
+VERIFY_ESCALATE = 4
+VERIFY_MAX_WINDOW = 512
+
+# Confidence of the upper bound on the fraction of bad rows
+VERIFY_CONFIDENCE = 0.95
+
+# Seconds between progress lines and events while dumping memory
+PROGRESS_INTERVAL = 10.0
+
+# When surveying memory, dump this much from the start of each block
+SURVEY_BLOCK = 0x10000
+SURVEY_SAMPLE = 0x100
+
+# Size of the address space of each subsystem, the Executive has an
+# 80286, the Display and Time Base have 80186es and the Main Acq a 6809
+ADDRESS_SPACE = {
+    'a' : 0x1000000,
+    'b' : 0x100000,
+    'c' : 0x100000,
+    'd' : 0x10000,
+}
+
 class FriendlyException(Exception):
     pass
 
@@ -35,69 +138,712 @@ def sanitize_fn(s):
     return re.sub('[^-_A-Za-z0-9]', '_', s)
 
 class Printer():
-    def __init__(self, f):
-        self.f = f
+    """Echo the screen to stdout and write it to a log file.
+
+    The stream is split into lines at each "erase line" sequence and
+    at newlines.  This is done by a writer thread which is fed through
+    a bounded queue so that the thread reading the serial port never
+    has to wait for the disk.  The log is flushed at most once every
+    flush_interval seconds.
+
+    If the file name ends with ".gz" the log is compressed.  If
+    rotate is set the log is rotated when it has grown to that many
+    bytes, keeping up to "backups" old logs as log.1, log.2 and so on.
+    If echo is false the screen is only written to the log.
+    """
+
+    LINE_RE = re.compile('\033\\[2K|\r?\n')
+
+    # Write out a partial line if it grows larger than this
+    MAX_CARRY = 4096
+
+    def __init__(self, fn = 'log', rotate = 0, backups = 5,
+                 queue_size = 4096, flush_interval = 1.0, echo = True):
+        self.fn = fn
+        self.echo = echo
+        self.rotate = rotate
+        self.backups = backups
+        self.flush_interval = flush_interval
         self.current_level = 2
-        self.last = ''
+        self.activity = None
 
-    def write(self, s):
-        if self.current_level < 1000:
-            sys.stdout.write(s)
-            sys.stdout.flush()
+        self.last = ''
+        self.size = 0
+        self.f = self.open()
+
+        # Statistics
+        self.stalls = 0
+        self.received = 0
+
+        self.queue = queue.Queue(queue_size)
+        self.thread = threading.Thread(target = self.writer, daemon = True)
+        self.thread.start()
+
+    def open(self):
+        if self.fn.endswith('.gz'):
+            return gzip.open(self.fn, 'wt', compresslevel = 6)
+        return open(self.fn, 'w')
+
+    def do_rotate(self):
+        self.f.close()
+        base, ext = self.fn, ''
+        if base.endswith('.gz'):
+            base, ext = base[:-3], '.gz'
+        for i in range(self.backups - 1, 0, -1):
+            src = '%s.%u%s' % (base, i, ext)
+            if os.path.exists(src):
+                os.replace(src, '%s.%u%s' % (base, i + 1, ext))
+        if self.backups:
+            os.replace(self.fn, '%s.1%s' % (base, ext))
+        self.f = self.open()
+        self.size = 0
+
+    def split(self, s):
+        """Split s into complete lines, keeping the rest for later"""
 
         s = self.last + s
-        r = re.compile('\033\\[2K|\n')
+        lines = []
         i = 0
-        while 1:
-            match = r.search(s, i)
-            if not match:
-                break
-
-            if match.group() == '\r\n':
-                e = match.start()
+        for match in self.LINE_RE.finditer(s):
+            if match.group() == '\033[2K':
+                lines.append(s[i:match.end()])
             else:
-                e = match.end()
-            self.f.write(s[i:e])
-            self.f.write('\n')
+                lines.append(s[i:match.start()])
             i = match.end()
 
-        self.f.flush()
         self.last = s[i:]
+        if len(self.last) > self.MAX_CARRY:
+            lines.append(self.last)
+            self.last = ''
+
+        return lines
+
+    def writer(self):
+        last_flush = time.time()
+        done = False
+        while not done:
+            try:
+                items = [ self.queue.get(timeout = self.flush_interval) ]
+            except queue.Empty:
+                items = []
+
+            # Take everything that is queued in one go
+            while 1:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            lines = []
+            flush = False
+            for item in items:
+                if item is None:
+                    flush = done = True
+                elif isinstance(item, threading.Event):
+                    flush = True
+                else:
+                    lines.extend(self.split(item))
+
+            if done and self.last:
+                lines.append(self.last)
+                self.last = ''
+
+            if lines:
+                data = '\n'.join(lines) + '\n'
+                self.f.write(data)
+                self.size += len(data)
+
+            now = time.time()
+            if flush or now - last_flush >= self.flush_interval:
+                self.f.flush()
+                last_flush = now
+
+            for item in items:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+            if self.rotate and self.size >= self.rotate:
+                self.do_rotate()
+
+        self.f.close()
+
+    def message(self, s):
+        """Log a message which is not part of the screen output."""
+
+        self.queue.put(s)
+
+    def move(self, fn):
+        """Move the log to fn and keep on writing to it there."""
+
+        self.flush()
+        os.replace(self.fn, fn)
+        self.fn = fn
+
+    def write(self, s):
+        self.received += len(s)
+        if self.activity:
+            self.activity()
+
+        if self.echo and self.current_level < 1000:
+            sys.stdout.write(s)
+            sys.stdout.flush()
+
+        try:
+            self.queue.put_nowait(s)
+        except queue.Full:
+            self.stalls += 1
+            self.queue.put(s)
 
     def flush(self):
-        if self.current_level < 1000:
+        if self.echo and self.current_level < 1000:
             sys.stdout.flush()
 
-        self.f.flush()
+        if self.thread.is_alive():
+            done = threading.Event()
+            self.queue.put(done)
+            done.wait()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
 
     def level(self, level):
         last_level = self.current_level
         self.current_level = level
         return last_level
 
+class Pacer():
+    """Adaptive delays between keystrokes.
+
+    Keys are sent as soon as the line has been quiet for the learned
+    delay of their kind.  When a key seems to have been dropped the
+    delay is doubled, up to the conservative delay.  After a run of
+    successes the delay is slowly decreased again, but never down to
+    a delay where a key has been dropped before.
+    """
+
+    def __init__(self, delays = None):
+        self.delays = dict(PACE_INITIAL)
+        if delays:
+            self.delays.update(delays)
+        self.last = 0
+        self.successes = {}
+        self.floor = dict(PACE_INITIAL)
+
+        # Statistics
+        self.drops = 0
+
+    def activity(self):
+        self.last = time.time()
+
+    def remaining(self, kind):
+        return self.last + self.delays[kind] - time.time()
+
+    def ok(self, kind):
+        n = self.successes.get(kind, 0) + 1
+        if n >= 8:
+            self.delays[kind] = max(self.floor[kind] * 1.25,
+                                    self.delays[kind] * 0.75)
+            n = 0
+        self.successes[kind] = n
+
+    def dropped(self, kind):
+        self.drops += 1
+        self.successes[kind] = 0
+        self.floor[kind] = max(self.floor[kind], self.delays[kind])
+        self.delays[kind] = min(PACE_CONSERVATIVE[kind],
+                                max(self.delays[kind] * 2,
+                                    PACE_CONSERVATIVE[kind] / 8))
+
+    def conservative(self, kind):
+        return self.delays[kind] >= PACE_CONSERVATIVE[kind]
+
+def load_sessions():
+    """Load the session cache.
+
+    The cache has the state of each instrument when it was last used,
+    keyed by Tek.main which includes the UID of the mainframe, and
+    which instrument was last seen on each serial port.
+    """
+
+    try:
+        with open(SESSION_FN) as f:
+            sessions = json.load(f)
+    except (OSError, ValueError):
+        sessions = {}
+    sessions.setdefault('ports', {})
+    sessions.setdefault('instruments', {})
+    return sessions
+
+# Several instruments can be backed up at the same time
+session_lock = threading.Lock()
+
+def save_session(key, port, session):
+    with session_lock:
+        sessions = load_sessions()
+        session['updated'] = datetime.datetime.now().isoformat()
+        sessions['instruments'][key] = session
+        sessions['ports'][port] = key
+        sessions['last'] = key
+
+        tmp_fn = SESSION_FN + '.tmp'
+        with open(tmp_fn, 'w') as f:
+            json.dump(sessions, f, indent = 4, sort_keys = True)
+        os.replace(tmp_fn, SESSION_FN)
+
+def error_bound(n, k, confidence = VERIFY_CONFIDENCE):
+    """Upper bound on the fraction of bad rows.
+
+    k of n rows picked at random were bad, the fraction of bad rows
+    is below the returned value with the given confidence.  This is
+    the Clopper-Pearson bound, found by bisection.
+    """
+
+    if k >= n:
+        return 1.0
+
+    # The terms are calculated as logarithms, math.comb(n, i) is far
+    # too large for a float when many rows are bad
+    def cdf(p):
+        lp = math.log(p)
+        lq = math.log1p(-p)
+        return sum(math.exp(math.lgamma(n + 1) - math.lgamma(i + 1) -
+                            math.lgamma(n - i + 1) + i * lp + (n - i) * lq)
+                   for i in range(k + 1))
+
+    lo, hi = k / n, 1.0
+    for i in range(50):
+        p = (lo + hi) / 2
+        if cdf(p) > 1 - confidence:
+            lo = p
+        else:
+            hi = p
+    return hi
+
+def first(values, value):
+    """Return a copy of values with value moved to the front."""
+
+    if value in values:
+        return [ value ] + [ _ for _ in values if _ != value ]
+    return list(values)
+
+class Journal():
+    """Checkpoint journal for a memory dump.
+
+    Dumped data is buffered in memory and appended to the dump file at
+    checkpoints.  After each append the file is synced and a small
+    JSON journal next to it is replaced with one recording how many
+    bytes of the file are valid and the CRC of every appended block.
+    An interrupted dump can then be resumed exactly where the last
+    checkpoint left it, anything written after that is thrown away.
+    """
+
+    def __init__(self, fn, start, byte_order,
+                 size = CHECKPOINT_SIZE, interval = CHECKPOINT_INTERVAL):
+        self.fn = fn
+        self.journal_fn = fn + '.journal'
+        self.size = size
+        self.interval = interval
+
+        self.state = {
+            'start' : start,
+            'byte_order' : byte_order,
+            'length' : 0,
+            'next' : start,
+            'blocks' : [],
+            'baudrate' : None,
+            'flagged' : [],
+            'verified' : False,
+            'created' : datetime.datetime.now().isoformat(),
+            'updated' : None,
+        }
+
+        self.f = None
+        self.buf = bytearray()
+        self.last = time.time()
+
+        # Statistics
+        self.commits = 0
+
+    def load(self):
+        try:
+            with open(self.journal_fn) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if (state.get('start') != self.state['start'] or
+            state.get('byte_order') != self.state['byte_order']):
+            print("%s does not match this dump, ignoring it" % (
+                self.journal_fn), file = sys.stderr)
+            return None
+
+        return state
+
+    def resume(self):
+        """Return the number of valid bytes in the dump file.
+
+        The file is truncated to that length.
+        """
+
+        if not os.path.exists(self.fn):
+            return 0
+
+        state = self.load()
+        if state is None:
+            # No journal, the file was written a row at a time
+            length = os.path.getsize(self.fn) // ROW_SIZE * ROW_SIZE
+            self.state['length'] = length
+            self.state['next'] = self.state['start'] + length
+            self.state['blocks'] = []
+            if length:
+                with open(self.fn, 'rb') as f:
+                    data = f.read(length)
+                self.state['blocks'].append([ length, zlib.crc32(data) ])
+
+        else:
+            self.state = state
+            state.setdefault('flagged', [])
+            state.setdefault('verified', False)
+            length = 0
+            blocks = []
+            with open(self.fn, 'rb') as f:
+                for n, crc in state['blocks']:
+                    data = f.read(n)
+                    if len(data) != n or zlib.crc32(data) != crc:
+                        print("%s: bad block at offset 0x%x" % (
+                            self.fn, length), file = sys.stderr)
+                        break
+                    length += n
+                    blocks.append([ n, crc ])
+            self.state['length'] = length
+            self.state['next'] = self.state['start'] + length
+            self.state['blocks'] = blocks
+
+        with open(self.fn, 'r+b') as f:
+            f.truncate(length)
+
+        return length
+
+    def open(self, baudrate = None):
+        self.state['baudrate'] = baudrate
+        self.f = open(self.fn, 'ab')
+        self.last = time.time()
+
+    def write(self, data):
+        self.buf += data
+        if (len(self.buf) >= self.size or
+            time.time() - self.last >= self.interval):
+            self.commit()
+
+    def commit(self):
+        self.last = time.time()
+        if not self.buf:
+            return
+
+        self.f.write(self.buf)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+        self.state['length'] += len(self.buf)
+        self.state['next'] = self.state['start'] + self.state['length']
+        self.state['blocks'].append([ len(self.buf), zlib.crc32(self.buf) ])
+        self.save()
+
+        self.buf.clear()
+        self.commits += 1
+
+    def save(self):
+        self.state['updated'] = datetime.datetime.now().isoformat()
+
+        tmp_fn = self.journal_fn + '.tmp'
+        with open(tmp_fn, 'w') as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fn, self.journal_fn)
+
+    def flag(self, addr):
+        """Remember a row which might be bad, saved with the next commit"""
+
+        if addr not in self.state['flagged']:
+            self.state['flagged'].append(addr)
+
+    def replace(self, data):
+        """Replace the whole dump file, after repairing it"""
+
+        tmp_fn = self.fn + '.tmp'
+        with open(tmp_fn, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fn, self.fn)
+
+        self.state['length'] = len(data)
+        self.state['next'] = self.state['start'] + len(data)
+        self.state['blocks'] = [ [ len(data), zlib.crc32(data) ] ]
+        self.save()
+
+    def close(self):
+        if self.f:
+            self.commit()
+            self.f.close()
+            self.f = None
+
+    def remove(self):
+        if os.path.exists(self.journal_fn):
+            os.remove(self.journal_fn)
+
+class Buffer():
+    """Collects what read_mem reads when it doesn't go to a journal"""
+
+    def __init__(self):
+        self.data = bytearray()
+        self.flagged = []
+
+    def write(self, data):
+        self.data += data
+
+    def flag(self, addr):
+        self.flagged.append(addr)
+
+def write_report(path, report):
+    """Write the confidence report for an image next to it"""
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    report = dict(report, file = os.path.basename(path),
+                  sha256 = hashlib.sha256(data).hexdigest())
+    with open(path + '.verify.json', 'w') as f:
+        json.dump(report, f, indent = 4, sort_keys = True)
+
+class Telemetry():
+    """Write events as JSON lines.
+
+    Each event has the time, the seconds since the start and what
+    happened.  Without a file name the events are thrown away.
+    """
+
+    def __init__(self, fn = None):
+        self.fn = fn
+        self.f = None
+        self.t0 = time.time()
+        self.lock = threading.Lock()
+
+    def event(self, name, **fields):
+        if not self.fn:
+            return
+
+        t = time.time()
+        record = dict(time = time.strftime('%Y-%m-%dT%H:%M:%S',
+                                           time.localtime(t)),
+                      elapsed = round(t - self.t0, 3),
+                      event = name)
+        record.update(fields)
+        with self.lock:
+            if not self.f:
+                self.f = open(self.fn, 'a')
+            self.f.write(json.dumps(record) + '\n')
+            self.f.flush()
+
+    def move(self, fn):
+        """Move the events to fn and keep on writing to it there."""
+
+        with self.lock:
+            if self.f:
+                self.f.close()
+                self.f = None
+            if self.fn and os.path.exists(self.fn):
+                os.replace(self.fn, fn)
+            self.fn = fn
+
+    def close(self):
+        with self.lock:
+            if self.f:
+                self.f.close()
+                self.f = None
+
+def format_eta(t):
+    if t is None:
+        return '-:--:--'
+    t = max(int(t), 0)
+    return '%u:%02u:%02u' % (t // 3600, t // 60 % 60, t % 60)
+
 class Tek():
-    def __init__(self, ser):
+    def __init__(self, ser, printer = None, reader = None):
         self.ser = ser
         self.debug = 10
         self.keep_tmp = True
 
+        # Read memory dumps directly from the serial port
+        self.raw_dump = True
+
+        # Seconds between checkpoints of a memory dump
+        self.checkpoint_interval = CHECKPOINT_INTERVAL
+
+        # Subsystems to survey after dumping the known memories
+        self.survey_subsystems = []
+
+        # Check existing EPROM images with the ROM checksum tests
+        self.verify = False
+
+        # Fraction of the rows of each dump to read again
+        self.verify_sample = VERIFY_SAMPLE
+
+        # Dump plan to use instead of the one for the model, and how
+        # many seconds a run may take
+        self.plan_fn = None
+        self.budget = None
+
+        # Only read the NVRAM regions of the plan and add snapshots of
+        # them to the archive
+        self.snapshot = False
+
+        # (subsystem, start) of the NVRAM regions in the plan
+        self.nvram = set()
+
+        # Where to keep every unique sampling head EEPROM image, the
+        # caller sets it, usually from --archive
+        self.archive = None
+
+        # Structured events and how often to log progress
+        self.telemetry = Telemetry()
+        self.progress_interval = PROGRESS_INTERVAL
+        self.show_progress = True
+        self.last_progress = 0
+
         ser.inter_byte_timeout = 0.1
 
-        self.spawn = pexpect_serial.SerialSpawn(
-            ser, encoding = 'ASCII', codec_errors = 'replace',
-            timeout = 5)
+        # Read the serial port from a thread so that it doesn't
+        # overrun if this thread stalls
+        if reader is None:
+            reader = SerialReader(ser)
+        self.reader = reader
 
-        logf = open('log','w')
-        self.printer = Printer(logf)
+        self.spawn = self.new_spawn(timeout = 5)
+
+        if printer is None:
+            printer = Printer()
+        self.printer = printer
         self.printer.level(2)
 
-        self.spawn.logfile_read = self.printer
+        # Everything received is drawn on a model of the screen
+        self.screen = Screen()
 
+        self.main = None
         self.main_baudrate = None
         self.test_baudrate = None
 
+        # Subsystem the Low-Level Hardware Debugger is running for
+        self.debugger = None
+
+        # State of the instrument, saved to the session cache
+        self.session = {}
+
+        # What is going on and how many bytes of memory have been
+        # dumped out of the total
+        self.status = 'idle'
+        self.done = 0
+        self.total = 0
+
         self.after = ''
-        self.saved = ''
+
+        self.pacer = Pacer()
+        self.printer.activity = lambda: self.pacer.activity()
+
+        # Time spent sleeping and waiting for the instrument
+        self.sleep_time = 0.0
+        self.expect_time = 0.0
+
+        # Keys sent again, lost address syncs, dumps which stopped
+        # early, restarted dumps, dumped lines and rows which were
+        # repaired after reading them again
+        self.retries = 0
+        self.sync_losses = 0
+        self.dump_timeouts = 0
+        self.resyncs = 0
+        self.rows = 0
+        self.repairs = 0
+
+        # Bytes dumped from the instrument and the time it took, bytes
+        # resumed from a checkpoint or skipped are not counted.  Bytes
+        # read again to verify a dump are also counted in reread_bytes
+        self.dumped = 0
+        self.reread_bytes = 0
+        self.dump_time = 0.0
+        self.dump_t0 = None
+
+    def close(self):
+        self.reader.stop()
+        self.telemetry.close()
+        self.printer.close()
+
+    def counters(self):
+        return dict(received = self.printer.received, dumped = self.dumped,
+                    rows = self.rows, retries = self.retries,
+                    sync_losses = self.sync_losses,
+                    dump_timeouts = self.dump_timeouts,
+                    resyncs = self.resyncs,
+                    repairs = self.repairs,
+                    reread_bytes = self.reread_bytes,
+                    overruns = self.reader.overruns,
+                    sleep = round(self.sleep_time, 3),
+                    wait = round(self.expect_time, 3))
+
+    def dump_rate(self):
+        """Payload bytes per second while dumping memory"""
+
+        t = self.dump_time
+        if self.dump_t0 is not None:
+            t += time.time() - self.dump_t0
+        if not t:
+            return None
+        return self.dumped / t
+
+    def eta(self):
+        """Seconds left of the backup at the rate seen so far"""
+
+        rate = self.dump_rate()
+        if not rate:
+            return None
+        return max(self.total - self.done, 0) / rate
+
+    def event(self, name, **fields):
+        eta = self.eta()
+        record = self.counters()
+        record.update(status = self.status, done = self.done,
+                      total = self.total,
+                      eta = round(eta) if eta is not None else None)
+        record.update(fields)
+        self.telemetry.event(name, **record)
+
+    def progress(self):
+        """Log progress and show a progress line now and then"""
+
+        t = time.time()
+        if t - self.last_progress < self.progress_interval:
+            return
+        self.last_progress = t
+
+        rate = self.dump_rate() or 0
+        self.event('progress', rate = round(rate))
+        if self.show_progress and self.total:
+            print("%s %5.1f%% %6.0f B/s ETA %s retries %u resyncs %u "
+                  "overruns %u" % (
+                      self.status, 100.0 * self.done / self.total, rate,
+                      format_eta(self.eta()), self.retries,
+                      self.resyncs, self.reader.overruns),
+                  file = sys.stderr)
+
+    def write(self, s):
+        """Everything received ends up here, from pexpect or raw_rows"""
+
+        self.screen.feed(s)
+        self.printer.write(s)
+
+    def flush(self):
+        self.printer.flush()
 
     def set_baudrate(self, baudrate):
         print("Baudrate %u bps" % baudrate, file = sys.stderr)
@@ -105,23 +851,176 @@ class Tek():
 
     def reset_input_buffer(self):
         self.ser.reset_input_buffer()
+        self.reader.clear()
 
     def send(self, buf, *args, **kwargs):
-        return self.spawn.send(buf, *args, **kwargs)
+        n = self.spawn.send(buf, *args, **kwargs)
+        self.pacer.activity()
+        return n
+
+    def sleep(self, t):
+        time.sleep(t)
+        self.sleep_time += t
+
+    def pace(self, kind = 'menu'):
+        t = self.pacer.remaining(kind)
+        if t > 0:
+            self.sleep(t)
+
+    def wait_quiet(self, quiet = 0.2):
+        """Wait until nothing has been received for a while"""
+
+        while self.pacer.remaining('menu') > -quiet:
+            self.expect(pexpect.TIMEOUT, timeout = quiet)
+
+    def wait_screen(self, test, timeout = -1):
+        """Wait until an update of the screen is complete and test()
+        returns something.
 
-    def send_delay(self, buf, delay, *args, **kwargs):
-        for b in buf:
-            self.spawn.send(b, *args, **kwargs)
-            time.sleep(delay)
+        Returns what test returned.
+        """
+
+        if timeout == -1:
+            timeout = self.spawn.timeout
+        end = time.time() + timeout
+        while 1:
+            result = self.screen.home and test()
+            if result:
+                break
+            self.expect(HOME_PAT, timeout = max(end - time.time(), 0))
+
+        # The screen has seen everything pexpect has read
+        self.set_buffer()
+        return result
+
+    def key(self, c, show = None, selected = None, retry = False,
+            kind = 'menu'):
+        """Send a key and wait for the response.
+
+        The response is an update of the screen.  If show is given the
+        update has to draw that text, if selected is given the row
+        with the selected menus has to show it.  The key is sent as
+        soon as the pacer allows.  If retry is set and the response
+        doesn't show up in time the key is assumed to have been
+        dropped and is sent again after backing off.  Only use retry
+        for keys which are harmless to send twice.
+        """
+
+        for attempt in range(KEY_RETRIES if retry else 1):
+            self.pace(kind)
+            mark = self.screen.mark()
+            self.send(c)
+            if selected is not None:
+                test = lambda: selected in self.screen.menu(mark)
+            elif show is not None:
+                test = lambda: self.screen.find(show, mark)
+            else:
+                test = lambda: self.screen.changed(mark)
+            try:
+                result = self.wait_screen(
+                    test, timeout = KEY_TIMEOUT if retry else -1)
+            except pexpect.exceptions.TIMEOUT:
+                self.pacer.dropped(kind)
+                self.retries += 1
+                if self.debug >= 1:
+                    print("No response to %s, backing off to %.2f s" % (
+                        repr(c), self.pacer.delays[kind]), file = sys.stderr)
+                continue
+
+            self.pacer.ok(kind)
+            return result
+
+        raise pexpect.exceptions.TIMEOUT("no response to %s" % repr(c))
+
+    def enter_value(self, field, label, value):
+        """Type a hex value into a field in the debugger.
+
+        The digits are paced by the pacer and the value shown on the
+        screen afterwards is checked.  When the pacer has backed off
+        all the way the old fixed delays are used around the digits.
+        """
+
+        confirm = '%s +0*%X .*%s' % (label, value, HOME_PAT)
+
+        retry = False
+        while 1:
+            conservative = self.pacer.conservative('digit')
+
+            # Close the field if the last Enter was dropped
+            if retry:
+                self.retries += 1
+                self.pace()
+                self.send('\r')
+            retry = True
+
+            # Whatever is left of the last screen update must not be
+            # taken for the response to the field key
+            self.pace()
+            self.expect(pexpect.TIMEOUT, timeout = 0)
+            self.set_buffer()
+            self.send(field)
+            if conservative:
+                self.sleep(1)
+            else:
+                # Anything shown on the screen means that the field
+                # key made it, the digits are checked afterwards
+                try:
+                    self.expect(ESC_PAT, timeout = KEY_TIMEOUT)
+                except pexpect.exceptions.TIMEOUT:
+                    self.pacer.dropped('menu')
+                    if not self.pacer.conservative('menu'):
+                        continue
+
+            for d in '%x' % value:
+                self.pace('digit')
+                self.send(d)
+            if conservative:
+                self.sleep(1)
+            self.pace('digit')
+            self.send('\r')
+
+            try:
+                self.expect(confirm, timeout = KEY_TIMEOUT)
+            except pexpect.exceptions.TIMEOUT:
+                if conservative:
+                    print("warning: could not verify %s 0x%x" % (
+                        label, value), file = sys.stderr)
+                    return
+                self.pacer.dropped('digit')
+                continue
+
+            self.pacer.ok('digit')
+            return
+
+    def new_spawn(self, timeout, s = ''):
+        """A pexpect spawn on the reader which has read s so far"""
+
+        spawn = ReaderSpawn(
+            self.ser, self.reader, encoding = 'ASCII',
+            codec_errors = 'replace', timeout = timeout)
+        spawn.logfile_read = self
+        spawn.buffer = s
+        return spawn
+
+    def set_buffer(self, s = ''):
+        """Replace what pexpect has read but not matched yet"""
+
+        # Setting the buffer is not enough, pexpect keeps a copy of
+        # what it has read and goes back to it on the next expect.
+        # The reader and the screen keep their state, so start over
+        # with a new spawn.
+        self.spawn = self.new_spawn(self.spawn.timeout, s)
 
     def sendline(self, *args, **kwargs):
         return self.spawn.sendline(*args, **kwargs)
 
-    def expect(self, *args, save = False, **kwargs):
-        idx = self.spawn.expect(*args, **kwargs)
+    def expect(self, *args, **kwargs):
+        t0 = time.time()
+        try:
+            idx = self.spawn.expect(*args, **kwargs)
+        finally:
+            self.expect_time += time.time() - t0
         self.after = self.spawn.after
-        if save:
-            self.saved = self.after
         return idx
 
     def get_dev_id(self):
@@ -146,29 +1045,37 @@ class Tek():
 
         return s[4:].strip()
 
+    def save_session(self, **kwargs):
+        self.session.update(kwargs)
+        if self.main:
+            self.session['pacing'] = self.pacer.delays
+            save_session(self.main, self.ser.port, self.session)
+
     def exit_test_mode(self):
         self.send('XEE')
+        self.debugger = None
+        self.save_session(menu = 'main')
 
-    def hard_exit_test_mode(self):
+    def hard_exit_test_mode(self, baudrate = None):
         # Try to exit test modea
         if self.debug >= 1:
             print("Trying to exit test modes", file = sys.stderr)
 
         last_level = self.printer.level(1000)
-        for b in TEST_BAUDRATES:
+        for b in first(TEST_BAUDRATES, baudrate):
             self.set_baudrate(b)
             self.exit_test_mode()
-            time.sleep(0.5)
+            self.sleep(0.5)
 
         self.printer.level(last_level)
 
-    def try_connect(self):
-        for b in MAIN_BAUDRATES:
+    def try_connect(self, baudrate = None):
+        for b in first(MAIN_BAUDRATES, baudrate):
             if self.debug >= 1:
                 print("Trying to connect at %u bps" % b, file = sys.stderr)
             self.set_baudrate(b)
             self.sendline('')
-            time.sleep(0.1)
+            self.sleep(0.1)
             self.reset_input_buffer()
 
             dev_id = self.get_dev_id()
@@ -180,14 +1087,40 @@ class Tek():
             return dev_id
 
     def connect(self):
-        dev_id = self.try_connect()
+        self.status = 'connecting'
+
+        # Start with what worked for the instrument last seen on this
+        # port, it is probably the same one
+        sessions = load_sessions()
+        key = sessions['ports'].get(self.ser.port, sessions.get('last'))
+        last = sessions['instruments'].get(key, {})
+        main_baudrate = last.get('main_baudrate')
+        test_baudrate = last.get('test_baudrate')
+
+        dev_id = None
+        if last.get('menu') == 'test':
+            # It was left in test mode, exit at the baudrate it used
+            if self.debug >= 1:
+                print("Last session left %s in test mode" % key,
+                      file = sys.stderr)
+            last_level = self.printer.level(1000)
+            self.set_baudrate(last.get('baudrate') or test_baudrate or
+                              TEST_BAUDRATE)
+            self.exit_test_mode()
+            self.sleep(0.5)
+            self.printer.level(last_level)
+            self.reset_input_buffer()
+        else:
+            dev_id = self.try_connect(main_baudrate)
+
         if not dev_id:
             for retry in range(10):
-                self.hard_exit_test_mode()
-                time.sleep(1)
-                self.reset_input_buffer()
+                if retry or last.get('menu') != 'test':
+                    self.hard_exit_test_mode(test_baudrate)
+                    self.sleep(1)
+                    self.reset_input_buffer()
 
-                dev_id = self.try_connect()
+                dev_id = self.try_connect(main_baudrate)
                 if dev_id:
                     break
 
@@ -220,61 +1153,81 @@ class Tek():
 
         self.rom_dir = sanitize_fn(self.main)
 
+        sessions = load_sessions()
+        self.session = sessions['instruments'].get(self.main, {})
+        self.pacer = Pacer(self.session.get('pacing'))
+        self.save_session(main_baudrate = self.main_baudrate, menu = 'main')
+
         now = datetime.datetime.now().strftime('%Y%m%d-%H%M')
         self.module_dir = 'MODULES-%s' % now
 
 
-    def dump_module(self, unit):
+    def dump_modules(self, units):
+        """Read the sampling head EEPROMs in a list of slots.
+
+        Both heads of an Acq are read back to back from the "Select
+        function" prompt of one run of the Registers exerciser, the
+        menus are only changed when moving on to the other Acq.
+        """
+
+        if not units:
+            return
+
+        self.leave_debugger()
         os.makedirs(self.module_dir, exist_ok = True)
 
-        acq = (unit - 1) // 2
+        for acq in sorted(set((_ - 1) // 2 for _ in units)):
+            self.start_exerciser(acq)
+            for unit in sorted(units):
+                if (unit - 1) // 2 == acq:
+                    self.read_module(unit)
+            self.key('X', show = ' Stopped ', retry = True)
+
+        self.redraw()
+
+    def dump_module(self, unit):
+        self.dump_modules([ unit ])
+
+    def start_exerciser(self, acq):
+        """Run the Registers exerciser on an Acq, counting from 0"""
+
         acq_key = 'ab'[acq]
-        num = (unit - 1) % 2 + 1
 
-        if ' Stopped ' not in self.saved:
-            self.send('q')
+        if self.screen.find(' Stopped ') is None:
+            self.key('q', show = ' Stopped ', retry = True)
 
-        self.send('1')
-        if ' Main Acq ' not in self.saved:
-            self.send('d')
-            self.expect(' Main Acq .*' + HOME_PAT)
+        if ' Main Acq ' not in self.screen.menu():
+            self.key('1', retry = True)
+            self.key('d', selected = ' Main Acq ', retry = True)
 
         s = ' Acq %u ' % (acq + 1)
-        if s not in self.saved:
-            time.sleep(1)
-            self.send('2')
-            self.expect(HOME_PAT)
-            self.send(acq_key)
-            self.expect(s + '.*' + HOME_PAT)
-
-        if ' Exercisers ' not in self.saved:
-            time.sleep(1)
-            self.send('3')
-            self.expect(HOME_PAT)
-            self.send('g')
-            self.expect(' Exercisers .*' + HOME_PAT)
-
-        if ' Registers ' not in self.saved:
-            self.send('4')
-            self.expect(HOME_PAT)
-            self.send('e')
-            self.expect(' Registers .*' + HOME_PAT)
-
-        time.sleep(1)
-        self.send('r')
+        if s not in self.screen.menu():
+            self.key('2', retry = True)
+            self.key(acq_key, selected = s, retry = True)
 
-        self.expect('Select function.*' + HOME_PAT)
-        time.sleep(1)
-        self.send('2')
-        self.expect(' Enter.*' + HOME_PAT)
-        time.sleep(1)
-        self.send('\r')
+        if ' Exercisers ' not in self.screen.menu():
+            self.key('3', retry = True)
+            self.key('g', selected = ' Exercisers ', retry = True)
 
-        self.expect('Enter head number.*' + HOME_PAT)
-        self.send('%u' % num)
-        time.sleep(1)
-        self.expect(' Enter.*' + HOME_PAT)
-        time.sleep(1)
+        if ' Registers ' not in self.screen.menu():
+            self.key('4', retry = True)
+            self.key('e', selected = ' Registers ', retry = True)
+
+        self.key('r', show = 'Select function', retry = True)
+
+    def read_module(self, unit):
+        """Read a head at the "Select function" prompt of the exerciser"""
+
+        self.status = 'module %u' % unit
+        self.event('module', slot = unit)
+
+        num = (unit - 1) % 2 + 1
+
+        self.key('2', show = ' Enter', retry = True)
+        self.key('\r', show = 'Enter head number')
+        self.key('%u' % num, show = ' Enter', retry = True)
+
+        self.pace()
         self.send('\r')
 
         # Wait until done and use everyting after "Enter head number" as the data
@@ -304,30 +1257,261 @@ class Tek():
             with open(os.path.join(self.module_dir, fn), 'wb') as f:
                 f.write(octets)
 
-        time.sleep(1)
-        self.send('\r')
+            if self.archive:
+                add_module(self.archive, bytes(octets), slot = unit,
+                           source = os.path.join(self.module_dir, fn))
 
-        self.expect('Select function.*' + HOME_PAT)
-        time.sleep(1)
-        self.send('X')
+        self.key('\r', show = 'Select function')
 
-        self.expect(' Stopped .*' + HOME_PAT)
+    def redraw(self):
+        """Toggle the output off and on to get a full redraw.
 
-        time.sleep(1)
-        self.send('1')
-        time.sleep(1)
-        self.send('T')
-        time.sleep(1)
+        If a T is dropped the output ends up off, so just send one
+        more.  The q first makes sure that the instrument is listening
+        without opening a menu which would eat the next key.
+        """
+
+        self.key('q', show = ' Stopped ', retry = True)
+        self.pace()
         self.send('T')
-        self.expect('EXTENDED DIAGNOSTICS', save = True)
+        self.key('T', show = 'EXTENDED DIAGNOSTICS', retry = True)
+
+    def rom_checksums(self, subsystem):
+        """Run the ROM checksum tests of a subsystem.
+
+        Returns a dict with the address of each EPROM as shown by the
+        test and a tuple with the routine, EXPECT and ACTUAL.
+        """
+
+        self.leave_debugger()
+        self.status = 'checksum %s' % subsystem
+
+        block_key, block, area_key, area = ROM_CHECKSUM_MENUS[subsystem]
+
+        if self.screen.find(' Stopped ') is None:
+            self.key('q', show = ' Stopped ', retry = True)
+
+        self.key('1' + subsystem,
+                 selected = ' %s ' % SUBSYSTEM_NAMES[subsystem], retry = True)
+        self.key('2', retry = True)
+        self.key(block_key, selected = ' %s ' % block, retry = True)
+        self.key('3', retry = True)
+        self.key(area_key, selected = ' %s ' % area, retry = True)
+
+        self.pace()
+        self.send('r')
+
+        pat = ('[a-z]\\) ([^\r\n\033]*?) +(?i:pass|fail)[^\r\n\033]*? '
+               '([0-9A-F]{6}) +([0-9A-F]{4}) +([0-9A-F]{4})')
+        r = re.compile(pat)
+        checksums = {}
+        while 1:
+            idx = self.expect([
+                pexpect.TIMEOUT,
+                ' Stopped .*' + HOME_PAT,
+                pat,
+            ], timeout = ROM_CHECKSUM_TIMEOUT)
+            if idx != 2:
+                break
+            match = r.match(self.spawn.after)
+            routine, addr, expect, actual = match.groups()
+            checksums[int(addr, 16)] = (routine, int(expect, 16),
+                                        int(actual, 16))
+
+        if idx != 1:
+            self.key('q', show = ' Stopped ', retry = True)
+        self.redraw()
+
+        return checksums
+
+    def verify_dumps(self, dumps):
+        """Verify existing EPROM images with the ROM checksum tests.
+
+        Images which don't match what the instrument calculates are
+        renamed to *.bad so that they are dumped again.  How the
+        checksum is calculated is a guess, so they are only removed
+        when the new dump is done.  Returns the dumps which were
+        verified.
+        """
+
+        # romtool imports NumPy which takes a while, so only do it
+        # when it is needed
+        from romtool import rom_checksum_file
+
+        checksums = {}
+        good = []
+        for subsystem, start, count, filenames, byte_order in dumps:
+            paths = [ os.path.join(self.rom_dir, _) for _ in filenames ]
+            if not all(os.path.exists(_) for _ in paths):
+                continue
+
+            if subsystem not in checksums:
+                checksums[subsystem] = self.rom_checksums(subsystem)
+
+            # With a pair of EPROMs the even one has the even address
+            ok = True
+            verified = False
+            for offset, path in enumerate(paths):
+                if start + offset not in checksums[subsystem]:
+                    continue
+                routine, expect, actual = checksums[subsystem][start + offset]
+                local = rom_checksum_file(path)
+                if local != (expect, actual):
+                    print("%s: checksum %04X %04X does not match %s %04X %04X" % (
+                        os.path.basename(path), local[0], local[1],
+                        routine, expect, actual), file = sys.stderr)
+                    ok = False
+                verified = True
+
+            if not verified:
+                continue
+
+            if ok:
+                print("%s verified" % ', '.join(filenames), file = sys.stderr)
+                good.append((subsystem, start, count, filenames, byte_order))
+                continue
+
+            self.set_aside(subsystem, start, filenames)
+
+        return good
+
+    def dump_paths(self, subsystem, start, filenames):
+        """The images of a dump and the temporary file with its journal"""
+
+        tmp_fn = self.mem_fn(subsystem, start)
+        return [ os.path.join(self.rom_dir, _) for _ in filenames ] + [
+            tmp_fn, tmp_fn + '.journal' ]
+
+    def set_aside(self, subsystem, start, filenames):
+        for path in self.dump_paths(subsystem, start, filenames):
+            if os.path.exists(path):
+                os.replace(path, path + '.bad')
+
+    def remove_set_aside(self, subsystem, start, filenames):
+        """Remove what set_aside kept once the dump has been done again"""
+
+        same = []
+        for fn in filenames:
+            path = os.path.join(self.rom_dir, fn)
+            if os.path.exists(path + '.bad'):
+                with open(path, 'rb') as f, open(path + '.bad', 'rb') as g:
+                    same.append(f.read() == g.read())
+        if same and all(same):
+            print("%s dumped again and nothing changed, the checksum is "
+                  "probably not calculated like that" % ', '.join(filenames),
+                  file = sys.stderr)
+
+        for path in self.dump_paths(subsystem, start, filenames):
+            if os.path.exists(path + '.bad'):
+                os.remove(path + '.bad')
+
+    def remove_dump(self, subsystem, start, filenames):
+        for path in self.dump_paths(subsystem, start, filenames):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def version(self, subsystem):
+        for k in SUBSYSTEM_IDS[subsystem]:
+            if k in self.subsystems:
+                return self.subsystems[k]
+        return None
+
+    def archive_images(self, subsystem, start, count, filenames):
+        """Add the images of a dump to the archive"""
+
+        if not self.archive:
+            return
+
+        # The NVRAM is different in every unit so it's not firmware
+        if (subsystem, start) in self.nvram:
+            return
+
+        for fn in filenames:
+            with open(os.path.join(self.rom_dir, fn), 'rb') as f:
+                data = f.read()
+            add_firmware(self.archive, data, fn, subsystem, start, count,
+                         self.version(subsystem), self.main)
+
+    def restore_images(self, dumps):
+        """Use images from the archive for dumps which are missing.
+
+        Returns the dumps where all images were found.  They have to
+        be verified since the archive only knows the name and version.
+        """
+
+        restored = []
+        for subsystem, start, count, filenames, byte_order in dumps:
+            if (subsystem, start) in self.nvram:
+                continue
+
+            paths = [ os.path.join(self.rom_dir, _) for _ in filenames ]
+            if all(os.path.exists(_) for _ in paths):
+                continue
+
+            hashes = [ find_firmware(self.archive, _, subsystem, start, count)
+                       for _ in filenames ]
+            if None in hashes:
+                continue
+
+            os.makedirs(self.rom_dir, exist_ok = True)
+            for path, h in zip(paths, hashes):
+                with open(path, 'wb') as f:
+                    f.write(self.archive.get(h))
+            print("%s found in archive" % ', '.join(filenames),
+                  file = sys.stderr)
+            restored.append((subsystem, start, count, filenames, byte_order))
+
+        return restored
+
+    def enter_debugger(self, subsystem):
+        """Start the Low-Level Hardware Debugger in 16 bit mode.
+
+        Does nothing if it is already running for the subsystem.
+        """
+
+        if self.debugger == subsystem:
+            return
+        self.leave_debugger()
+
+        self.key('1' + subsystem,
+                 selected = ' %s ' % SUBSYSTEM_NAMES[subsystem], retry = True)
+        self.key('D', show = 'Low-Level Hardware Debugger', retry = True)
+        self.debugger = subsystem
+
+        match = self.wait_screen(lambda: self.screen.search(' 8/16 .*? (8|16) '))
+        if match.group(1) == '8':
+            self.key('x', show = ' 16 ')
+
+    def leave_debugger(self):
+        if self.debugger is None:
+            return
+        self.debugger = None
+        try:
+            self.key('X', show = 'EXTENDED DIAGNOSTICS', retry = True)
+        except pexpect.exceptions.TIMEOUT:
+            pass
 
     def dump_mem(self, subsystem, start, count, *filenames,
-                 byte_order = '<'):
+                 byte_order = '<', retries = RESYNC_RETRIES, leave = True,
+                 tmp_fn = None, verify = True, progress = True):
         """Dump memory from subsystem.
 
         Dump count bytes of memory at address start from a subystem to
         files.  If there are multiple filenames the file will be split
         so that the files contain even/odd bytes.
+
+        If the addresses skip ahead or the dump stops early the
+        debugger is restarted at the first missing address.  After
+        retries attempts in a row without any progress a ValueError is
+        raised, what has been dumped is kept for the next run.
+
+        Unless verify is false a sample of the rows is read again
+        with verify_mem() and a confidence report is written next to
+        each file.
+
+        Unless leave is false the debugger is left afterwards.  The
+        whole region is kept in tmp_fn, by default in mem_fn().  Unless
+        progress is false the region counts towards done.
         """
 
         # Speed up when testing logic
@@ -341,212 +1525,900 @@ class Tek():
 
         os.makedirs(self.rom_dir, exist_ok = True)
 
-        tmp_fn = os.path.join(self.rom_dir, 'mem-%s-%08x.bin' % (
-            subsystem, start))
+        if tmp_fn is None:
+            tmp_fn = self.mem_fn(subsystem, start)
 
         # Check if all files already exist
         if filenames:
             for fn in filenames:
                 path = os.path.join(self.rom_dir, fn)
-                if not os.path.exists(path) or os.path.getsize(path) < count:
+                if (not os.path.exists(path) or
+                    os.path.getsize(path) < count // len(filenames)):
                     break
             else:
                 print("files exist: skipping dump")
+                if progress:
+                    self.done += count
+                self.archive_images(subsystem, start, count, filenames)
                 return
 
-        # Resume if temporary file already exists
-        if os.path.exists(tmp_fn):
-            n = os.path.getsize(tmp_fn)
-            start += n
-            count -= n
+        region = (subsystem, start, count)
+        before = self.counters()
+
+        # Resume from the last checkpoint of an earlier dump
+        journal = Journal(tmp_fn, start, byte_order,
+                          interval = self.checkpoint_interval)
+        n = journal.resume()
+        start += n
+        count -= n
+        if progress:
+            self.done += n
+
+        self.status = 'mem %s %06x' % (subsystem, start)
+        self.event('region_start', subsystem = subsystem, start = region[1],
+                   count = region[2], resumed = n)
 
         # Start download if we have something to read
+        t0 = time.time()
         if count > 0:
-            f = open(tmp_fn, 'ab')
-
-            self.send('1')
-            self.send(subsystem)
+            journal.open(self.ser.baudrate)
 
             try:
-                self.send('D')
-                time.sleep(1)
-
-                self.expect('Low-Level Hardware Debugger')
-
-                i = self.expect([
-                    ' 8/16 .* 8 .*' + HOME_PAT,
-                    ' 8/16 .* 16 .*' + HOME_PAT,
-                ])
-                if i == 0:
-                    self.send('x')
-                    self.expect(' 16 .*' + HOME_PAT)
-
-                self.send('s')
-                time.sleep(1)
-                self.send_delay('%x' % start, 0.1)
-                time.sleep(1)
-                self.send('\r')
-                self.send('l')
-                time.sleep(1)
-                self.send_delay('%x' % (count//2), 0.1)
-                time.sleep(1)
-                self.send('\r')
-
-                self.expect(pexpect.TIMEOUT)
-
-                time.sleep(1)
-                self.send('T')
-
-                pat = 'RM +[0-9A-F]+( +[0-9A-F]+)+'
-                r = re.compile(pat)
-                next = start
-                while count > 0:
-                    idx = self.expect([
-                        pexpect.TIMEOUT,
-                        pat + ' +.*\033',
-                    ])
-                    if idx == 0:
+                failures = 0
+                while 1:
+                    n, error = self.read_mem(journal, subsystem, start, count,
+                                             byte_order, progress = progress)
+                    start += n
+                    count -= n
+                    if count <= 0:
                         break
-                    else:
-                        match = r.match(self.spawn.after)
-                        parts = match.group().split()
-                        addr = int(parts[1], 16)
-                        words = [ int(_, 16) for _ in parts[2:] ]
-                        data = struct.pack('%s%uH' % (byte_order, len(words)), *words)
-                        if addr == next:
-                            f.write(data)
-                            f.flush()
-                            n = len(data)
-                            next = addr + n
-                            count -= n
-                        elif addr > next:
-                            raise ValueError('lost address sync')
+
+                    # Only read what is missing
+                    failures = failures + 1 if not n else 1
+                    if failures > retries:
+                        raise ValueError("%s at 0x%06x, giving up" % (
+                            error, start))
+                    self.resyncs += 1
+                    print("%s at 0x%06x, restarting there" % (error, start),
+                          file = sys.stderr)
+                    self.event('resync', subsystem = subsystem,
+                               addr = start, count = count, error = error)
+                    self.status = 'mem %s %06x' % (subsystem, start)
 
             finally:
-                self.send('X')
+                journal.close()
 
-            f.close()
+        # Read a sample of the rows again and repair what is wrong,
+        # read_mem has already left the debugger if the dump failed
+        report = None
+        try:
+            if verify and self.verify_sample and not journal.state['verified']:
+                report = self.verify_mem(journal, *region, byte_order)
+        finally:
+            if leave:
+                self.leave_debugger()
 
         # Split into parts
         if filenames:
+            from romtool import split_file
             arrays = split_file(tmp_fn, *[
                 os.path.join(self.rom_dir, _) for _ in filenames
             ])
+            self.remove_set_aside(*region[:2], filenames)
+            self.archive_images(*region, filenames)
+
+        if report:
+            for path in [ os.path.join(self.rom_dir, _)
+                          for _ in filenames ] or [ tmp_fn ]:
+                write_report(path, report)
 
         # Remove temporary file
         if not keep_tmp:
             os.remove(tmp_fn)
+            journal.remove()
+
+        t = time.time() - t0
+        after = self.counters()
+        delta = dict((k, round(after[k] - before[k], 3)) for k in after)
+        self.event('region_end', subsystem = subsystem, start = region[1],
+                   count = region[2], seconds = round(t, 3),
+                   rate = round(delta['dumped'] / t) if t else None,
+                   delta = delta)
+
+    def verify_mem(self, journal, subsystem, start, count, byte_order):
+        """Read a random sample of the rows of a dump again.
+
+        The sample is read in windows of VERIFY_WINDOW rows, together
+        with the rows the parser had doubts about.  When a row which
+        hasn't been seen before doesn't match the image, a window
+        VERIFY_ESCALATE times as wide around it is read, until nothing
+        new turns up or the window is VERIFY_MAX_WINDOW rows.  A row
+        where most of the reads agree on something other than the
+        image is repaired.
+
+        Returns a report with what was read and an upper bound on the
+        fraction of bad rows in the image, from the random sample.
+        """
 
-    def enable_debugger(self):
-        DEBUGGER_ENABLED = '\033\\[0;4;7m.* Debugger .*\033\\[0m'
-        if not re.search(DEBUGGER_ENABLED, self.saved):
-            print("Enabling debugger", file = sys.stderr)
-            self.send('WWWWWO')
-            self.expect(DEBUGGER_ENABLED + '.*' + HOME_PAT, timeout = 10)
+        with open(journal.fn, 'rb') as f:
+            image = bytearray(f.read())
+        rows = (len(image) + ROW_SIZE - 1) // ROW_SIZE
+
+        # Seeded from the image so that a replay picks the same rows
+        rng = random.Random(hashlib.sha256(image).digest())
+        windows = range(0, rows, VERIFY_WINDOW)
+        sampled = rng.sample(windows, min(len(windows), math.ceil(
+            rows * self.verify_sample / VERIFY_WINDOW)))
+        flagged = set((addr - start) // ROW_SIZE for addr in
+                      journal.state['flagged']
+                      if start <= addr < start + len(image))
+
+        todo = []
+        queued = set()
+        def add(first, n):
+            if (first, n) not in queued:
+                queued.add((first, n))
+                todo.append((first, n))
+
+        for first in sorted(set(sampled) |
+                            set(_ // VERIFY_WINDOW * VERIFY_WINDOW
+                                for _ in flagged)):
+            add(first, VERIFY_WINDOW)
+
+        self.status = 'verify %s %06x' % (subsystem, start)
+        reads = {}
+        suspects = set()
+        while todo:
+            first, n = todo.pop(0)
+            offset = first * ROW_SIZE
+            size = min(n * ROW_SIZE, len(image) - offset)
+            data = self.reread(subsystem, start + offset, size, byte_order)
+
+            new = []
+            for i in range(0, size, ROW_SIZE):
+                r = first + i // ROW_SIZE
+                row = data[i : i + ROW_SIZE]
+                reads.setdefault(r, []).append(row)
+                if row != image[offset + i : offset + i + ROW_SIZE]:
+                    if r not in suspects:
+                        new.append(r)
+            suspects.update(new)
+
+            if new and n < VERIFY_MAX_WINDOW:
+                n *= VERIFY_ESCALATE
+                add(first // n * n, n)
+            else:
+                # Read rows seen only once at the widest window again
+                for r in new:
+                    todo.append((r, 1))
+
+        # Majority vote between the image and the reads
+        repaired = []
+        unresolved = []
+        bad = set()
+        for r in sorted(suspects):
+            old = bytes(image[r * ROW_SIZE : (r + 1) * ROW_SIZE])
+            votes = [ old ] + reads[r]
+            best = max(votes, key = votes.count)
+            if votes.count(best) * 2 <= len(votes):
+                unresolved.append(start + r * ROW_SIZE)
+                bad.add(r)
+            elif best != old:
+                image[r * ROW_SIZE : (r + 1) * ROW_SIZE] = best
+                repaired.append(start + r * ROW_SIZE)
+                bad.add(r)
+
+        if repaired:
+            print("%s %06x: repaired %u rows at %s" % (
+                subsystem, start, len(repaired),
+                ' '.join('%06x' % _ for _ in repaired)), file = sys.stderr)
+            self.repairs += len(repaired)
+            journal.state['verified'] = True
+            journal.replace(image)
+        else:
+            journal.state['verified'] = True
+            journal.save()
 
-    def run(self):
-        self.connect()
+        if unresolved:
+            print("%s %06x: reads disagree at %s, dump again to be sure" % (
+                subsystem, start, ' '.join('%06x' % _ for _ in unresolved)),
+                  file = sys.stderr)
 
-        self.sendline('TEST MAN')
+        # Only the random sample says anything about the rest
+        sample_rows = set(r for first in sampled
+                          for r in range(first, min(first + VERIFY_WINDOW,
+                                                    rows)))
+        bound = error_bound(len(sample_rows), len(sample_rows & bad))
+        unchecked = rows - len(reads)
+
+        report = dict(
+            subsystem = subsystem, start = '%06x' % start, count = len(image),
+            time = datetime.datetime.now().isoformat(timespec = 'seconds'),
+            rows = rows, sample = self.verify_sample,
+            sampled = len(sample_rows), flagged = len(flagged),
+            reread = len(reads), mismatches = len(suspects),
+            repaired = [ '%06x' % _ for _ in repaired ],
+            unresolved = [ '%06x' % _ for _ in unresolved ],
+            confidence = VERIFY_CONFIDENCE,
+            error_bound = round(bound, 6),
+            bad_rows_bound = round(bound * unchecked, 1))
+
+        print("%s %06x: read %u of %u rows again, %u repaired, "
+              "%u unresolved, at most %.2f%% bad (%.0f%% confidence)" % (
+                  subsystem, start, len(reads), rows, len(repaired),
+                  len(unresolved), 100 * bound, 100 * VERIFY_CONFIDENCE),
+              file = sys.stderr)
+        self.event('verify_mem', subsystem = subsystem, start = start,
+                   reread = len(reads), mismatches = len(suspects),
+                   repaired = len(repaired), unresolved = len(unresolved),
+                   error_bound = report['error_bound'])
+
+        return report
+
+    def reread(self, subsystem, start, count, byte_order):
+        """Read memory again for verify_mem, returns the data"""
+
+        buf = Buffer()
+        failures = 0
+        while 1:
+            n, error = self.read_mem(buf, subsystem, start + len(buf.data),
+                                     count - len(buf.data), byte_order,
+                                     progress = False)
+            self.reread_bytes += n
+            if len(buf.data) >= count:
+                return bytes(buf.data[:count])
+
+            failures = failures + 1 if not n else 1
+            if failures > RESYNC_RETRIES:
+                raise ValueError("%s at 0x%06x, giving up" % (
+                    error, start + len(buf.data)))
+            self.resyncs += 1
+
+    def read_mem(self, journal, subsystem, start, count, byte_order,
+                 progress = True):
+        """Read memory with the debugger and append it to the journal.
+
+        Returns the number of bytes read and why it stopped before
+        count bytes had been read, or None if it didn't.  Unless it
+        stopped early the debugger is left running.  Unless progress
+        is false what is read counts as done.
+        """
 
-        self.printer.level(2)
+        error = 'failed'
+        try:
+            self.enter_debugger(subsystem)
+            self.enter_value('s', 'Start', start)
+            self.enter_value('l', 'Length', count // 2)
+
+            self.pace()
+            self.send('T')
+
+            if self.raw_dump:
+                rows = self.raw_rows(byte_order)
+            else:
+                rows = self.expect_rows(byte_order)
+
+            next = start
+            last = None
+            error = 'timeout'
+            self.dump_t0 = time.time()
+            try:
+                for addr, data in rows:
+                    if addr == next:
+                        journal.write(data)
+                        n = len(data)
+                        next = addr + n
+                        last = addr
+
+                        # Only the last row may be short
+                        if n < ROW_SIZE and next - start < count:
+                            journal.flag(addr)
+                        if progress:
+                            self.done += n
+                        self.dumped += n
+                        self.rows += 1
+                        if next - start >= count:
+                            error = None
+                            break
+                        self.progress()
+                    elif addr > next:
+                        self.sync_losses += 1
+                        error = 'lost address sync'
+                        break
+            finally:
+                rows.close()
+                self.dump_time += time.time() - self.dump_t0
+                self.dump_t0 = None
 
+            # The row before the dump went wrong might be damaged too
+            if error and last is not None:
+                journal.flag(last)
+
+            if error == 'timeout':
+                self.dump_timeouts += 1
+
+            # Wait for the dump to finish before changing anything
+            if not error:
+                try:
+                    self.expect(' Stopped .*' + HOME_PAT,
+                                timeout = KEY_TIMEOUT)
+                except pexpect.exceptions.TIMEOUT:
+                    error = 'not stopped'
+
+            return next - start, error
+
+        finally:
+            # The only way to stop a dump is to leave the debugger
+            if error:
+                self.leave_debugger()
+
+    def take_snapshots(self, items):
+        """Read the NVRAM regions of a plan and archive snapshots of them.
+
+        The debugger can only read, so the whole region is read every
+        time, but only the blocks which changed since the last
+        snapshot are stored.
+        """
+
+        for item in items:
+            if item['kind'] != 'mem' or not item['nvram']:
+                continue
+
+            subsystem, start = item['subsystem'], item['start']
+            fn = os.path.join(self.rom_dir, 'snapshot-%s-%08x.bin' % (
+                subsystem, start))
+
+            # A snapshot is of one moment, don't resume an old one
+            journal = Journal(fn, start, item['byte_order'])
+            journal.remove()
+            if os.path.exists(fn):
+                os.remove(fn)
+
+            self.dump_mem(subsystem, start, item['count'],
+                          byte_order = item['byte_order'], leave = False,
+                          tmp_fn = fn)
+
+            with open(fn, 'rb') as f:
+                data = f.read()
+            record = add_snapshot(self.archive, data, self.main,
+                                  subsystem, start)
+            size = record['block_size']
+            blocks = (len(data) + size - 1) // size
+            print("Snapshot %s %06x %s: %u of %u blocks changed" % (
+                subsystem, start, record['hash'][:12],
+                len(record['blocks']), blocks), file = sys.stderr)
+            self.event('snapshot', subsystem = subsystem, start = start,
+                       hash = record['hash'], changed = len(record['blocks']),
+                       blocks = blocks)
+
+            os.remove(fn)
+            journal.remove()
+            if os.path.exists(fn + '.verify.json'):
+                os.remove(fn + '.verify.json')
+
+        self.leave_debugger()
+
+    def mem_fn(self, subsystem, start):
+        return os.path.join(self.rom_dir, 'mem-%s-%08x.bin' % (
+            subsystem, start))
+
+    def survey(self, subsystem, start = 0, end = None,
+               block = SURVEY_BLOCK, sample = SURVEY_SAMPLE, dump = True):
+        """Find out which parts of the memory of a subsystem to dump.
+
+        Dump the first sample bytes of each block up to end, by default
+        the end of the address space of the subsystem, which has not
+        been dumped already.  If they are all 0xff the block is taken to be
+        erased, if they are the same as at the start of a block which
+        has been seen before it is taken to be a mirror of that block.
+        Blocks which are unique are then dumped in full if dump is set.
+
+        The map is saved to survey-<subsystem>.json in rom_dir and is
+        used instead of sampling again on the next run.
+        """
+
+        if end is None:
+            end = ADDRESS_SPACE[subsystem]
+
+        os.makedirs(self.rom_dir, exist_ok = True)
+
+        map_fn = os.path.join(self.rom_dir, 'survey-%s.json' % subsystem)
+
+        blocks = {}
         try:
-            time.sleep(5)
+            with open(map_fn) as f:
+                survey = json.load(f)
+            if survey['block'] == block and survey['sample'] == sample:
+                blocks = { int(k, 16) : v
+                           for k, v in survey['blocks'].items() }
+        except (OSError, ValueError, KeyError):
+            pass
+
+        def save():
+            survey = {
+                'subsystem' : subsystem,
+                'block' : block,
+                'sample' : sample,
+                'blocks' : { '%06x' % k : v
+                             for k, v in sorted(blocks.items()) },
+            }
+            tmp_fn = map_fn + '.tmp'
+            with open(tmp_fn, 'w') as f:
+                json.dump(survey, f, indent = 4)
+            os.replace(tmp_fn, map_fn)
+
+        # Index the start of every block of what has already been dumped
+        seen = {}
+        dumped = []
+        for fn in sorted(os.listdir(self.rom_dir)):
+            match = re.match(r'mem-%s-([0-9a-f]{8})\.bin$' % subsystem, fn)
+            if not match:
+                continue
+            base = int(match.group(1), 16)
+            with open(os.path.join(self.rom_dir, fn), 'rb') as f:
+                data = f.read()
+            dumped.append((base, base + len(data)))
+            for offset in range(0, len(data) - sample + 1, block):
+                seen.setdefault(data[offset : offset + sample], base + offset)
+
+        for addr in range(start, end, block):
+            if addr in blocks:
+                continue
+
+            for lo, hi in dumped:
+                if lo <= addr and addr + block <= hi:
+                    blocks[addr] = { 'kind' : 'dumped' }
+                    break
+            else:
+                try:
+                    self.dump_mem(subsystem, addr, sample, retries = 0,
+                                  leave = False, verify = False,
+                                  progress = False)
+                except ValueError:
+                    pass
+                with open(self.mem_fn(subsystem, addr), 'rb') as f:
+                    data = f.read(sample)
+
+                if len(data) < sample:
+                    blocks[addr] = { 'kind' : 'unreadable' }
+                elif data == b'\xff' * sample:
+                    blocks[addr] = { 'kind' : 'erased' }
+                elif seen.get(data, addr) != addr:
+                    blocks[addr] = { 'kind' : 'mirror',
+                                     'of' : '%06x' % seen[data] }
+                else:
+                    seen.setdefault(data, addr)
+                    blocks[addr] = { 'kind' : 'unique' }
+
+            save()
+
+        if dump:
+            for addr, info in sorted(blocks.items()):
+                if info['kind'] == 'unique' and start <= addr < end:
+                    self.dump_mem(subsystem, addr, block, leave = False,
+                                  progress = False)
+                    info['kind'] = 'dumped'
+                    save()
+
+        self.leave_debugger()
+
+        return blocks
+
+    def expect_rows(self, byte_order):
+        """Yield (address, data) for each RM line using pexpect."""
+
+        pat = 'RM +[0-9A-F]+( +[0-9A-F]+)+'
+        r = re.compile(pat)
+        while 1:
+            # pexpect uses re.DOTALL, don't let the match swallow the
+            # following lines, but the escape sequence which ends the
+            # line may come after the CR/LF
+            idx = self.expect([
+                pexpect.TIMEOUT,
+                pat + '\\s[^\033]*\033',
+            ])
+            if idx == 0:
+                return
+            match = r.match(self.spawn.after)
+            parts = match.group().split()
+            addr = int(parts[1], 16)
+            words = [ int(_, 16) for _ in parts[2:] ]
+            yield addr, struct.pack('%s%uH' % (byte_order, len(words)),
+                                    *words)
+
+    def read_raw(self, timeout):
+        """Read whatever the reader has buffered.
+
+        Returns an empty string if nothing arrives within timeout.
+        """
+
+        t0 = time.time()
+        try:
+            return self.reader.read(timeout = timeout)
+        finally:
+            self.expect_time += time.time() - t0
+
+    def raw_rows(self, byte_order):
+        """Yield (address, data) for each RM line.
 
-            for b in TEST_BAUDRATES:
+        pexpect is far too slow to keep up with a dump at 38400 bps so
+        take the data straight from the reader and decode the lines
+        with RMDecoder.  Anything pexpect has buffered is decoded first and
+        whatever follows the last line is handed back to pexpect.
+        """
+
+        decoder = RMDecoder(byte_order)
+        data = self.spawn.buffer.encode('ASCII', 'replace')
+        self.set_buffer()
+        try:
+            while 1:
+                for row in decoder.feed(data):
+                    yield row
+                data = self.read_raw(self.spawn.timeout)
+                if not data:
+                    return
+                self.write(data.decode('ASCII', 'replace'))
+        finally:
+            self.set_buffer(decoder.tail.decode('ASCII', 'replace'))
+
+    def enable_debugger(self):
+        # The Debugger soft key is highlighted when it is enabled, let
+        # the screen settle to be sure it has been drawn
+        self.wait_quiet()
+        if not self.screen.highlighted(' Debugger '):
+            print("Enabling debugger", file = sys.stderr)
+            self.send('WWWWWO')
+            self.wait_screen(lambda: self.screen.highlighted(' Debugger '),
+                             timeout = 10)
+
+    def enter_test_mode(self):
+        self.status = 'entering test mode'
+        self.sendline('TEST MAN')
+        self.pacer.activity()
+        t0 = time.time()
+
+        # Keys are ignored until the menu has been drawn, so keep
+        # sending T until the menu shows up over the serial port.
+        self.pace('test')
+        b = None
+        while b is None:
+            if time.time() - t0 > 4 * PACE_CONSERVATIVE['test']:
+                raise FriendlyException("Failed to enter test mode")
+
+            for tb in first(TEST_BAUDRATES,
+                            self.session.get('test_baudrate')):
                 if self.debug >= 1:
-                    print("Trying test mode %u bps" % b, file = sys.stderr)
+                    print("Trying test mode %u bps" % tb, file = sys.stderr)
 
-                self.set_baudrate(b)
+                self.set_baudrate(tb)
                 self.send('T')
-                self.expect('SUBSYSTEM')
+                try:
+                    self.expect('SUBSYSTEM', timeout = 1)
+                except pexpect.exceptions.TIMEOUT:
+                    continue
+
                 if self.debug >= 2:
                     print("Seen \"SUBSYSTEM\"", file = sys.stderr)
 
+                b = tb
                 self.test_baudrate = b
-
                 break
 
-            global screen_dirty
-            screen_dirty = True
+        # Remember how long it took, with some margin
+        self.pacer.delays['test'] = max(PACE_INITIAL['test'],
+                                        time.time() - t0 - 1)
 
-            self.expect('EXTENDED DIAGNOSTICS', save = True)
-            if self.debug >= 2:
-                print("Seen \"EXTENDED DIAGNOSTICS\"", file = sys.stderr)
+        # Forget about the last time in test mode
+        self.save_session(menu = 'test', test_baudrate = b, baudrate = b)
+
+        global screen_dirty
+        screen_dirty = True
+
+        self.expect('EXTENDED DIAGNOSTICS')
+        if self.debug >= 2:
+            print("Seen \"EXTENDED DIAGNOSTICS\"", file = sys.stderr)
 
-            self.expect(HOME_PAT)
+        self.expect(HOME_PAT)
+        if self.debug >= 2:
+            print("Seen HOME_PAT", file = sys.stderr)
+
+        print("Baudrate %u bps" % b, file = sys.stderr)
+
+        if b != TEST_BAUDRATE:
+            print("Switching to TEST_BAUDRATE bps\n", file = sys.stderr)
+            self.wait_quiet()
+            self.sendline('B%u' % TEST_BAUDRATE)
+            self.sleep(0.1)
+            self.set_baudrate(TEST_BAUDRATE)
+            self.test_baudrate = TEST_BAUDRATE
+            self.save_session(baudrate = TEST_BAUDRATE)
+            self.send('TT')
+            self.expect('EXTENDED DIAGNOSTICS')
             if self.debug >= 2:
-                print("Seen HOME_PAT", file = sys.stderr)
+                print("Seen EXTENDED DIAGNOSTICS", file = sys.stderr)
 
-            print("Baudrate %u bps" % b, file = sys.stderr)
+    def left(self, subsystem, start, count, filenames):
+        """Estimate how many bytes of a region are left to dump"""
 
-            if b != TEST_BAUDRATE:
-                print("Switching to TEST_BAUDRATE bps\n", file = sys.stderr)
-                self.sendline('B%u' % TEST_BAUDRATE)
-                time.sleep(0.1)
-                self.set_baudrate(TEST_BAUDRATE)
-                self.send('TT')
-                self.expect('EXTENDED DIAGNOSTICS', save = True)
-                if self.debug >= 2:
-                    print("Seen EXTENDED DIAGNOSTICS", file = sys.stderr)
+        paths = [ os.path.join(self.rom_dir, _) for _ in filenames ]
+        if paths and all(os.path.exists(_) and
+                         os.path.getsize(_) >= count // len(paths)
+                         for _ in paths):
+            return 0
+        try:
+            return max(count - os.path.getsize(
+                self.mem_fn(subsystem, start)), 0)
+        except OSError:
+            return count
+
+    def run_plan(self, items):
+        """Do the items of a dump plan.
 
+        The items are ordered by the scheduler and only the items
+        which are estimated to fit in what is left of the time budget
+        are done.  Returns the items which were skipped.
+        """
+
+        for item in items:
+            if item['kind'] == 'mem':
+                item['left'] = self.left(item['subsystem'], item['start'],
+                                         item['count'], item['files'])
+
+        rate = self.session.get('rate') or DEFAULT_RATE
+        budget = None
+        if self.budget is not None:
+            budget = self.budget - (time.time() - self.t0)
+        order, skipped = fit(schedule(items), rate, budget)
+        self.event('plan', items = len(order), skipped = len(skipped),
+                   estimate = round(sum(estimate(_, rate) for _ in order)))
+
+        last = None
+        modules = []
+        try:
+            for item in order:
+                # Check again with the rate seen so far
+                if self.budget is not None:
+                    t = estimate(item, self.dump_rate() or rate, last)
+                    if time.time() - self.t0 + t > self.budget:
+                        skipped.append(item)
+                        continue
+
+                # Modules are read together when the next item isn't one
+                if item['kind'] == 'module':
+                    modules.append(item['slot'])
+                else:
+                    self.dump_modules(modules)
+                    modules = []
+                    self.dump_mem(item['subsystem'], item['start'],
+                                  item['count'], *item['files'],
+                                  byte_order = item['byte_order'],
+                                  leave = False)
+                last = group(item)
+
+            self.dump_modules(modules)
+
+        finally:
+            self.leave_debugger()
+
+        return skipped
+
+    def run(self):
+        self.t0 = time.time()
+        self.done = 0
+        self.total = 0
+        self.event('start', port = self.ser.port)
+        self.connect()
+        self.event('connected', unit = self.main,
+                   baudrate = self.ser.baudrate)
+
+        self.printer.level(2)
+
+        try:
+            self.enter_test_mode()
             self.enable_debugger()
+            self.event('test_mode', baudrate = self.ser.baudrate)
+
+            plan_fn = self.plan_fn
+            if not plan_fn:
+                try:
+                    plan_fn = find_plan(self.device.split('/')[-1])
+                except ValueError as e:
+                    raise FriendlyException("%s, use --plan to give one" % e)
+            items = load_plan(plan_fn, self.subsystems)
+            print("Using dump plan %s" % plan_fn, file = sys.stderr)
+
+            self.nvram = set((_['subsystem'], _['start'])
+                             for _ in items if _['kind'] == 'mem' and
+                             _['nvram'])
+
+            if self.snapshot:
+                self.total = sum(_['count'] for _ in items
+                                 if _['kind'] == 'mem' and _['nvram'])
+                self.take_snapshots(items)
+                print("Success")
+                self.status = 'done'
+                self.event('done')
+                return
+
+            dumps = [ (_['subsystem'], _['start'], _['count'], _['files'],
+                       _['byte_order'])
+                      for _ in items if _['kind'] == 'mem' ]
+
+            self.total = sum(_[2] for _ in dumps)
+
+            # Images from other units with the same firmware can be
+            # used if they pass the ROM checksum tests
+            restored = []
+            if self.archive:
+                restored = self.restore_images(dumps)
+
+            if self.verify or restored:
+                verified = self.verify_dumps(dumps if self.verify else restored)
+                self.event('verified', regions = len(verified),
+                           restored = len(restored))
+                for subsystem, start, count, filenames, byte_order in restored:
+                    if (subsystem, start, count, filenames, byte_order) not in verified:
+                        self.remove_dump(subsystem, start, filenames)
+
+            skipped = self.run_plan(items)
+
+            rate = self.dump_rate()
+            if rate:
+                self.save_session(rate = round(rate, 1))
+
+            if skipped:
+                print("Out of time, run again to do the rest:",
+                      file = sys.stderr)
+                for item in skipped:
+                    print("    %s" % describe(item), file = sys.stderr)
+                self.status = 'incomplete'
+                self.event('incomplete', skipped = len(skipped))
+                return
 
-            if 1:
-                # Should be present on all models
-                if 'ACQM1' in self.subsystems:
-                    self.dump_module(1)
-                    self.dump_module(2)
-
-                # Only present on 11810, not on CSA803 and propbly not on 11802
-                if 'ACQM2' in self.subsystems:
-                    self.dump_module(3)
-                    self.dump_module(4)
-
-            if 0:
-                # Dump the first bit of each 64k section to see if we
-                # can find anything interesting
-                for i in range(0x100):
-                    self.dump_mem('a', i * 0x10000, 0x100)
-
-            ver = sanitize_fn(self.subsystems.get('ACQM1') or self.subsystems.get('ACQM2') or 'unknown')
-            self.dump_mem('d', 0x8000, 0x8000, 'A28-U611-ACQ-%s-UPPER.bin' % ver, byte_order = '>')
-
-            ver = sanitize_fn(self.subsystems.get('DSY') or 'unknown')
-            self.dump_mem('b', 0xe0000, 0x20000, 'A15-U140-DSY-%s.bin' % ver, 'A15_U150_DSY_%s.bin' % ver)
-
-            ver = sanitize_fn(self.subsystems.get('TBC') or 'unknown')
-            self.dump_mem('c', 0xc0000, 0x20000, 'A5-U300-TBC-%s.bin' % ver, 'A5-U400-TBC-%s.bin' % ver)
-            self.dump_mem('c', 0xe0000, 0x20000, 'A5-U310-TBC-%s.bin' % ver, 'A5-U410-TBC-%s.bin' % ver)
-            self.dump_mem('c', 0x10000, 0x10000, 'A5-U500-TBC-%s.bin' % ver, 'A5-U511-TBC-%s.bin' % ver)
-
-            ver = sanitize_fn(self.subsystems.get('EXP') or 'unknown')
-            self.dump_mem('a', 0xfc0000, 0x00040000, 'A18-U800-EXP-%s.bin' % ver, 'A18-U900-EXP-%s.bin' % ver)
-            self.dump_mem('a', 0xf80000, 0x00040000, 'A18-U810-EXP-%s.bin' % ver, 'A18-U910-EXP-%s.bin' % ver)
-            self.dump_mem('a', 0xf40000, 0x00040000, 'A18-U820-EXP-%s.bin' % ver, 'A18-U920-EXP-%s.bin' % ver)
-            self.dump_mem('a', 0xf00000, 0x00040000, 'A18-U830-EXP-%s.bin' % ver, 'A18-U930-EXP-%s.bin' % ver)
-            self.dump_mem('a', 0x3e0000, 0x00020000, 'A18-NVRAM-EXP-%s.bin' % ver)
-
-            # self.dump_mem('a', 0x400000, 0x10000)
-            # self.dump_mem('a', 0x410000, 0x10000)
-            # self.dump_mem('a', 0x420000, 0x10000)
-            # self.dump_mem('a', 0x430000, 0x10000)
+            # Look for anything interesting outside the known regions
+            for subsystem in self.survey_subsystems:
+                self.event('survey', subsystem = subsystem)
+                self.survey(subsystem)
 
             print("Success")
+            self.status = 'done'
+            self.event('done')
+
+        except Exception as e:
+            self.event('failed', error = str(e) or e.__class__.__name__)
+            raise
 
         finally:
-            time.sleep(1)
+            self.pace()
             self.exit_test_mode()
-            pass
 
 def main():
-    device = sys.argv[1]
+    parser = OptionParser(usage = "%prog [options] device")
+    parser.add_option('-l', '--log', dest = 'log', default = 'log',
+                      help = "write a log of the session to FILE, "
+                      "compressed if it ends with .gz (default log)",
+                      metavar = "FILE")
+    parser.add_option('--log-rotate', dest = 'log_rotate', type = 'int',
+                      default = 0,
+                      help = "rotate the log when it reaches SIZE bytes",
+                      metavar = "SIZE")
+
+    parser.add_option('--checkpoint', dest = 'checkpoint', type = 'float',
+                      default = CHECKPOINT_INTERVAL,
+                      help = "commit dumped memory to disk every SECONDS "
+                      "(default %.0f)" % CHECKPOINT_INTERVAL,
+                      metavar = "SECONDS")
+
+    parser.add_option('--events', dest = 'events',
+                      help = "append telemetry events as JSON lines to FILE",
+                      metavar = "FILE")
+    parser.add_option('--progress', dest = 'progress', type = 'float',
+                      default = PROGRESS_INTERVAL,
+                      help = "show progress and ETA every SECONDS while "
+                      "dumping, 0 to turn it off (default %.0f)" %
+                      PROGRESS_INTERVAL,
+                      metavar = "SECONDS")
+
+    parser.add_option('--capture', dest = 'capture',
+                      help = "write everything received and sent to FILE "
+                      "so that it can be replayed with replay.py, "
+                      "compressed if it ends with .gz",
+                      metavar = "FILE")
+
+    parser.add_option('--plan', dest = 'plan',
+                      help = "use the dump plan in FILE instead of the one "
+                      "for the model",
+                      metavar = "FILE")
+    parser.add_option('--budget', dest = 'budget', type = 'float',
+                      help = "stop starting new work after MINUTES, "
+                      "cheap and important things are done first",
+                      metavar = "MINUTES")
+
+    parser.add_option('--survey', dest = 'survey', action = 'append',
+                      default = [],
+                      help = "survey the whole memory of SUBSYSTEM (a-d) "
+                      "and dump anything which is not erased or a mirror",
+                      metavar = "SUBSYSTEM")
+
+    parser.add_option('--verify', dest = 'verify', action = 'store_true',
+                      help = "experimental, verify existing EPROM images "
+                      "with the ROM checksum tests and only dump them "
+                      "again if they don't match, how the checksum is "
+                      "calculated is a guess")
+
+    parser.add_option('--snapshot', dest = 'snapshot', action = 'store_true',
+                      help = "only read the NVRAM and archive the blocks "
+                      "which changed since the last snapshot")
+    parser.add_option('--snapshot-every', dest = 'snapshot_every',
+                      type = 'float',
+                      help = "take a snapshot every MINUTES until "
+                      "interrupted, implies --snapshot",
+                      metavar = "MINUTES")
+
+    parser.add_option('--verify-sample', dest = 'verify_sample',
+                      type = 'float', default = VERIFY_SAMPLE,
+                      help = "read FRACTION of the rows of each dump again "
+                      "and repair what doesn't match, 0 to turn it off "
+                      "(default %g)" % VERIFY_SAMPLE,
+                      metavar = "FRACTION")
+
+    parser.add_option('--archive', dest = 'archive', default = 'ARCHIVE',
+                      help = "archive module images in DIR, "
+                      "empty to disable (default ARCHIVE)",
+                      metavar = "DIR")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("expected exactly one serial device")
+
+    device = args[0]
+
+    if options.snapshot_every is not None:
+        options.snapshot = True
+    if options.snapshot and not options.archive:
+        parser.error("snapshots are kept in the archive")
+
+    capture = None
+    if options.capture:
+        capture = Capture(options.capture, port = device,
+                          sessions = load_sessions(),
+                          options = dict(checkpoint = options.checkpoint,
+                                         plan = options.plan and
+                                         os.path.abspath(options.plan),
+                                         budget = options.budget,
+                                         survey = options.survey,
+                                         verify = options.verify,
+                                         verify_sample =
+                                         options.verify_sample,
+                                         snapshot = options.snapshot,
+                                         snapshot_every =
+                                         options.snapshot_every))
 
     with serial.Serial(device, timeout = 0) as ser:
+        printer = Printer(options.log, rotate = options.log_rotate)
+        tek = None
         try:
-            tek = Tek(ser)
-            tek.run()
+            tek = Tek(ser, printer, SerialReader(ser, capture = capture))
+            tek.checkpoint_interval = options.checkpoint
+            tek.telemetry = Telemetry(options.events)
+            if options.progress > 0:
+                tek.progress_interval = options.progress
+            else:
+                tek.show_progress = False
+            tek.survey_subsystems = options.survey
+            tek.verify = options.verify
+            tek.verify_sample = options.verify_sample
+            tek.plan_fn = options.plan
+            if options.budget is not None:
+                tek.budget = options.budget * 60
+            tek.archive = Archive(options.archive) if options.archive else None
+            tek.snapshot = options.snapshot
+            while 1:
+                tek.run()
+                if options.snapshot_every is None:
+                    break
+                time.sleep(options.snapshot_every * 60)
 
         except FriendlyException as e:
             screen_cleanup()
@@ -555,6 +2427,11 @@ def main():
 
         finally:
             screen_cleanup()
+            if tek:
+                tek.close()
+            printer.close()
+            if capture:
+                capture.close()
 
 if __name__ == '__main__':
     # Test for when run from within emacs
@@ -0,0 +1,244 @@
+#! /usr/bin/python3
+"""Benchmark backup.py against the simulated instrument in teksim.py.
+
+The simulator is started as a separate process on a pseudo terminal
+and the Tek class from backup.py is used to connect to it, read the
+sampling head EEPROMs and dump the start of every memory region.  For
+each step the wall time, the payload rate and how much of the time was
+spent in sleeps and waiting for the instrument is reported.  Dumped
+data is compared with the memory of the simulator.
+
+To measure the whole thing end to end use --full which calls
+Tek.run() just like backup.py does.  Add --verify to run it once more
+with --verify, and --checksum crc to make the ROM Checksum tests of
+the simulator disagree with how romtool.py calculates them.
+"""
+
+import sys
+import os
+import time
+import shutil
+import tempfile
+import subprocess
+import serial
+from optparse import OptionParser
+
+import backup
+import teksim
+from archive import Archive
+
+# The regions dumped by Tek.run()
+REGIONS = [
+    ('d', 0x8000, 0x8000, '>'),
+    ('b', 0xe0000, 0x20000, '<'),
+    ('c', 0xc0000, 0x20000, '<'),
+    ('c', 0xe0000, 0x20000, '<'),
+    ('c', 0x10000, 0x10000, '<'),
+    ('a', 0xfc0000, 0x40000, '<'),
+    ('a', 0xf80000, 0x40000, '<'),
+    ('a', 0xf40000, 0x40000, '<'),
+    ('a', 0xf00000, 0x40000, '<'),
+    ('a', 0x3e0000, 0x20000, '<'),
+]
+
+def start_simulator(options):
+    args = [ sys.executable,
+             os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'teksim.py'),
+             '-m', options.model,
+             '-s', str(options.time_scale),
+             '--test-baudrate', str(options.test_baudrate),
+             '--digit-gap', str(options.digit_gap),
+             '--settle', str(options.settle),
+             '--line-loss', str(options.line_loss),
+             '--stall', str(options.stall),
+             '--corrupt', str(options.corrupt),
+             '--checksum', options.checksum ]
+    sim = subprocess.Popen(args, stdout = subprocess.PIPE,
+                           universal_newlines = True)
+    name = sim.stdout.readline().strip()
+    return sim, name
+
+class Timer():
+    def __init__(self, tek, desc, payload = 0):
+        self.tek = tek
+        self.desc = desc
+        self.payload = payload
+
+    def __enter__(self):
+        self.t0 = time.time()
+        self.sleep0 = self.tek.sleep_time
+        self.expect0 = self.tek.expect_time
+        return self
+
+    def __exit__(self, *args):
+        wall = time.time() - self.t0
+        sleep = self.tek.sleep_time - self.sleep0
+        wait = self.tek.expect_time - self.expect0
+        rate = ''
+        if self.payload:
+            rate = '%8.0f B/s' % (self.payload / wall)
+        print("%-24s %8.2f s  sleep %7.2f s  wait %7.2f s  %s" % (
+            self.desc, wall, sleep, wait, rate))
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-m', '--model', dest = 'model', default = '11801B',
+                      help = "model to simulate")
+    parser.add_option('-s', '--time-scale', dest = 'time_scale',
+                      type = 'float', default = 1.0,
+                      help = "time scale for the simulator, 0 for no delays",
+                      metavar = "SCALE")
+    parser.add_option('--size', dest = 'size', type = 'int', default = 0x400,
+                      help = "number of bytes to dump from each region")
+    parser.add_option('--test-baudrate', dest = 'test_baudrate',
+                      type = 'int', default = 9600,
+                      help = "initial test mode baudrate of the simulator")
+    parser.add_option('--digit-gap', dest = 'digit_gap',
+                      type = 'float', default = 0.0,
+                      help = "make the simulator drop fast hex digits")
+    parser.add_option('--settle', dest = 'settle',
+                      type = 'float', default = 0.0,
+                      help = "make the simulator drop keys sent too early")
+    parser.add_option('--line-loss', dest = 'line_loss',
+                      type = 'float', default = 0.0,
+                      help = "make the simulator lose dumped lines")
+    parser.add_option('--stall', dest = 'stall',
+                      type = 'float', default = 0.0,
+                      help = "make the simulator stop dumps early")
+    parser.add_option('--corrupt', dest = 'corrupt',
+                      type = 'float', default = 0.0,
+                      help = "make the simulator change digits in dumps")
+    parser.add_option('--checksum', dest = 'checksum', default = 'sum',
+                      help = "how the simulator calculates ROM checksums, "
+                      "sum or crc")
+    parser.add_option('--verify-sample', dest = 'verify_sample',
+                      type = 'float', default = backup.VERIFY_SAMPLE,
+                      help = "read this fraction of each dump again")
+    parser.add_option('--no-modules', dest = 'modules', default = True,
+                      action = 'store_false',
+                      help = "do not read the sampling head EEPROMs")
+    parser.add_option('--pexpect-dump', dest = 'raw_dump', default = True,
+                      action = 'store_false',
+                      help = "decode memory dumps with pexpect")
+    parser.add_option('--survey', dest = 'survey', action = 'append',
+                      default = [],
+                      help = "survey the memory of SUBSYSTEM",
+                      metavar = "SUBSYSTEM")
+    parser.add_option('--full', dest = 'full', action = 'store_true',
+                      help = "run a full backup with Tek.run()")
+    parser.add_option('--verify', dest = 'verify', action = 'store_true',
+                      help = "with --full, run Tek.run() again with "
+                      "--verify afterwards")
+    parser.add_option('-k', '--keep', dest = 'keep', action = 'store_true',
+                      help = "keep the output directory")
+
+    (options, args) = parser.parse_args()
+
+    sim, name = start_simulator(options)
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp(prefix = 'tekbench-')
+    os.chdir(tmp_dir)
+
+    errors = 0
+
+    try:
+        with serial.Serial(name, timeout = 0) as ser:
+            tek = backup.Tek(ser)
+            tek.archive = Archive()
+            tek.debug = 0
+            tek.raw_dump = options.raw_dump
+            tek.verify_sample = options.verify_sample
+            tek.printer.level(1000)
+
+            t0 = time.time()
+
+            if options.full:
+                with Timer(tek, 'run'):
+                    tek.run()
+                if options.verify:
+                    tek.verify = True
+                    with Timer(tek, 'verify'):
+                        tek.run()
+
+            else:
+                with Timer(tek, 'connect'):
+                    tek.connect()
+
+                try:
+                    with Timer(tek, 'enter test mode'):
+                        tek.enter_test_mode()
+                        tek.enable_debugger()
+
+                    if options.modules:
+                        units = []
+                        if 'ACQM1' in tek.subsystems:
+                            units += [ 1, 2 ]
+                        if 'ACQM2' in tek.subsystems:
+                            units += [ 3, 4 ]
+                        with Timer(tek, 'modules %s' % ','.join(
+                                map(str, units)), 128 * len(units)):
+                            tek.dump_modules(units)
+
+                    memories = teksim.make_memories(
+                        teksim.MODELS[options.model][1], options.checksum)
+                    for subsystem, start, count, byte_order in REGIONS:
+                        count = min(count, options.size)
+                        with Timer(tek, 'mem %s %06x' % (subsystem, start),
+                                   count):
+                            tek.dump_mem(subsystem, start, count,
+                                         byte_order = byte_order,
+                                         leave = False)
+
+                        fn = os.path.join(tek.rom_dir, 'mem-%s-%08x.bin' % (
+                            subsystem, start))
+                        with open(fn, 'rb') as f:
+                            data = f.read()
+                        if data != memories[subsystem].read(start, count):
+                            print("error: %s does not match" % fn)
+                            errors += 1
+
+                    tek.leave_debugger()
+
+                    for subsystem in options.survey:
+                        with Timer(tek, 'survey %s' % subsystem):
+                            blocks = tek.survey(subsystem, dump = False)
+                        kinds = {}
+                        for info in blocks.values():
+                            kinds[info['kind']] = kinds.get(info['kind'], 0) + 1
+                        print("survey %s: %s" % (subsystem, ', '.join(
+                            '%u %s' % (n, k) for k, n in sorted(kinds.items()))))
+
+                finally:
+                    tek.exit_test_mode()
+
+            print("%-24s %8.2f s  sleep %7.2f s  wait %7.2f s" % (
+                'total', time.time() - t0, tek.sleep_time, tek.expect_time))
+            print("pacing %s, %u keys dropped" % (
+                ', '.join('%s %.2f s' % _ for _ in
+                          sorted(tek.pacer.delays.items())),
+                tek.pacer.drops))
+            print("%u lost address syncs, %u timeouts, %u resyncs, "
+                  "%u rows repaired" % (
+                      tek.sync_losses, tek.dump_timeouts, tek.resyncs,
+                      tek.repairs))
+            print("reader %u bytes, %u overrun, %u buffered at most" % (
+                tek.reader.received, tek.reader.overruns,
+                tek.reader.high_water))
+
+            tek.close()
+
+    finally:
+        os.chdir(cwd)
+        sim.terminate()
+        sim.wait()
+        if options.keep:
+            print("output kept in %s" % tmp_dir)
+        else:
+            shutil.rmtree(tmp_dir)
+
+    if errors:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#! /usr/bin/python3
+"""Raw capture of a session with an instrument.
+
+The log written by backup.py is the screen split into lines, which is
+fine for reading but not good enough to find out why the parsing went
+wrong.  A capture has every byte received from the serial port with
+the time it arrived, the keys which were sent and the times the input
+buffer was cleared.  replay.py feeds a capture through the Tek class
+again without the instrument.
+
+A capture starts with a magic line and a line of JSON with the port,
+the session cache and the options of the backup.  After that there is
+one record for each thing that happened, the time in seconds since
+the start, a kind and the data:
+
+    r  bytes received
+    s  bytes sent
+    c  input buffer cleared
+
+If the file name ends with ".gz" the capture is compressed.
+"""
+
+import gzip
+import json
+import struct
+import threading
+import time
+
+MAGIC = b'TEKCAP 1\n'
+
+RECORD = struct.Struct('<dcI')
+
+class Capture():
+    def __init__(self, fn, **header):
+        self.fn = fn
+        self.t0 = time.time()
+        self.lock = threading.Lock()
+
+        if fn.endswith('.gz'):
+            self.f = gzip.open(fn, 'wb', compresslevel = 6)
+        else:
+            self.f = open(fn, 'wb')
+
+        header['time'] = self.t0
+        self.f.write(MAGIC)
+        self.f.write(json.dumps(header, sort_keys = True).encode('ASCII'))
+        self.f.write(b'\n')
+
+    def record(self, kind, data = b''):
+        with self.lock:
+            if self.f is None:
+                return
+            self.f.write(RECORD.pack(time.time() - self.t0, kind, len(data)))
+            self.f.write(data)
+
+    def received(self, data):
+        self.record(b'r', data)
+
+    def sent(self, data):
+        self.record(b's', data)
+
+    def cleared(self):
+        self.record(b'c')
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+def load_capture(fn):
+    """Load a capture.
+
+    Returns the header and a list of (time, kind, data) records.  A
+    partial record at the end of an interrupted capture is ignored.
+    """
+
+    if fn.endswith('.gz'):
+        f = gzip.open(fn, 'rb')
+    else:
+        f = open(fn, 'rb')
+
+    with f:
+        if f.readline() != MAGIC:
+            raise ValueError("%s: not a capture" % fn)
+        header = json.loads(f.readline().decode('ASCII'))
+
+        records = []
+        try:
+            while 1:
+                h = f.read(RECORD.size)
+                if len(h) < RECORD.size:
+                    break
+                t, kind, n = RECORD.unpack(h)
+                data = f.read(n)
+                if len(data) < n:
+                    break
+                records.append((t, kind.decode('ASCII'), data))
+        except EOFError:
+            # A compressed capture which was never closed
+            pass
+
+    return header, records
@@ -0,0 +1,250 @@
+#! /usr/bin/python3
+"""Dump plans for each model and a scheduler for them.
+
+A plan is a JSON file in plans/ named after the model as shown by ID?,
+with a list of items to read from the instrument.  Each item is either
+a sampling head EEPROM:
+
+    {"kind": "module", "slot": 1, "requires": "ACQM1", "priority": 1}
+
+or a region of memory which is dumped and split into files:
+
+    {"kind": "mem", "subsystem": "c", "start": "0xc0000",
+     "count": "0x20000", "files": ["A5-U300-TBC-{TBC}.bin", ...],
+     "byte_order": "<", "priority": 2}
+
+Regions with "nvram": true hold calibration constants and settings
+which are different in every unit, they are not put in the firmware
+archive and are what backup.py --snapshot reads.
+
+Items with a "requires" are skipped unless ID? lists that subsystem.
+{EXP}, {DSY}, {TBC} and {ACQ} in file names are replaced with the
+firmware version of the subsystem.  Items with a lower priority are
+done first.
+
+    ./dumpplan.py 11801B
+"""
+
+import os
+import re
+import json
+from optparse import OptionParser
+
+PLAN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'plans')
+
+# Models which use the plan of another model.  The revisions of the
+# 11801 with a letter are all the same, the original 11801 is quite
+# different and has no plan
+PLAN_ALIASES = {
+    '11801A' : '11801B',
+    '11801C' : '11801B',
+}
+
+# Rough cost in seconds of menu navigation, reading a module EEPROM
+# once the exerciser is running, switching the debugger to another
+# subsystem and setting up a region
+MODULE_COST = 10
+SWITCH_COST = 15
+REGION_COST = 10
+
+# Payload bytes per second until the rate of an instrument has been
+# measured, a full backup of about 1.6 MB takes around 12 hours
+DEFAULT_RATE = 40
+
+def plan_fn(model):
+    return os.path.join(PLAN_DIR, '%s.json' % model)
+
+def find_plan(model):
+    """File name of the plan for a model.
+
+    Uses the plan in PLAN_ALIASES or falls back to the plan for the
+    model without a trailing revision letter, 11802B uses the 11802
+    plan.  Raises ValueError if there is no plan, rather than guess.
+    """
+
+    for name in [ model, PLAN_ALIASES.get(model),
+                  re.sub('[A-Z]+$', '', model) ]:
+        if name and os.path.exists(plan_fn(name)):
+            return plan_fn(name)
+    raise ValueError("no dump plan for %s" % model)
+
+def load_plan(fn, subsystems):
+    """Load a plan and fill it in for the subsystems from ID?.
+
+    Returns a list of items with the numbers parsed and the versions
+    filled in to the file names.
+    """
+
+    with open(fn) as f:
+        plan = json.load(f)
+
+    versions = {
+        'EXP' : subsystems.get('EXP'),
+        'DSY' : subsystems.get('DSY'),
+        'TBC' : subsystems.get('TBC'),
+        'ACQ' : subsystems.get('ACQM1') or subsystems.get('ACQM2'),
+    }
+    versions = { k : re.sub('[^-_A-Za-z0-9]', '_', v or 'unknown')
+                 for k, v in versions.items() }
+
+    items = []
+    for item in plan['items']:
+        item = dict(item)
+        if item.get('requires') and item['requires'] not in subsystems:
+            continue
+        item.setdefault('priority', 1)
+        if item['kind'] == 'mem':
+            item['start'] = int(item['start'], 0)
+            item['count'] = int(item['count'], 0)
+            item['files'] = [ _.format(**versions) for _ in item['files'] ]
+            item.setdefault('byte_order', '<')
+            item.setdefault('nvram', False)
+        elif item['kind'] != 'module':
+            raise ValueError("%s: unknown kind of item %s" % (
+                fn, repr(item['kind'])))
+        items.append(item)
+
+    return items
+
+def find_region(filenames):
+    """Find the region which is split into these files in any plan.
+
+    The versions in the file names can be anything.  Returns the
+    address of the region or None.
+    """
+
+    names = [ os.path.basename(_) for _ in filenames ]
+    for fn in sorted(os.listdir(PLAN_DIR)):
+        if not fn.endswith('.json'):
+            continue
+        with open(os.path.join(PLAN_DIR, fn)) as f:
+            plan = json.load(f)
+        for item in plan['items']:
+            if item['kind'] != 'mem' or len(item['files']) != len(names):
+                continue
+            patterns = [ '[-_A-Za-z0-9]+'.join(
+                re.escape(_) for _ in re.split(r'\{\w+\}', pattern))
+                         for pattern in item['files'] ]
+            if all(re.fullmatch(p, n) for p, n in zip(patterns, names)):
+                return int(item['start'], 0)
+    return None
+
+def group(item):
+    """Items in the same group can be done without changing menus"""
+
+    if item['kind'] == 'module':
+        return 'module'
+    return item['subsystem']
+
+def schedule(items, current = None):
+    """Order items to do as few menu changes as possible.
+
+    Items are taken in order of priority.  Within a priority all items
+    in the same group as the last item are done before moving on to
+    the next group, in the order the plan lists the groups.  Regions
+    are done in order of address.
+    """
+
+    order = []
+    for priority in sorted(set(_['priority'] for _ in items)):
+        todo = [ _ for _ in items if _['priority'] == priority ]
+        while todo:
+            same = [ _ for _ in todo if group(_) == current ]
+            if not same:
+                current = group(todo[0])
+                same = [ _ for _ in todo if group(_) == current ]
+            same.sort(key = lambda _: _.get('start', _.get('slot')))
+            order += same
+            todo = [ _ for _ in todo if group(_) != current ]
+    return order
+
+def estimate(item, rate, last = None):
+    """Seconds to do an item, rate is the payload bytes per second.
+
+    If the item has a "left" it is the number of bytes which are left
+    to dump, an item with nothing left costs nothing.
+    """
+
+    if item.get('left') == 0:
+        return 0
+    t = 0
+    if group(item) != last:
+        t += SWITCH_COST
+    if item['kind'] == 'module':
+        return t + MODULE_COST
+    return t + REGION_COST + item.get('left', item['count']) / rate
+
+def fit(order, rate, budget):
+    """Take the items which fit within budget seconds.
+
+    Items which don't fit are skipped, but a later cheaper item is
+    still taken if it fits.  Returns the items to do and the ones
+    which were skipped.
+    """
+
+    selected = []
+    skipped = []
+    t = 0
+    last = None
+    for item in order:
+        cost = estimate(item, rate, last)
+        if budget is not None and t + cost > budget:
+            skipped.append(item)
+            continue
+        selected.append(item)
+        if cost:
+            t += cost
+            last = group(item)
+    return selected, skipped
+
+def describe(item):
+    if item['kind'] == 'module':
+        return 'module %u' % item['slot']
+    return 'mem %s %06x %s' % (item['subsystem'], item['start'],
+                               ', '.join(item['files']))
+
+def main():
+    parser = OptionParser(usage = "%prog [options] MODEL")
+    parser.add_option('-r', '--rate', dest = 'rate', type = 'float',
+                      default = DEFAULT_RATE,
+                      help = "estimate times for RATE bytes per second "
+                      "(default %u)" % DEFAULT_RATE,
+                      metavar = "RATE")
+    parser.add_option('--budget', dest = 'budget', type = 'float',
+                      help = "only take what fits in MINUTES",
+                      metavar = "MINUTES")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("expected a model")
+
+    model = args[0]
+    try:
+        fn = find_plan(model)
+    except ValueError as e:
+        parser.error(str(e))
+    print("%s: %s" % (model, fn))
+
+    # Pretend that the instrument has everything
+    subsystems = dict((_, 'x.xx') for _ in
+                      [ 'EXP', 'DSY', 'TBC', 'ACQM1', 'ACQM2' ])
+    items = load_plan(fn, subsystems)
+
+    rate = options.rate
+    budget = options.budget * 60 if options.budget is not None else None
+    selected, skipped = fit(schedule(items), rate, budget)
+
+    last = None
+    total = 0
+    for item in selected:
+        t = estimate(item, rate, last)
+        total += t
+        last = group(item)
+        print("%8.0f s  %s" % (t, describe(item)))
+    for item in skipped:
+        print("skipped    %s" % describe(item))
+    print("%8.0f s  total" % total)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+#! /usr/bin/python3
+"""Back up several instruments at the same time.
+
+Each serial port gets its own thread running Tek.run() just like
+backup.py does, with the same plan, archive, verify and snapshot
+options for all of them.  The screen and messages from each instrument go to a
+log in its ROM directory instead of the terminal, and the progress of
+the whole fleet is shown instead.
+
+The ports can be given on the command line or in a manifest file with
+one port per line.  Empty lines and lines starting with # are ignored.
+"""
+
+import sys
+import os
+import time
+import threading
+import traceback
+import serial
+from optparse import OptionParser
+
+import backup
+from archive import Archive
+
+class Output():
+    """Send what a thread prints to the log of its instrument.
+
+    Output from threads without a log goes to the original stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.printers = {}
+
+    def write(self, s):
+        printer = self.printers.get(threading.get_ident())
+        if printer:
+            printer.message(s)
+        else:
+            self.stream.write(s)
+
+    def flush(self):
+        self.stream.flush()
+
+class FleetTek(backup.Tek):
+    def connect(self):
+        super().connect()
+
+        # Now that we know which instrument it is, move the log and
+        # the events to the directory with its ROMs
+        os.makedirs(self.rom_dir, exist_ok = True)
+        self.printer.move(os.path.join(
+            self.rom_dir, os.path.basename(self.printer.fn)))
+        if self.telemetry.fn:
+            self.telemetry.move(os.path.join(
+                self.rom_dir, os.path.basename(self.telemetry.fn)))
+
+class Worker(threading.Thread):
+    def __init__(self, device, options, outputs):
+        super().__init__(daemon = True)
+        self.device = device
+        self.options = options
+        self.outputs = outputs
+        self.tek = None
+        self.error = None
+
+    def run(self):
+        options = self.options
+        fn = 'log-%s' % backup.sanitize_fn(os.path.basename(self.device))
+        if options.compress:
+            fn += '.gz'
+        printer = backup.Printer(fn, rotate = options.log_rotate,
+                                 echo = False)
+        for output in self.outputs:
+            output.printers[self.ident] = printer
+
+        try:
+            with serial.Serial(self.device, timeout = 0) as ser:
+                # The reader has to be stopped before the port is closed
+                try:
+                    self.tek = FleetTek(ser, printer)
+                    self.tek.checkpoint_interval = options.checkpoint
+                    if options.events:
+                        self.tek.telemetry = backup.Telemetry(
+                            'events-%s.jsonl' % backup.sanitize_fn(
+                                os.path.basename(self.device)))
+                    self.tek.verify = options.verify
+                    self.tek.verify_sample = options.verify_sample
+                    self.tek.plan_fn = options.plan
+                    if options.budget is not None:
+                        self.tek.budget = options.budget * 60
+                    self.tek.archive = (Archive(options.archive)
+                                        if options.archive else None)
+                    self.tek.snapshot = options.snapshot
+                    while 1:
+                        self.tek.run()
+                        if options.snapshot_every is None:
+                            break
+                        time.sleep(options.snapshot_every * 60)
+                finally:
+                    if self.tek:
+                        self.tek.close()
+
+        except Exception as e:
+            traceback.print_exc()
+            self.error = str(e) or e.__class__.__name__
+
+        finally:
+            printer.close()
+            for output in self.outputs:
+                del output.printers[self.ident]
+
+    def status(self):
+        if self.error:
+            return 'failed: %s' % self.error
+        if self.tek:
+            return self.tek.status
+        return 'starting'
+
+def read_manifest(fn):
+    devices = []
+    with open(fn) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                devices.append(line)
+    return devices
+
+def show_progress(workers, t0, stream):
+    done = 0
+    total = 0
+    for worker in workers:
+        tek = worker.tek
+        line = '%-32s %-24s' % (worker.device, worker.status())
+        if tek and tek.total:
+            line += ' %5.1f%% ETA %s' % (100.0 * tek.done / tek.total,
+                                         backup.format_eta(tek.eta()))
+            done += tek.done
+            total += tek.total
+        print(line, file = stream)
+
+    elapsed = time.time() - t0
+    finished = len([ _ for _ in workers if not _.is_alive() ])
+    line = '%u/%u finished, %u/%u bytes' % (
+        finished, len(workers), done, total)
+    if done and total:
+        rate = done / elapsed
+        line += ', %.0f B/s, %.0f minutes left' % (
+            rate, (total - done) / rate / 60)
+    print(line + '\n', file = stream, flush = True)
+
+def main():
+    parser = OptionParser(usage = "%prog [options] device...")
+    parser.add_option('-f', '--manifest', dest = 'manifest',
+                      help = "read serial devices from FILE",
+                      metavar = "FILE")
+    parser.add_option('-z', '--compress', dest = 'compress',
+                      action = 'store_true',
+                      help = "compress the logs")
+    parser.add_option('--log-rotate', dest = 'log_rotate', type = 'int',
+                      default = 0,
+                      help = "rotate the logs when they reach SIZE bytes",
+                      metavar = "SIZE")
+    parser.add_option('--checkpoint', dest = 'checkpoint', type = 'float',
+                      default = backup.CHECKPOINT_INTERVAL,
+                      help = "commit dumped memory to disk every SECONDS",
+                      metavar = "SECONDS")
+    parser.add_option('-e', '--events', dest = 'events',
+                      action = 'store_true',
+                      help = "write telemetry events to each ROM directory")
+    parser.add_option('-i', '--interval', dest = 'interval', type = 'float',
+                      default = 10.0,
+                      help = "show progress every SECONDS (default 10)",
+                      metavar = "SECONDS")
+
+    parser.add_option('--plan', dest = 'plan',
+                      help = "use the dump plan in FILE instead of the one "
+                      "for the model of each instrument",
+                      metavar = "FILE")
+    parser.add_option('--budget', dest = 'budget', type = 'float',
+                      help = "stop starting new work after MINUTES, "
+                      "cheap and important things are done first",
+                      metavar = "MINUTES")
+    parser.add_option('--verify', dest = 'verify', action = 'store_true',
+                      help = "experimental, verify existing EPROM images "
+                      "with the ROM checksum tests and only dump them "
+                      "again if they don't match, how the checksum is "
+                      "calculated is a guess")
+    parser.add_option('--verify-sample', dest = 'verify_sample',
+                      type = 'float', default = backup.VERIFY_SAMPLE,
+                      help = "read FRACTION of the rows of each dump again "
+                      "and repair what doesn't match, 0 to turn it off "
+                      "(default %g)" % backup.VERIFY_SAMPLE,
+                      metavar = "FRACTION")
+    parser.add_option('--snapshot', dest = 'snapshot', action = 'store_true',
+                      help = "only read the NVRAM and archive the blocks "
+                      "which changed since the last snapshot")
+    parser.add_option('--snapshot-every', dest = 'snapshot_every',
+                      type = 'float',
+                      help = "take a snapshot every MINUTES until "
+                      "interrupted, implies --snapshot",
+                      metavar = "MINUTES")
+    parser.add_option('--archive', dest = 'archive', default = 'ARCHIVE',
+                      help = "archive module images in DIR, "
+                      "empty to disable (default ARCHIVE)",
+                      metavar = "DIR")
+
+    (options, args) = parser.parse_args()
+
+    devices = list(args)
+    if options.manifest:
+        devices += read_manifest(options.manifest)
+
+    if not devices:
+        parser.error("expected at least one serial device")
+
+    if options.snapshot_every is not None:
+        options.snapshot = True
+    if options.snapshot and not options.archive:
+        parser.error("snapshots are kept in the archive")
+
+    stdout = sys.stdout
+    outputs = [ Output(sys.stdout), Output(sys.stderr) ]
+    sys.stdout, sys.stderr = outputs
+
+    workers = [ Worker(_, options, outputs) for _ in devices ]
+    t0 = time.time()
+    try:
+        for worker in workers:
+            worker.start()
+
+        while any(_.is_alive() for _ in workers):
+            t = time.time() + options.interval
+            while time.time() < t and any(_.is_alive() for _ in workers):
+                time.sleep(0.5)
+            show_progress(workers, t0, stdout)
+
+    finally:
+        sys.stdout, sys.stderr = [ _.stream for _ in outputs ]
+
+    failed = [ _ for _ in workers if _.error or not _.tek or
+               _.tek.status != 'done' ]
+    for worker in failed:
+        print("%s: %s" % (worker.device, worker.status()), file = sys.stderr)
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,32 +1,44 @@
 #! /usr/bin/python3
 from __future__ import division, print_function, unicode_literals
 
+import os
 import sys
+import glob
+import json
 import struct
 from optparse import OptionParser
 
-def read_text(f):
+FORMATS = [ 'big', 'little', 'text' ]
+
+# File name extensions used in batch mode
+EXTENSIONS = { 'big' : '.bin', 'little' : '.le', 'text' : '.txt' }
+
+def parse_text(f):
     words = []
     for l in f:
         l = l.strip()
-        if l.startswith('#'):
+        if not l or l.startswith('#'):
             continue
         t = [ int(_, 16) for _ in l.split() ]
         if len(t) != 8:
-            print("error: each line of input must contain 8 words",
-                  file = sys.stderr())
-            sys.exit(1)
+            raise ValueError("each line of input must contain 8 words")
         words.extend(t)
     if len(words) != 64:
-        print("error: input must contain 8 lines", file = sys.stderr)
-        sys.exit(1)
+        raise ValueError("input must contain 8 lines")
     data = struct.pack('>64H', *words)
     return data
 
+def read_text(f):
+    try:
+        return parse_text(f)
+    except ValueError as e:
+        print("error: %s" % e, file = sys.stderr)
+        sys.exit(1)
+
 def read_bin(f):
     data = f.read()
     if len(data) != 128:
-        print("error: input must be 128 bytes", file = sys.stderr())
+        print("error: input must be 128 bytes", file = sys.stderr)
         sys.exit(1)
     return data
 
@@ -41,6 +53,171 @@ def write_bin(f, data):
 def byteswap(data):
     return struct.pack('>64H', *struct.unpack('<64H', data))
 
+def find_images(paths, fmt):
+    """Find image files.
+
+    Each path can be a file, a glob or a directory which is searched
+    recursively for files with the extension of the format.  Returns
+    a list of (file name, base directory).
+    """
+
+    ext = EXTENSIONS[fmt]
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for fn in sorted(files):
+                    if fn.endswith(ext):
+                        found.append((os.path.join(root, fn), path))
+        else:
+            # Keep the part of the path after the first wildcard
+            base = []
+            for part in os.path.dirname(path).split(os.sep):
+                if any(_ in part for _ in '*?['):
+                    break
+                base.append(part)
+            base = os.sep.join(base)
+            for fn in sorted(glob.glob(path)):
+                found.append((fn, base))
+    return found
+
+def read_images(fns, fmt):
+    """Read images into an array with one big endian image per row.
+
+    Returns the array and a list of errors, None for images which
+    could be read.  Rows for images with errors are all 0xff.
+    """
+
+    import numpy as np
+
+    images = np.full((len(fns), 128), 0xff, dtype = 'B')
+    errors = [ None ] * len(fns)
+    for i, fn in enumerate(fns):
+        try:
+            if fmt == 'text':
+                with open(fn) as f:
+                    data = parse_text(f)
+            else:
+                with open(fn, 'rb') as f:
+                    data = f.read(129)
+                if len(data) != 128:
+                    raise ValueError("file must be 128 bytes")
+            images[i] = np.frombuffer(data, dtype = 'B')
+        except (OSError, ValueError) as e:
+            errors[i] = str(e)
+
+    if fmt == 'little':
+        images = images.reshape((-1, 64, 2))[:, :, ::-1].reshape((-1, 128))
+
+    return images, errors
+
+def image_checksums(images):
+    """Return the stored and calculated checksum of all images"""
+
+    import numpy as np
+
+    words = images.view('>u2')
+    stored = words[:, 63].astype(np.uint32)
+    calculated = -words[:, :63].sum(axis = 1, dtype = np.uint32) & 0xffff
+    return stored, calculated
+
+def write_images(images, fns, fmt):
+    import numpy as np
+
+    if fmt == 'little':
+        images = images.reshape((-1, 64, 2))[:, :, ::-1].reshape((-1, 128))
+
+    if fmt == 'text':
+        words = images.view('>u2').reshape((-1, 8, 8))
+
+    for i, fn in enumerate(fns):
+        d = os.path.dirname(fn)
+        if d:
+            os.makedirs(d, exist_ok = True)
+        if fmt == 'text':
+            data = images[i].tobytes()
+            model = data[0x6e:0x76].decode('ASCII', errors = 'replace').strip()
+            serial = data[0x76:0x7e].decode('ASCII', errors = 'replace').strip()
+            with open(fn, 'w') as f:
+                print("# %s %s" % (model, serial), file = f)
+                for line in words[i]:
+                    print(' '.join('%04x' % _ for _ in line), file = f)
+        else:
+            with open(fn, 'wb') as f:
+                f.write(images[i].tobytes())
+
+def batch(options, paths):
+    """Check and convert many images in one go"""
+
+    infmt = options.infmt or 'big'
+    outfmt = options.outfmt or 'big'
+
+    found = find_images(paths, infmt)
+    fns = [ _[0] for _ in found ]
+    images, errors = read_images(fns, infmt)
+    stored, calculated = image_checksums(images)
+
+    if options.checksum:
+        images.view('>u2')[:, 63] = calculated
+
+    summary = []
+    outfns = []
+    for i, (fn, base) in enumerate(found):
+        data = images[i].tobytes()
+        entry = {
+            'file' : fn,
+            'model' : data[0x6e:0x76].decode('ASCII', errors = 'replace').strip(),
+            'serial' : data[0x76:0x7e].decode('ASCII', errors = 'replace').strip(),
+            'checksum' : '%04x' % stored[i],
+            'calculated' : '%04x' % calculated[i],
+            'valid' : bool(stored[i] == calculated[i]),
+        }
+        if errors[i]:
+            entry = { 'file' : fn, 'error' : errors[i] }
+
+        elif options.outdir:
+            outfn = os.path.join(options.outdir, os.path.relpath(fn, base))
+            outfn = os.path.splitext(outfn)[0] + EXTENSIONS[outfmt]
+            entry['output'] = outfn
+            outfns.append((i, outfn))
+
+        summary.append(entry)
+
+    if outfns:
+        write_images(images[[ _[0] for _ in outfns ]],
+                     [ _[1] for _ in outfns ], outfmt)
+
+    bad = 0
+    for entry in summary:
+        if 'error' in entry:
+            print("%s: error: %s" % (entry['file'], entry['error']),
+                  file = sys.stderr)
+            bad += 1
+        elif not entry['valid']:
+            print("%s: invalid checksum 0x%s, calculated 0x%s%s" % (
+                entry['file'], entry['checksum'], entry['calculated'],
+                " (fixed)" if options.checksum else ""), file = sys.stderr)
+            if not options.checksum:
+                bad += 1
+
+    print("%u images, %u valid, %u invalid, %u errors" % (
+        len(summary),
+        len([ _ for _ in summary if _.get('valid') ]),
+        len([ _ for _ in summary if _.get('valid') is False ]),
+        len([ _ for _ in summary if 'error' in _ ])), file = sys.stderr)
+
+    if options.summary:
+        if options.summary == '-':
+            json.dump(summary, sys.stdout, indent = 4)
+            print()
+        else:
+            with open(options.summary, 'w') as f:
+                json.dump(summary, f, indent = 4)
+
+    if bad:
+        sys.exit(1)
+
 def main():
     parser = OptionParser()
     parser.add_option('-I', '--input-format', dest = 'infmt',
@@ -61,21 +238,38 @@ def main():
     parser.add_option('-c', '--checksum', dest = 'checksum',
                       help = "calculate new checksum",
                       action = 'store_true')
+    parser.add_option('-b', '--batch', dest = 'batch',
+                      help = "check all images in the directories, "
+                      "globs or files given as arguments",
+                      action = 'store_true')
+    parser.add_option('-d', '--output-dir', dest = 'outdir',
+                      help = "in batch mode, write converted images to DIR",
+                      metavar = "DIR")
+    parser.add_option('--summary', dest = 'summary',
+                      help = "in batch mode, write a JSON summary to FILE",
+                      metavar = "FILE")
 
     (options, args) = parser.parse_args()
 
+    if options.infmt not in [ None ] + FORMATS:
+        parser.error("invalid input format %s" % repr(options.infmt))
+
+    if options.outfmt not in [ None ] + FORMATS:
+        parser.error("invalid output format %s" % repr(options.outfmt))
+
+    if options.batch:
+        if not args:
+            parser.error("batch mode needs at least one directory or file")
+        if options.checksum and not options.outdir:
+            parser.error("-c in batch mode needs -d, the fixed images "
+                         "have to be written somewhere")
+        batch(options, args)
+        return
+
     if len(args):
         print("%s: error: this program takes no arguments", file = sys.stderr)
         sys.exit(1)
 
-    if options.infmt not in [ None, 'big', 'little', 'text' ]:
-        print("error: invalid input format %s" % repr(options.infmt),
-              file = sys.stderr)
-
-    if options.outfmt not in [ None, 'big', 'little', 'text' ]:
-        print("error: invalid output format %s" % repr(options.outfmt),
-              file = sys.stderr)
-
     if options.infn is None or options.infn == '-':
         f = sys.stdin
         indesc = 'stdin'
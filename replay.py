@@ -0,0 +1,280 @@
+#! /usr/bin/python3
+"""Replay a capture made with backup.py --capture.
+
+The capture is fed through the same Tek class as a live backup, but
+without the instrument and as fast as the CPU allows, so that all the
+images can be made again after fixing a bug in the parsing.
+
+Time is virtual and follows the capture.  Sleeps take no time, a read
+which timed out during the session times out at once, and data shows
+up when the Tek class has got as far as it had when the data arrived
+during the session.  Everything Tek sends is compared with what was
+sent during the session, if it differs the replay has gone off track,
+most likely because the parsing changed what the backup did.
+
+The session cache and options from the capture are used and the output
+is written to an empty directory.  The archive is not used unless it
+is given with --archive, so a session which used images from the
+archive can only be replayed with the same archive.
+
+Since no time is spent waiting this is also a benchmark of the
+parsing, the time it took is printed at the end.
+
+    ./backup.py --capture capture.gz /dev/ttyUSB0
+    ./replay.py -o replay capture.gz
+"""
+
+import sys
+import os
+import json
+import time
+import pexpect.expect
+from optparse import OptionParser
+
+import backup
+from archive import Archive
+from capture import load_capture
+
+class Clock():
+    """Virtual time, stands in for the time module"""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, t):
+        self.now += t
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+class ReplayReader():
+    """Stands in for a SerialReader, the data comes from a capture."""
+
+    def __init__(self, records, clock, t0):
+        self.records = records
+        self.clock = clock
+        self.t0 = t0
+        self.i = 0
+        self.buf = bytearray()
+        self.stopped = False
+        self.capture = None
+
+        # Statistics
+        self.received = 0
+        self.overruns = 0
+        self.high_water = 0
+        self.mismatches = 0
+        self.beyond = 0
+
+    def pending(self):
+        """Time the next data was received.
+
+        Returns None if something has to be sent first.
+        """
+
+        if self.i < len(self.records) and self.records[self.i][1] == 'r':
+            return self.t0 + self.records[self.i][0]
+        return None
+
+    def take(self):
+        data = self.records[self.i][2]
+        self.i += 1
+        self.buf += data
+        self.received += len(data)
+        self.high_water = max(self.high_water, len(self.buf))
+
+    def read(self, size = None, timeout = None):
+        if not self.buf:
+            t = self.pending()
+            if t is None or (timeout is not None and
+                             t > self.clock.now + timeout):
+                if timeout is not None:
+                    self.clock.sleep(timeout)
+                return b''
+
+            # Everything which had arrived by then
+            self.clock.now = max(self.clock.now, t)
+            while 1:
+                t = self.pending()
+                if t is None or t > self.clock.now:
+                    break
+                self.take()
+
+        if size is None:
+            size = len(self.buf)
+        data = bytes(self.buf[:size])
+        del self.buf[:size]
+        return data
+
+    def action(self, kind, data = b''):
+        """Tek sent something or cleared the buffer"""
+
+        # Whatever arrived before it during the session has arrived
+        while self.pending() is not None:
+            self.take()
+
+        if self.i == len(self.records):
+            self.beyond += 1
+            return
+
+        t, k, d = self.records[self.i]
+        self.i += 1
+        if (k, d) != (kind, data):
+            self.mismatches += 1
+        self.clock.now = max(self.clock.now, self.t0 + t)
+
+    def clear(self):
+        self.action('c')
+        self.buf.clear()
+
+    def stop(self):
+        self.stopped = True
+
+class ReplayPort():
+    """Stands in for a serial port, writes go to the ReplayReader"""
+
+    def __init__(self, port, reader):
+        self.port = port
+        self.reader = reader
+        self.baudrate = backup.MAIN_BAUDRATES[0]
+        self.inter_byte_timeout = None
+        self.is_open = True
+
+    def isOpen(self):
+        return self.is_open
+
+    def fileno(self):
+        return -1
+
+    def write(self, data):
+        self.reader.action('s', bytes(data))
+        return len(data)
+
+    def reset_input_buffer(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+def main():
+    parser = OptionParser(usage = "%prog [options] CAPTURE")
+    parser.add_option('-o', '--output', dest = 'output', default = 'replay',
+                      help = "write the output to DIR, which must be empty "
+                      "(default replay)",
+                      metavar = "DIR")
+    parser.add_option('--archive', dest = 'archive',
+                      help = "use the archive in DIR like the session did",
+                      metavar = "DIR")
+    parser.add_option('--events', dest = 'events',
+                      help = "append telemetry events as JSON lines to FILE",
+                      metavar = "FILE")
+    parser.add_option('--pexpect-dump', dest = 'raw_dump', default = True,
+                      action = 'store_false',
+                      help = "decode memory dumps with pexpect")
+    parser.add_option('-d', '--debug', dest = 'debug', type = 'int',
+                      default = 0,
+                      help = "debug level of the Tek class")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.error("expected exactly one capture")
+
+    header, records = load_capture(args[0])
+
+    archive = options.archive and os.path.abspath(options.archive)
+    events = options.events and os.path.abspath(options.events)
+
+    out = options.output
+    if os.path.exists(out) and os.listdir(out):
+        parser.error("%s is not empty" % out)
+    os.makedirs(out, exist_ok = True)
+    os.chdir(out)
+
+    # Start from the session cache as it was at the start of the session
+    with open(backup.SESSION_FN, 'w') as f:
+        json.dump(header['sessions'], f, indent = 4, sort_keys = True)
+
+    # Make backup.py and pexpect use the virtual time
+    clock = Clock(header['time'])
+    backup.time = clock
+    pexpect.expect.time = clock
+
+    reader = ReplayReader(records, clock, header['time'])
+    port = ReplayPort(header['port'], reader)
+    printer = backup.Printer('log', echo = False)
+
+    tek = backup.Tek(port, printer, reader)
+    tek.debug = options.debug
+    tek.raw_dump = options.raw_dump
+    tek.show_progress = False
+    tek.telemetry = backup.Telemetry(events)
+    tek.archive = Archive(archive) if archive else None
+
+    session_options = header['options']
+    tek.checkpoint_interval = session_options['checkpoint']
+    tek.plan_fn = session_options['plan']
+    if session_options['budget'] is not None:
+        tek.budget = session_options['budget'] * 60
+    tek.survey_subsystems = session_options['survey']
+    tek.verify = session_options['verify']
+    tek.verify_sample = session_options.get('verify_sample', 0)
+    tek.snapshot = session_options.get('snapshot', False)
+    snapshot_every = session_options.get('snapshot_every')
+    if tek.snapshot and not tek.archive:
+        parser.error("the session took snapshots, which needs --archive")
+
+    # A session taking snapshots goes on until it is interrupted, what
+    # was sent in the run where the capture ends can't be replayed
+    failed = False
+    interrupted = None
+    t0 = time.time()
+    try:
+        while 1:
+            mismatches = reader.mismatches
+            try:
+                tek.run()
+            except Exception:
+                if snapshot_every is None or reader.i < len(records):
+                    raise
+                interrupted = reader.mismatches - mismatches + reader.beyond
+                reader.mismatches = mismatches
+                break
+            if snapshot_every is None or reader.i == len(records):
+                break
+            clock.sleep(snapshot_every * 60)
+    except Exception as e:
+        print("Replay failed: %s" % (str(e) or e.__class__.__name__),
+              file = sys.stderr)
+        failed = True
+    finally:
+        elapsed = time.time() - t0
+        tek.close()
+
+    total = sum(len(_[2]) for _ in records if _[1] == 'r')
+    duration = records[-1][0] if records else 0
+    print("replayed %u of %u bytes in %.2f s, %.0f kB/s" % (
+        reader.received, total, elapsed,
+        reader.received / elapsed / 1000 if elapsed else 0))
+    print("the session took %s, %.0f times as long" % (
+        backup.format_eta(duration), duration / elapsed if elapsed else 0))
+    print("%u bytes dumped in %u rows, %u resyncs" % (
+        tek.dumped, tek.rows, tek.resyncs))
+    if interrupted is not None:
+        print("the session was interrupted while taking snapshots, "
+              "%u sends in the last run were not compared" % interrupted)
+    else:
+        # Sending more than the session did means the replay has gone
+        # off track
+        reader.mismatches += reader.beyond
+    print("%u sends which did not match the capture, %u records left" % (
+        reader.mismatches, len(records) - reader.i))
+
+    if failed or reader.mismatches:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#! /usr/bin/python3
+"""Streaming decoder for memory dumps from the Low-Level Hardware Debugger.
+
+In 16 bit mode the debugger prints one line per eight words:
+
+    RM 0E0000 EB32 BE4E A2FB 71C8 0BC7 47B7 1E95 4827
+
+The decoder is fed raw bytes as they come from the serial port, in
+chunks of any size, and returns the address and data of every complete
+line.  All the lines found in a chunk are converted from hex in one go.
+"""
+
+import re
+
+# An RM line must be followed by an escape sequence, otherwise it might
+# not be complete yet.  The escape sequence can come before or after
+# the CR/LF at the end of the line.
+RM_RE = re.compile(rb'RM +([0-9A-F]+)((?: +[0-9A-F]{4})+)\s[^\033]*\033')
+
+class RMDecoder():
+    """Decode RM lines from a stream of bytes.
+
+    Words are stored with the given byte order, '<' for little endian
+    and '>' for big endian, just like struct does.
+    """
+
+    # Bytes to keep while waiting for the rest of a line
+    MAX_TAIL = 4096
+
+    def __init__(self, byte_order = '<'):
+        self.byte_order = byte_order
+        self.tail = b''
+
+        # Statistics
+        self.bytes = 0
+        self.rows = 0
+
+    def feed(self, data):
+        self.bytes += len(data)
+        buf = self.tail + data
+
+        addrs = []
+        values = []
+        end = 0
+        for match in RM_RE.finditer(buf):
+            end = match.end()
+            words = match.group(2).split()
+            if any(len(_) != 4 for _ in words):
+                continue
+            addrs.append(int(match.group(1), 16))
+            values.append(words)
+
+        self.tail = buf[end:]
+        if len(self.tail) > self.MAX_TAIL:
+            i = self.tail.rfind(b'RM')
+            self.tail = self.tail[i:] if i >= 0 else b''
+
+        if not addrs:
+            return []
+
+        data = bytearray.fromhex(b''.join(
+            b''.join(_) for _ in values).decode('ASCII'))
+        if self.byte_order == '<':
+            data[0::2], data[1::2] = data[1::2], data[0::2]
+
+        rows = []
+        offset = 0
+        for addr, words in zip(addrs, values):
+            n = len(words) * 2
+            rows.append((addr, bytes(data[offset:offset + n])))
+            offset += n
+
+        self.rows += len(rows)
+        return rows
@@ -1,50 +1,455 @@
 #! /usr/bin/python3
+"""Tools for EPROM images.
+
+Split an image into a pair of EPROMs with even and odd bytes or
+interleave them again, and convert images to and from Intel HEX and
+Motorola S-records for EPROM programmers and disassemblers:
+
+    ./romtool.py export fc0000.hex A18-U800-EXP-4_04.bin A18-U900-EXP-4_04.bin
+    ./romtool.py import fc0000.s28 U800.bin U900.bin
+
+Exporting a pair interleaves it on the fly, importing into a pair
+splits it.  Everything is done a chunk or a record at a time so that
+images of any size can be converted.  Unless an address is given with
+-a the address is looked up in the dump plans, A18-U800 and A18-U900
+together are at 0xFC0000.  The format is taken from the extension of
+the file name, .hex, .ihx or .ihex for Intel HEX and .s19, .s28, .s37,
+.srec or .mot for S-records, anything else is raw binary.
+"""
+
 from __future__ import division, print_function, unicode_literals
 
+import os
+import sys
+from optparse import OptionParser
+
 import numpy as np
 
-def interleave_arrays(*arrays):
+from dumpplan import find_region
+
+# Bytes per file to process at a time when splitting or interleaving
+# files, this keeps the memory usage down for large images
+CHUNK_SIZE = 0x100000
+
+# Data bytes per Intel HEX or S-record line
+RECORD_SIZE = 16
+
+# Gaps between the records of an imported image are filled with this,
+# which is what an erased EPROM contains
+FILL = b'\xff'
+
+FORMATS = {
+    'ihex' : [ '.hex', '.ihx', '.ihex' ],
+    'srec' : [ '.s19', '.s28', '.s37', '.srec', '.mot' ],
+}
+
+# Bytes in the address of each kind of S-record
+SREC_ADDRESS = {
+    '0' : 2, '1' : 2, '2' : 3, '3' : 4,
+    '5' : 2, '6' : 3, '7' : 4, '8' : 3, '9' : 2,
+}
+
+# The data record and termination record for each size of address
+SREC_KINDS = [ (0xffff, '1', '9'), (0xffffff, '2', '8'),
+               (0xffffffff, '3', '7') ]
+
+def map_file(fn):
+    """Memory map a file as an array of bytes"""
+
+    if os.path.getsize(fn) == 0:
+        return np.zeros(0, dtype = 'B')
+    return np.memmap(fn, dtype = 'B', mode = 'r')
+
+def create_file(fn, size):
+    """Create a file of size bytes and memory map it"""
+
+    if size == 0:
+        open(fn, 'wb').close()
+        return np.zeros(0, dtype = 'B')
+    return np.memmap(fn, dtype = 'B', mode = 'w+', shape = (size,))
+
+def interleave_arrays(*arrays, width = 1):
+    """Interleave arrays.
+
+    Take width bytes from each array in turn, width = 2 interleaves
+    16 bit words.
+    """
+
     for i in range(1, len(arrays)):
         if arrays[i-1].shape != arrays[i].shape:
             raise ValueError("array sizes are not equal")
 
-    array = np.array(arrays)
-    array = array.T
-    array = array.reshape(len(arrays) * len(arrays[0]))
-
-    split_array(array, len(arrays))
+    array = np.empty(len(arrays) * len(arrays[0]), dtype = arrays[0].dtype)
+    views = split_array(array, len(arrays), width)
+    for view, a in zip(views, arrays):
+        view[...] = a.reshape(view.shape)
 
     return array
 
-def interleave_files(out_fn, *in_fns):
+def interleave_files(out_fn, *in_fns, width = 1, chunk_size = CHUNK_SIZE):
     arrays = []
     for fn in in_fns:
-        array = np.fromfile(fn, dtype = 'B')
+        array = map_file(fn)
         if arrays and len(arrays[-1]) != len(array):
             raise ValueError("file sizes are not equal")
         arrays.append(array)
 
-    array = interleave_arrays(*arrays)
+    n = len(arrays[0])
+    if n % width:
+        raise ValueError("length of file is not a multiple of width")
+
+    out = create_file(out_fn, n * len(arrays))
+    views = split_array(out, len(arrays), width)
+    step = max(chunk_size // width, 1)
+    for i in range(0, n // width, step):
+        for view, array in zip(views, arrays):
+            chunk = view[i : i + step]
+            chunk[...] = array[i * width : (i + step) * width].reshape(
+                chunk.shape)
+        if isinstance(out, np.memmap):
+            out.flush()
+
+def split_array(array, parts, width = 1):
+    """Split an array into parts.
 
-    array.tofile(out_fn)
+    Returns views of the array, no data is copied.  With width = 1
+    the result is a (parts, len(array) // parts) array just like
+    before, with a larger width each part is a (words, width) array.
+    """
 
-def split_array(array, parts):
-    if len(array) % parts:
+    if len(array) % (parts * width):
         raise ValueError("length of array is not a multiple of parts")
 
-    array = array.reshape((len(array) // parts, parts))
-    array = array.T
+    array = array.reshape((len(array) // (parts * width), parts, width))
+    array = array.transpose((1, 0, 2))
+    if width == 1:
+        array = array[:, :, 0]
 
     return array
 
-def split_file(in_fn, *out_fns):
-    array = np.fromfile(in_fn, dtype = 'B')
-    arrays = split_array(array, len(out_fns))
-    for i in range(len(arrays)):
-        arrays[i].tofile(out_fns[i])
+def split_file(in_fn, *out_fns, width = 1, chunk_size = CHUNK_SIZE):
+    array = map_file(in_fn)
+    views = split_array(array, len(out_fns), width)
+
+    n = len(array) // len(out_fns)
+    outs = [ create_file(fn, n) for fn in out_fns ]
+    step = max(chunk_size // width, 1)
+    for i in range(0, n // width, step):
+        for view, out in zip(views, outs):
+            chunk = view[i : i + step]
+            out[i * width : (i + step) * width] = chunk.reshape(-1)
+            if isinstance(out, np.memmap):
+                out.flush()
+
+def guess_format(fn):
+    ext = os.path.splitext(fn)[1].lower()
+    for fmt, exts in FORMATS.items():
+        if ext in exts:
+            return fmt
+    return 'raw'
+
+def read_chunks(fns, width = 1, chunk_size = CHUNK_SIZE):
+    """Yield (offset, data) of files interleaved on the fly"""
+
+    arrays = []
+    for fn in fns:
+        array = map_file(fn)
+        if arrays and len(arrays[-1]) != len(array):
+            raise ValueError("file sizes are not equal")
+        arrays.append(array)
+
+    n = len(arrays[0])
+    if n % width:
+        raise ValueError("length of file is not a multiple of width")
+
+    step = max(chunk_size // width, 1) * width
+    for i in range(0, n, step):
+        chunk = interleave_arrays(*[ _[i : i + step] for _ in arrays ],
+                                  width = width)
+        yield i * len(arrays), chunk.tobytes()
+
+def ihex_record(kind, address, data = b''):
+    rec = bytes([ len(data), address >> 8 & 0xff, address & 0xff,
+                  kind ]) + data
+    return ':%s%02X\n' % (rec.hex().upper(), -sum(rec) & 0xff)
+
+def write_ihex(f, chunks, address = 0, record_size = RECORD_SIZE):
+    """Write Intel HEX with extended linear address records"""
+
+    upper = 0
+    for offset, data in chunks:
+        i = 0
+        while i < len(data):
+            a = address + offset + i
+            if a > 0xffffffff:
+                raise ValueError("address 0x%x is too large" % a)
+            if a >> 16 != upper:
+                upper = a >> 16
+                f.write(ihex_record(4, 0, upper.to_bytes(2, 'big')))
+
+            # A record can't cross a 64k boundary
+            n = min(record_size, len(data) - i, 0x10000 - (a & 0xffff))
+            f.write(ihex_record(0, a & 0xffff, data[i : i + n]))
+            i += n
+    f.write(ihex_record(1, 0))
+
+def read_ihex(f):
+    """Yield (address, data) for each data record in Intel HEX"""
+
+    base = 0
+    for n, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            if not line.startswith(':'):
+                raise ValueError
+            rec = bytes.fromhex(line[1:])
+        except ValueError:
+            raise ValueError("line %u: not an Intel HEX record" % n)
+        if len(rec) < 5 or len(rec) != rec[0] + 5 or sum(rec) & 0xff:
+            raise ValueError("line %u: bad record" % n)
+
+        kind = rec[3]
+        data = rec[4:-1]
+        if kind == 0:
+            yield base + (rec[1] << 8 | rec[2]), data
+        elif kind == 1:
+            return
+        elif kind == 2:
+            base = int.from_bytes(data, 'big') << 4
+        elif kind == 4:
+            base = int.from_bytes(data, 'big') << 16
+
+def srec_record(kind, address, data = b''):
+    n = SREC_ADDRESS[kind]
+    rec = bytes([ n + len(data) + 1 ]) + address.to_bytes(n, 'big') + data
+    return 'S%s%s%02X\n' % (kind, rec.hex().upper(), ~sum(rec) & 0xff)
+
+def write_srec(f, chunks, address = 0, size = 0, header = b'',
+               record_size = RECORD_SIZE):
+    """Write S-records, with addresses large enough for size bytes"""
+
+    for limit, kind, end in SREC_KINDS:
+        if address + max(size, 1) - 1 <= limit:
+            break
+    else:
+        raise ValueError("address 0x%x is too large" % (address + size - 1))
+
+    f.write(srec_record('0', 0, header))
+    for offset, data in chunks:
+        for i in range(0, len(data), record_size):
+            f.write(srec_record(kind, address + offset + i,
+                                data[i : i + record_size]))
+    f.write(srec_record(end, 0))
+
+def read_srec(f):
+    """Yield (address, data) for each data record in S-records"""
+
+    for n, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            kind = line[1:2]
+            if not line.startswith('S') or kind not in SREC_ADDRESS:
+                raise ValueError
+            rec = bytes.fromhex(line[2:])
+        except ValueError:
+            raise ValueError("line %u: not an S-record" % n)
+        if (len(rec) < SREC_ADDRESS[kind] + 2 or len(rec) != rec[0] + 1 or
+            sum(rec) & 0xff != 0xff):
+            raise ValueError("line %u: bad record" % n)
+
+        if kind in '123':
+            a = SREC_ADDRESS[kind] + 1
+            yield int.from_bytes(rec[1:a], 'big'), rec[a:-1]
+        elif kind in '789':
+            return
+
+def read_raw(f, chunk_size = CHUNK_SIZE):
+    offset = 0
+    while 1:
+        data = f.read(chunk_size)
+        if not data:
+            return
+        yield offset, data
+        offset += len(data)
+
+class ImageWriter():
+    """Write data at any offset to a file or split it into files.
+
+    With more than one file, width bytes at a time go to each file in
+    turn, just like split_file.  Gaps are filled with FILL.
+    """
+
+    def __init__(self, fns, width = 1):
+        self.files = [ open(_, 'wb') for _ in fns ]
+        self.sizes = [ 0 ] * len(fns)
+        self.width = width
+
+    def put(self, part, pos, data):
+        f = self.files[part]
+        if pos > self.sizes[part]:
+            f.seek(self.sizes[part])
+            left = pos - self.sizes[part]
+            while left:
+                n = min(left, CHUNK_SIZE)
+                f.write(FILL * n)
+                left -= n
+        f.seek(pos)
+        f.write(data)
+        self.sizes[part] = max(self.sizes[part], pos + len(data))
+
+    def write(self, offset, data):
+        parts = len(self.files)
+        w = self.width
+        if parts == 1:
+            self.put(0, offset, data)
+        elif offset % w or len(data) % w:
+            # Not whole words, a byte at a time
+            for i in range(len(data)):
+                word, k = divmod(offset + i, w)
+                self.put(word % parts, word // parts * w + k,
+                         data[i : i + 1])
+        else:
+            first = offset // w
+            words = len(data) // w
+            for j in range(min(parts, words)):
+                word = first + j
+                self.put(word % parts, word // parts * w, b''.join(
+                    data[i * w : (i + 1) * w]
+                    for i in range(j, words, parts)))
+
+    def close(self):
+        # All files of a split image have the same size
+        size = max(self.sizes)
+        for part in range(len(self.files)):
+            if self.sizes[part] < size:
+                self.put(part, size, b'')
+            self.files[part].close()
+
+def export_files(out_fn, *in_fns, fmt = None, address = None, width = 1):
+    """Write files, interleaved if there are more than one, to out_fn.
+
+    Unless address is given the address of the region in the dump
+    plans is used, or 0 if it isn't in any plan.
+    """
+
+    if fmt is None:
+        fmt = guess_format(out_fn)
+    if address is None:
+        address = find_region(in_fns) or 0
+    size = sum(os.path.getsize(_) for _ in in_fns)
+
+    chunks = read_chunks(in_fns, width)
+    if fmt == 'raw':
+        with open(out_fn, 'wb') as f:
+            for offset, data in chunks:
+                f.write(data)
+        return
+
+    with open(out_fn, 'w') as f:
+        if fmt == 'ihex':
+            write_ihex(f, chunks, address)
+        else:
+            header = os.path.basename(out_fn).encode('ASCII', 'replace')
+            write_srec(f, chunks, address, size, header[:64])
+
+def import_files(in_fn, *out_fns, fmt = None, address = None, width = 1):
+    """Read in_fn into out_fns, split if there are more than one.
+
+    The data which was at address ends up at the start, unless it is
+    given the address of the region in the dump plans is used, or
+    else the address of the first record.
+    """
+
+    if fmt is None:
+        fmt = guess_format(in_fn)
+    if address is None:
+        address = find_region(out_fns)
+
+    if fmt == 'raw':
+        f = open(in_fn, 'rb')
+        records = read_raw(f)
+        address = 0
+    else:
+        f = open(in_fn)
+        records = read_ihex(f) if fmt == 'ihex' else read_srec(f)
+
+    out = ImageWriter(out_fns, width)
+    try:
+        for a, data in records:
+            if address is None:
+                address = a
+            if a < address:
+                raise ValueError("data at 0x%x is below 0x%x" % (a, address))
+            out.write(a - address, data)
+    finally:
+        out.close()
+        f.close()
+
+def rom_checksum(array):
+    """Checksum an EPROM image.
+
+    Returns the checksum stored in the first two bytes of the image,
+    high byte first, and the 16 bit sum of all the other bytes.  This
+    is my best guess of what the ROM Checksum test in the Extended
+    Diagnostics shows as EXPECT and ACTUAL.
+    """
+
+    if isinstance(array, (bytes, bytearray)):
+        array = np.frombuffer(array, dtype = 'B')
+    expect = int(array[0]) << 8 | int(array[1])
+    actual = int(array[2:].sum(dtype = np.uint32)) & 0xffff
+    return expect, actual
+
+def rom_checksum_file(fn):
+    return rom_checksum(map_file(fn))
+
+def main():
+    parser = OptionParser(usage = "%prog [options] split IN OUT...\n"
+                          "       %prog [options] interleave OUT IN...\n"
+                          "       %prog [options] export OUT IN...\n"
+                          "       %prog [options] import IN OUT...")
+    parser.add_option('-w', '--width', dest = 'width', type = 'int',
+                      default = 1,
+                      help = "interleave WIDTH bytes at a time, 2 for "
+                      "16 bit words (default 1)",
+                      metavar = "WIDTH")
+    parser.add_option('-f', '--format', dest = 'format',
+                      choices = [ 'raw', 'ihex', 'srec' ],
+                      help = "export or import FORMAT, raw, ihex or srec "
+                      "(default from the file name)",
+                      metavar = "FORMAT")
+    parser.add_option('-a', '--address', dest = 'address',
+                      type = 'int',
+                      help = "the image starts at ADDRESS "
+                      "(default from the dump plans)",
+                      metavar = "ADDRESS")
+
+    (options, args) = parser.parse_args()
+
+    if len(args) < 3:
+        parser.error("expected a command and at least two files")
+
+    cmd = args[0]
+    if cmd == 'split':
+        split_file(args[1], *args[2:], width = options.width)
+    elif cmd == 'interleave':
+        interleave_files(args[1], *args[2:], width = options.width)
+    elif cmd == 'export':
+        export_files(args[1], *args[2:], fmt = options.format,
+                     address = options.address, width = options.width)
+    elif cmd == 'import':
+        try:
+            import_files(args[1], *args[2:], fmt = options.format,
+                         address = options.address, width = options.width)
+        except ValueError as e:
+            print("%s: %s" % (args[1], e), file = sys.stderr)
+            sys.exit(1)
+    else:
+        parser.error("unknown command %s" % repr(cmd))
 
 if __name__ == '__main__':
-    interleave_files('A0',
-                     'w140_roms/160-6988-03.bin',
-                     'w140_roms/160-6989-03.bin')
-    split_file('A0', 'A1', 'A2')
+    main()
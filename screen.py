@@ -0,0 +1,249 @@
+#! /usr/bin/python3
+"""A model of the terminal screen in test mode.
+
+The Extended Diagnostics draw their menus on an 80x24 terminal with
+ANSI escape sequences, and a redraw can arrive split up in any number
+of pieces.  Screen follows the output as it arrives and keeps the text
+and the reverse video attribute of every cell, so that the state of
+the menus can be looked up directly instead of searching the stream
+with regular expressions.
+
+Only the sequences used by the instrument and a few common ones are
+handled, anything else is ignored.  Each row remembers when it was
+last drawn, so that it is possible to wait for something to show up
+in response to a key:
+
+    mark = screen.mark()
+    ... send a key and feed the screen until ...
+    screen.find(' Stopped ', mark)
+"""
+
+import re
+
+ROWS = 24
+COLUMNS = 80
+
+# A control sequence, another escape sequence, a control character or
+# a run of text.  An incomplete escape sequence does not match.
+TOKEN_RE = re.compile('\033\\[([0-9;?]*)([@-~])|'
+                      '\033[()*+].|'
+                      '\033([^[()*+])|'
+                      '([\x00-\x1a\x1c-\x1f])|'
+                      '([^\x00-\x1f]+)', re.S)
+
+# Give up on an escape sequence which is still incomplete after this
+MAX_TAIL = 32
+
+class Screen():
+    def __init__(self):
+        self.tail = ''
+        self.serial = 0
+        self.clear()
+
+    def clear(self):
+        self.text = [ [ ' ' ] * COLUMNS for _ in range(ROWS) ]
+        self.attr = [ [ False ] * COLUMNS for _ in range(ROWS) ]
+        self.drawn = [ self.serial ] * ROWS
+        self.row = 0
+        self.col = 0
+        self.top = 0
+        self.bottom = ROWS - 1
+        self.reverse = False
+
+        # The last thing received erased a line, every update of the
+        # screen ends like that
+        self.home = False
+
+    def mark(self):
+        """Rows drawn from now on have drawn >= the returned value"""
+
+        self.serial += 1
+        return self.serial
+
+    def feed(self, s):
+        s = self.tail + s
+        self.tail = ''
+
+        i = 0
+        n = len(s)
+        while i < n:
+            match = TOKEN_RE.match(s, i)
+            if not match:
+                # The start of an escape sequence, wait for the rest
+                if n - i < MAX_TAIL:
+                    self.tail = s[i:]
+                    return
+                i += 1
+                continue
+            i = match.end()
+
+            params, final, esc, ctrl, text = match.groups()
+            if text is not None:
+                self.put(text)
+            elif ctrl is not None:
+                self.control(ctrl)
+            elif final is not None:
+                self.csi(params, final)
+            elif esc == 'c':
+                self.clear()
+
+    def touch(self, *rows):
+        for r in rows:
+            self.drawn[r] = self.serial
+
+    def put(self, s):
+        while s:
+            if self.col >= COLUMNS:
+                self.col = 0
+                self.linefeed()
+            n = min(len(s), COLUMNS - self.col)
+            r = self.row
+            self.text[r][self.col:self.col + n] = s[:n]
+            self.attr[r][self.col:self.col + n] = [ self.reverse ] * n
+            self.touch(r)
+            self.col += n
+            s = s[n:]
+            self.home = False
+
+    def control(self, c):
+        if c == '\r':
+            self.col = 0
+        elif c == '\n':
+            self.linefeed()
+        elif c == '\b':
+            self.col = max(self.col - 1, 0)
+        elif c == '\t':
+            self.col = min((self.col // 8 + 1) * 8, COLUMNS - 1)
+
+    def linefeed(self):
+        if self.row == self.bottom:
+            self.scroll()
+        elif self.row < ROWS - 1:
+            self.row += 1
+
+    def scroll(self):
+        del self.text[self.top]
+        del self.attr[self.top]
+        self.text.insert(self.bottom, [ ' ' ] * COLUMNS)
+        self.attr.insert(self.bottom, [ False ] * COLUMNS)
+        self.touch(*range(self.top, self.bottom + 1))
+
+    def erase(self, r, start = 0, end = COLUMNS):
+        self.text[r][start:end] = [ ' ' ] * (end - start)
+        self.attr[r][start:end] = [ False ] * (end - start)
+        self.touch(r)
+
+    def csi(self, params, final):
+        args = [ int(_) if _.isdigit() else 0
+                 for _ in params.lstrip('?').split(';') ]
+        n = max(args[0], 1)
+
+        if final in 'Hf':
+            row = args[0] if len(args) > 0 else 0
+            col = args[1] if len(args) > 1 else 0
+            self.row = min(max(row, 1), ROWS) - 1
+            self.col = min(max(col, 1), COLUMNS) - 1
+        elif final == 'A':
+            self.row = max(self.row - n, 0)
+        elif final == 'B':
+            self.row = min(self.row + n, ROWS - 1)
+        elif final == 'C':
+            self.col = min(self.col + n, COLUMNS - 1)
+        elif final == 'D':
+            self.col = max(min(self.col, COLUMNS - 1) - n, 0)
+        elif final == 'K':
+            if args[0] == 0:
+                self.erase(self.row, min(self.col, COLUMNS))
+            elif args[0] == 1:
+                self.erase(self.row, 0, min(self.col + 1, COLUMNS))
+            else:
+                self.erase(self.row)
+                self.home = True
+        elif final == 'J':
+            if args[0] == 0:
+                self.erase(self.row, min(self.col, COLUMNS))
+                rows = range(self.row + 1, ROWS)
+            elif args[0] == 1:
+                self.erase(self.row, 0, min(self.col + 1, COLUMNS))
+                rows = range(0, self.row)
+            else:
+                rows = range(ROWS)
+            for r in rows:
+                self.erase(r)
+        elif final == 'm':
+            for a in args:
+                if a in (0, 27):
+                    self.reverse = False
+                elif a == 7:
+                    self.reverse = True
+        elif final == 'r':
+            top = args[0] if len(args) > 0 else 0
+            bottom = args[1] if len(args) > 1 else 0
+            self.top = min(max(top, 1), ROWS) - 1
+            self.bottom = min(bottom, ROWS) - 1 if bottom else ROWS - 1
+            if self.bottom <= self.top:
+                self.top, self.bottom = 0, ROWS - 1
+            self.row = 0
+            self.col = 0
+
+    def line(self, r):
+        """Text of row r, counting from 1 like the escape sequences"""
+
+        return ''.join(self.text[r - 1])
+
+    def lines(self):
+        return [ self.line(r) for r in range(1, ROWS + 1) ]
+
+    def changed(self, since):
+        """Has anything been drawn after the mark since"""
+
+        return max(self.drawn) >= since
+
+    def find(self, s, since = None):
+        """Find the first row with s on it.
+
+        If since is given only rows drawn after that mark count.
+        Returns the row, counting from 1, or None.
+        """
+
+        for r in range(ROWS):
+            if since is not None and self.drawn[r] < since:
+                continue
+            if s in ''.join(self.text[r]):
+                return r + 1
+        return None
+
+    def search(self, pattern):
+        """re.search each row, returns the first match or None"""
+
+        for line in self.lines():
+            match = re.search(pattern, line)
+            if match:
+                return match
+        return None
+
+    def highlighted(self, s):
+        """Is s shown in reverse video, like an active soft key"""
+
+        for r in range(ROWS):
+            line = ''.join(self.text[r])
+            i = line.find(s)
+            while i >= 0:
+                if all(self.attr[r][i:i + len(s)]):
+                    return True
+                i = line.find(s, i + 1)
+        return False
+
+    def menu(self, since = None):
+        """The row with the selected subsystem, block, area and routine.
+
+        It is the row below the headings, empty if it isn't shown or
+        hasn't been drawn after the mark since.
+        """
+
+        r = self.find('SUBSYSTEM')
+        if r is None or r == ROWS:
+            return ''
+        if since is not None and self.drawn[r] < since:
+            return ''
+        return self.line(r + 1)
@@ -0,0 +1,133 @@
+#! /usr/bin/python3
+"""Drain a serial port from a thread.
+
+At 38400 bps the UART in a USB serial adapter only buffers a fraction
+of a second of data, so anything that makes the thread parsing the
+dump stall, a slow disk or a busy terminal, can make it overrun.  A
+SerialReader reads the port as soon as data arrives and keeps it in a
+bounded buffer in memory until it is asked for.
+
+If the buffer fills up anyway the oldest data is thrown away and
+counted as overruns, the address checks in backup.py will notice the
+hole.  ReaderSpawn lets pexpect read from the buffer instead of the
+port.
+
+If a Capture is given everything received, sent and cleared is also
+written to it, see capture.py.
+"""
+
+import select
+import threading
+import serial
+import pexpect
+import pexpect_serial
+
+# About four minutes at 38400 bps
+BUFFER_SIZE = 0x100000
+
+class SerialReader():
+    def __init__(self, ser, size = BUFFER_SIZE, poll_interval = 0.1,
+                 capture = None):
+        self.ser = ser
+        self.size = size
+        self.poll_interval = poll_interval
+        self.capture = capture
+
+        self.buf = bytearray()
+        self.cond = threading.Condition()
+        self.stopped = False
+
+        # Statistics
+        self.received = 0
+        self.overruns = 0
+        self.high_water = 0
+
+        self.thread = threading.Thread(target = self.reader, daemon = True)
+        self.thread.start()
+
+    def reader(self):
+        fd = self.ser.fileno()
+        while not self.stopped:
+            try:
+                r, w, x = select.select([ fd ], [], [], self.poll_interval)
+                if not r:
+                    continue
+                data = self.ser.read(max(1, self.ser.in_waiting))
+            except (OSError, ValueError, serial.SerialException):
+                break
+
+            if data:
+                self.put(data)
+
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def put(self, data):
+        with self.cond:
+            if self.capture:
+                self.capture.received(data)
+            self.received += len(data)
+            self.buf += data
+            n = len(self.buf) - self.size
+            if n > 0:
+                del self.buf[:n]
+                self.overruns += n
+            self.high_water = max(self.high_water, len(self.buf))
+            self.cond.notify_all()
+
+    def read(self, size = None, timeout = None):
+        """Read up to size bytes, everything buffered if size is None.
+
+        Waits up to timeout seconds for something to arrive, forever
+        if timeout is None.  Returns an empty string on a timeout.
+        """
+
+        with self.cond:
+            if not self.buf and not self.stopped:
+                self.cond.wait_for(lambda: self.buf or self.stopped, timeout)
+            if size is None:
+                size = len(self.buf)
+            data = bytes(self.buf[:size])
+            del self.buf[:size]
+        return data
+
+    def clear(self):
+        """Throw away anything buffered"""
+
+        with self.cond:
+            if self.capture:
+                self.capture.cleared()
+            self.buf.clear()
+
+    def stop(self):
+        self.stopped = True
+        self.thread.join()
+
+class ReaderSpawn(pexpect_serial.SerialSpawn):
+    """A SerialSpawn which reads from a SerialReader."""
+
+    def __init__(self, ser, reader, **kwargs):
+        super().__init__(ser, **kwargs)
+        self.reader = reader
+
+    def send(self, s):
+        if self.reader.capture:
+            data = s
+            if isinstance(data, str):
+                data = data.encode('ASCII', 'replace')
+            self.reader.capture.sent(data)
+        return super().send(s)
+
+    def read_nonblocking(self, size = 1, timeout = -1):
+        if timeout == -1:
+            timeout = self.timeout
+        data = self.reader.read(size, timeout)
+        if not data:
+            if self.reader.stopped:
+                self.flag_eof = True
+                raise pexpect.exceptions.EOF("serial port closed")
+            raise pexpect.exceptions.TIMEOUT("Timeout exceeded.")
+        s = self._decoder.decode(data, final = False)
+        self._log(s, 'read')
+        return s
@@ -0,0 +1,114 @@
+#! /usr/bin/python3
+"""Measure how long it takes for each command of tektool.py to start.
+
+Each command is run with --help a few times and the fastest run is
+shown next to how long it takes to start Python itself.  It also
+checks which of the slow modules each command imports, and fails if a
+command imports one it doesn't need or, with --limit, if it takes too
+long to start.
+
+    ./startup.py
+    ./startup.py --limit 100 module rom
+"""
+
+import os
+import sys
+import json
+import time
+import subprocess
+from optparse import OptionParser
+
+from tektool import COMMANDS
+
+TEKTOOL = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'tektool.py')
+
+# Modules which take a while to import and the commands which need them
+SLOW = {
+    'numpy' : [ 'rom' ],
+    'serial' : [ 'backup', 'fleet', 'replay' ],
+    'pexpect' : [ 'backup', 'fleet', 'replay' ],
+}
+
+# Run a command and print the slow modules it imported as JSON on the
+# original stdout, the help text goes to /dev/null
+CHECK = '''
+import os, sys, json, runpy
+out = os.fdopen(os.dup(1), 'w')
+os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+tektool, cmd, slow = sys.argv[1], sys.argv[2], sys.argv[3:]
+sys.path.insert(0, os.path.dirname(tektool))
+sys.argv = [ tektool, cmd, '--help' ]
+try:
+    runpy.run_path(tektool, run_name = '__main__')
+except SystemExit:
+    pass
+out.write(json.dumps([ _ for _ in slow if _ in sys.modules ]))
+'''
+
+def best_time(args, runs):
+    """Fastest of runs runs of a command, in seconds"""
+
+    best = None
+    for i in range(runs):
+        t0 = time.time()
+        subprocess.run(args, stdout = subprocess.DEVNULL,
+                       stderr = subprocess.DEVNULL, check = True)
+        t = time.time() - t0
+        if best is None or t < best:
+            best = t
+    return best
+
+def slow_imports(cmd):
+    out = subprocess.run([ sys.executable, '-c', CHECK, TEKTOOL, cmd ] +
+                         sorted(SLOW), stdout = subprocess.PIPE,
+                         check = True, universal_newlines = True).stdout
+    return json.loads(out)
+
+def main():
+    parser = OptionParser(usage = "%prog [options] [COMMAND...]")
+    parser.add_option('-n', '--runs', dest = 'runs', type = 'int',
+                      default = 5,
+                      help = "start each command N times (default 5)",
+                      metavar = "N")
+    parser.add_option('--limit', dest = 'limit', type = 'float',
+                      help = "fail if a command takes more than MS "
+                      "milliseconds longer to start than Python",
+                      metavar = "MS")
+
+    (options, args) = parser.parse_args()
+
+    commands = [ _[0] for _ in COMMANDS ]
+    for cmd in args:
+        if cmd not in commands:
+            parser.error("unknown command %s" % repr(cmd))
+    if args:
+        commands = args
+
+    python = best_time([ sys.executable, '-c', 'pass' ], options.runs)
+    print("%-10s %7.1f ms" % ('python', python * 1000))
+
+    failures = 0
+    for cmd in commands:
+        t = best_time([ sys.executable, TEKTOOL, cmd, '--help' ],
+                      options.runs)
+        extra = (t - python) * 1000
+        imported = slow_imports(cmd)
+        unneeded = [ _ for _ in imported if cmd not in SLOW[_] ]
+
+        problems = []
+        if unneeded:
+            problems.append("imports %s" % ', '.join(unneeded))
+        if options.limit is not None and extra > options.limit:
+            problems.append("too slow")
+        failures += bool(problems)
+
+        print("%-10s %7.1f ms  +%6.1f ms  %-22s %s" % (
+            cmd, t * 1000, extra, ' '.join(imported),
+            '; '.join(problems) or 'ok'))
+
+    if failures:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,804 @@
+#! /usr/bin/python3
+"""Simulated 11801/11802/CSA803 mainframe on a pseudo terminal.
+
+This is a stand-in for a real scope so that backup.py can be run and
+timed without any hardware.  It answers "ID?" and "UID?" in the
+normal GPIB mode, enters the Extended Diagnostics on "TEST MAN" and
+draws a crude version of the diagnostics menus with ANSI escape
+codes.  The Low-Level Hardware Debugger can dump memory with "RM"
+lines and the Registers exerciser can show the sampling head EEPROM
+contents.
+
+The serial line is emulated too.  Output is paced to the emulated
+baudrate and if the baudrate on the other side of the pseudo terminal
+does not match the baudrate of the instrument both directions are
+garbled, just like on a real serial port.
+
+Run it stand alone and point backup.py at the pseudo terminal it
+prints:
+
+    python3 teksim.py &
+    python3 backup.py /dev/pts/5
+"""
+
+import sys
+import os
+import pty
+import tty
+import time
+import errno
+import fcntl
+import random
+import select
+import struct
+import binascii
+import termios
+from optparse import OptionParser
+
+BAUDRATES = {
+    termios.B1200 : 1200,
+    termios.B2400 : 2400,
+    termios.B4800 : 4800,
+    termios.B9600 : 9600,
+    termios.B19200 : 19200,
+    termios.B38400 : 38400,
+    termios.B57600 : 57600,
+    termios.B115200 : 115200,
+}
+
+MODELS = {
+    '11801B' : (
+        'TEK/11801B,V81.1,TBC/4.03,DSY/4.00,EXP/4.04,ACQM1/9.02,ACQM2/9.02',
+        'B021111'),
+    '11801C' : (
+        'TEK/11801C,V81.1,TBC/5.01,DSY/5.00,EXP/5.02,ACQM1/9.03,ACQM2/9.03',
+        'B031111'),
+    '11802' : (
+        'TEK/11802,V81.1,TBC/4.03,DSY/4.00,EXP/4.04,ACQM1/9.02',
+        'B041111'),
+    'CSA803' : (
+        'TEK/CSA803,V81.1,TBC/4.03,DSY/4.00,EXP/4.04,ACQM1/9.02',
+        'B051111'),
+}
+
+# Subsystem, block, area and routine menus.  Only the parts which are
+# used by backup.py are anywhere near correct.
+EXEC_CONTROL = [
+    ('Processor', []),
+    ('ROM Checksum', [ 'U800', 'U900', 'U810', 'U910',
+                       'U820', 'U920', 'U830', 'U930' ]),
+    ('NVRAM', [ 'Battery', 'Data Lines', 'Address/Data' ]),
+]
+
+ACQ_AREAS = [
+    ('Processor', []),
+    ('ROM', [ 'ROM Loc', 'ROM Check' ]),
+    ('RAM', [ 'RAM Data', 'RAM Address' ]),
+    ('Interrupts', []),
+    ('Bus', []),
+    ('Sampler', []),
+    ('Exercisers', [ 'Timing', 'Strobe', 'Memory', 'Counter', 'Registers' ]),
+]
+
+MENUS = [
+    ('Executive', [ ('Exec Control', EXEC_CONTROL) ]),
+    ('Display', [ ('Dsy Control', [
+        ('Processor', []),
+        ('ROM Checksum', [ 'U140', 'U150' ]),
+    ]) ]),
+    ('Time Base', [ ('Tbc Control', [
+        ('Processor', []),
+        ('ROM Checksum', [ 'U300', 'U310', 'U400', 'U410' ]),
+    ]) ]),
+    ('Main Acq', [ ('Acq 1', ACQ_AREAS), ('Acq 2', ACQ_AREAS) ]),
+]
+
+# The EPROMs checked by the ROM Checksum tests of each block: routine,
+# address and size.  An odd address means the odd bytes of a pair of
+# interleaved EPROMs, and the even address of such a pair the even
+# bytes.
+ROM_CHECKSUMS = {
+    'Exec Control' : [ ('U800', 0xfc0000, 0x20000), ('U900', 0xfc0001, 0x20000),
+                       ('U810', 0xf80000, 0x20000), ('U910', 0xf80001, 0x20000),
+                       ('U820', 0xf40000, 0x20000), ('U920', 0xf40001, 0x20000),
+                       ('U830', 0xf00000, 0x20000), ('U930', 0xf00001, 0x20000) ],
+    'Dsy Control' : [ ('U140', 0xe0000, 0x10000), ('U150', 0xe0001, 0x10000) ],
+    'Tbc Control' : [ ('U300', 0xc0000, 0x10000), ('U310', 0xc0001, 0x10000),
+                      ('U400', 0xe0000, 0x10000), ('U410', 0xe0001, 0x10000) ],
+}
+
+# The acquisition EPROM is not interleaved
+ACQ_CHECKSUMS = [ ('ROM Loc', None, 0), ('ROM Check', 0x8000, 0x8000) ]
+
+ESC = '\033'
+
+def row(n, s = ''):
+    return '%s[%u;1H%s[2K%s' % (ESC, n, ESC, s)
+
+# Every screen update ends with the cursor parked on an empty command
+# line at the bottom of the screen.
+END = row(24)
+
+def fake_rom(seed, size, fill = 0.75):
+    """Pseudo random EPROM contents with an erased tail"""
+
+    rnd = random.Random(seed)
+    n = int(size * fill) & ~1
+    data = bytearray(rnd.randbytes(n) + b'\xff' * (size - n))
+    return data
+
+def checksum_test(data, checksum = 'sum'):
+    """EXPECT and ACTUAL of the simulated ROM Checksum test.
+
+    EXPECT is the first two bytes, high byte first.  With "sum" ACTUAL
+    is the 16 bit sum of the other bytes, which is what romtool.py
+    guesses that the real test does.  With "crc" it is a CRC-16 of
+    them instead, to see what backup.py does when that guess is wrong.
+    This is on purpose not the code in romtool.py.
+    """
+
+    expect = data[0] << 8 | data[1]
+    if checksum == 'crc':
+        actual = binascii.crc_hqx(bytes(data[2:]), 0xffff)
+    else:
+        actual = sum(data[2:]) & 0xffff
+    return expect, actual
+
+def fake_eprom(seed, size, checksum = 'sum'):
+    """Like fake_rom but with a valid checksum in the first two bytes"""
+
+    data = fake_rom(seed, size)
+    expect, actual = checksum_test(data, checksum)
+    data[0:2] = struct.pack('>H', actual)
+    return data
+
+class Memory():
+    """The memory map of one subsystem.
+
+    Reads from unmapped addresses return 0xff.  An alias maps a
+    window onto another address, which is how incompletely decoded
+    address lines show up.
+    """
+
+    def __init__(self, byte_order = '<'):
+        self.byte_order = byte_order
+        self.regions = []
+
+    def add(self, base, data):
+        self.regions.append((base, len(data), data, None))
+
+    def alias(self, base, size, target):
+        self.regions.append((base, size, None, target))
+
+    def read(self, addr, count):
+        data = bytearray(b'\xff' * count)
+        for base, size, src, target in self.regions:
+            lo = max(base, addr)
+            hi = min(base + size, addr + count)
+            if lo >= hi:
+                continue
+            if target is not None:
+                data[lo - addr:hi - addr] = self.read(
+                    target + lo - base, hi - lo)
+            else:
+                data[lo - addr:hi - addr] = src[lo - base:hi - base]
+        return bytes(data)
+
+    def words(self, addr, count):
+        data = self.read(addr, count * 2)
+        return struct.unpack('%s%uH' % (self.byte_order, count), data)
+
+def interleave(even, odd):
+    data = bytearray(len(even) * 2)
+    data[0::2] = even
+    data[1::2] = odd
+    return data
+
+def make_memories(serial, checksum = 'sum'):
+    """Create the memory maps for all subsystems"""
+
+    exp = Memory()
+    for i, base in enumerate([ 0xfc0000, 0xf80000, 0xf40000, 0xf00000 ]):
+        exp.add(base, interleave(fake_eprom('U8%u0' % i, 0x20000, checksum),
+                                 fake_eprom('U9%u0' % i, 0x20000, checksum)))
+    nvram = bytearray(fake_rom('NVRAM', 0x20000, fill = 0.25))
+    nvram[0:0x20] = (b'\xad\xde\x52\x21\xad\xde\x52\x21' +
+                     b'4.04\x00\xa2\x00\x00\x80\x40\x40\x00\x01\x00\xc0\x18' +
+                     serial.encode('ASCII') + b'\x00')
+    exp.add(0x3e0000, nvram)
+    exp.alias(0x400000, 0x20000, 0x3e0000)
+    exp.alias(0x420000, 0x20000, 0x3e0000)
+
+    dsy = Memory()
+    dsy.add(0xe0000, interleave(fake_eprom('U140', 0x10000, checksum),
+                                fake_eprom('U150', 0x10000, checksum)))
+
+    tbc = Memory()
+    tbc.add(0xc0000, interleave(fake_eprom('U300', 0x10000, checksum),
+                                fake_eprom('U310', 0x10000, checksum)))
+    tbc.add(0xe0000, interleave(fake_eprom('U400', 0x10000, checksum),
+                                fake_eprom('U410', 0x10000, checksum)))
+    tbc.add(0x10000, fake_rom('TBC-NVRAM', 0x10000, fill = 0.5))
+
+    acq = Memory(byte_order = '>')
+    acq.add(0x8000, fake_eprom('U611', 0x8000, checksum))
+
+    return { 'a' : exp, 'b' : dsy, 'c' : tbc, 'd' : acq }
+
+def load_modules():
+    """Use the example images for the sampling heads in slot 1 and 3"""
+
+    d = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                     'EXAMPLE-MODULES')
+    modules = {}
+    for slot, fn in [ (1, 'SD-24-B020024.bin'), (3, 'SD-26-B020026.bin') ]:
+        try:
+            with open(os.path.join(d, fn), 'rb') as f:
+                modules[slot] = f.read()
+        except OSError:
+            pass
+    return modules
+
+class Instrument():
+    """The keyboard and screen of the simulated mainframe.
+
+    Keys are fed in with key() and the output to the serial port is
+    collected with output().  Long running output such as a memory
+    dump is produced lazily by a generator in self.stream.
+    """
+
+    def __init__(self, model = '11801B', main_baudrate = 9600,
+                 test_baudrate = 9600, menu_delay = 5.0, digit_gap = 0.0,
+                 line_loss = 0.0, stall = 0.0, corrupt = 0.0,
+                 checksum = 'sum'):
+        self.id, self.serial = MODELS[model]
+        self.acqs = 2 if 'ACQM2' in self.id else 1
+        self.main_baudrate = main_baudrate
+        self.default_test_baudrate = test_baudrate
+        self.baudrate = main_baudrate
+        self.menu_delay = menu_delay
+        self.digit_gap = digit_gap
+
+        # Probability that a dumped line is lost, that the dump stops
+        # after a line or that a digit in a line is wrong
+        self.line_loss = line_loss
+        self.stall = stall
+        self.corrupt = corrupt
+        self.random = random.Random(1)
+
+        # How the ROM Checksum tests calculate ACTUAL, see checksum_test
+        self.checksum = checksum
+
+        self.memories = make_memories(self.serial, checksum)
+        self.modules = load_modules()
+
+        self.mode = 'main'
+        self.ansi = False
+        self.line = ''
+        self.out = []
+        self.stream = None
+
+        # Statistics
+        self.keys = 0
+        self.dropped = 0
+
+    def uid(self):
+        parts = [ 'MAIN:"%s"' % self.serial ]
+        for slot in sorted(self.modules):
+            if slot <= self.acqs * 2:
+                serial = self.modules[slot][0x76:0x7e]
+                parts.append('M%u:"%s"' % (
+                    slot * 2 - 1, serial.decode('ASCII').strip()))
+        return ','.join(parts)
+
+    def emit(self, s):
+        if self.mode == 'main' or self.ansi:
+            self.out.append(s)
+
+    def output(self):
+        if not self.out and self.stream:
+            try:
+                self.out.append(next(self.stream))
+            except StopIteration:
+                self.stream = None
+        s = ''.join(self.out)
+        self.out = []
+        return s
+
+    def key(self, c, now = None):
+        if now is None:
+            now = time.time()
+        self.keys += 1
+        if self.mode == 'main':
+            self.main_key(c)
+        elif now < self.test_ready_at:
+            # Keys are ignored until the menu has been drawn
+            self.dropped += 1
+        else:
+            self.test_key(c, now)
+
+    # Normal GPIB mode
+
+    def main_key(self, c):
+        if c not in '\r\n':
+            self.line += c
+            return
+
+        line, self.line = self.line.strip(), ''
+        if line == 'ID?':
+            self.emit('ID %s\r\n' % self.id)
+        elif line == 'UID?':
+            self.emit('UID %s\r\n' % self.uid())
+        elif line == 'TEST MAN':
+            self.enter_test_mode()
+
+    def enter_test_mode(self):
+        self.mode = 'test'
+        self.baudrate = self.default_test_baudrate
+        self.test_ready_at = time.time() + self.menu_delay
+        self.ansi = False
+        self.screen = 'menu'
+        self.sel = [ 0, 0, 0, 0 ]
+        self.popup = None
+        self.running = False
+        self.debugger_enabled = False
+        self.w_count = 0
+        self.baud_entry = None
+        self.width = 8
+        self.start = 0
+        self.length = 0x10
+        self.entry = None
+        self.last_digit = 0
+        self.exerciser = None
+
+    def exit_test_mode(self):
+        self.stream = None
+        self.mode = 'main'
+        self.line = ''
+        self.baudrate = self.main_baudrate
+
+    # Extended Diagnostics
+
+    def menus(self):
+        subsystem, blocks = MENUS[self.sel[0]]
+        block, areas = blocks[min(self.sel[1], len(blocks) - 1)]
+        area, routines = areas[min(self.sel[2], len(areas) - 1)]
+        routine = ''
+        if routines:
+            routine = routines[min(self.sel[3], len(routines) - 1)]
+        return [ (subsystem, MENUS), (block, blocks),
+                 (area, areas), (routine, routines) ]
+
+    def selection_row(self):
+        return row(3, ' ' + ''.join(
+            '%-15s' % _[0] for _ in self.menus()))
+
+    def soft_keys(self):
+        if self.screen == 'debugger':
+            s = ' (s) Start  (l) Length  (x) Width  (T) Test  (X) Exit'
+        else:
+            debugger = ' (D) Debugger '
+            if self.debugger_enabled:
+                debugger = '%s[0;4;7m%s%s[0m' % (ESC, debugger, ESC)
+            s = (' (1) Subsystem  (2) Block  (3) Area  (4) Routine ' +
+                 debugger + ' (r) Run  (q) Quit')
+        return row(22, s)
+
+    def status_row(self):
+        return row(23, ' Running ' if self.running else ' Stopped ')
+
+    def redraw(self):
+        s = ESC + '[r' + ESC + '[2J'
+        s += row(2, '  SUBSYSTEM      BLOCK          AREA           ROUTINE')
+        s += self.selection_row()
+        s += row(21, ' TEK %s  EXTENDED DIAGNOSTICS' % self.id.split(',')[0])
+        s += self.soft_keys()
+        s += self.status_row()
+        self.emit(s + END)
+
+    def test_key(self, c, now):
+        if self.baud_entry is not None:
+            if c in '\r\n':
+                try:
+                    b = int(self.baud_entry)
+                except ValueError:
+                    b = 0
+                self.baud_entry = None
+                if b in (9600, 19200, 38400):
+                    self.baudrate = b
+            else:
+                self.baud_entry += c
+            return
+
+        if self.screen == 'debugger':
+            self.debugger_key(c, now)
+        elif self.screen == 'exerciser':
+            self.exerciser_key(c)
+        elif c == 'T':
+            self.ansi = not self.ansi
+            if self.ansi:
+                self.redraw()
+        elif c == 'B':
+            self.baud_entry = ''
+        elif c == 'W':
+            self.w_count += 1
+        elif c == 'O':
+            if self.w_count >= 5 and not self.debugger_enabled:
+                self.debugger_enabled = True
+                self.emit(self.soft_keys() + END)
+            self.w_count = 0
+        elif c == 'E':
+            self.exit_test_mode()
+        elif c in '1234':
+            self.popup = int(c) - 1
+            choices = self.menus()[self.popup][1]
+            s = ''
+            for i, choice in enumerate(choices):
+                if isinstance(choice, tuple):
+                    choice = choice[0]
+                s += row(5 + i, '%s) %s' % (chr(ord('a') + i), choice))
+            self.emit(s + END)
+        elif self.popup is not None and 'a' <= c <= 'z':
+            choices = self.menus()[self.popup][1]
+            i = ord(c) - ord('a')
+            if i < len(choices):
+                self.sel[self.popup] = i
+                for j in range(self.popup + 1, 4):
+                    self.sel[j] = 0
+            s = ''.join(row(5 + i) for i in range(len(choices)))
+            self.popup = None
+            self.emit(s + self.selection_row() + END)
+        elif c == 'q':
+            self.running = False
+            self.emit(self.status_row() + END)
+        elif c == 'r':
+            self.run_routine()
+        elif c == 'D' and self.debugger_enabled:
+            self.enter_debugger()
+
+    # Routines
+
+    def run_routine(self):
+        menus = self.menus()
+        if menus[2][0] in ('ROM Checksum', 'ROM'):
+            self.running = True
+            self.emit(self.status_row() + END)
+            self.stream = self.checksum_lines()
+        elif menus[2][0] == 'Exercisers' and menus[3][0] == 'Registers':
+            self.screen = 'exerciser'
+            self.running = True
+            self.exerciser = 'function'
+            s = row(5, ' Registers Exerciser')
+            s += row(6, ' 1) Display registers  '
+                     '2) Display sampling head eeprom contents')
+            s += row(8, 'Select function: ')
+            self.emit(s + self.status_row() + END)
+
+    def exerciser_key(self, c):
+        if c == 'X':
+            self.screen = 'menu'
+            self.running = False
+            self.exerciser = None
+            s = ''.join(row(i) for i in range(5, 21))
+            self.emit(s + self.soft_keys() + self.status_row() + END)
+        elif self.exerciser == 'function':
+            if c == '2':
+                self.exerciser = 'function-enter'
+                self.emit(row(8, 'Select function: 2') +
+                          row(10, ' Press Enter') + END)
+        elif self.exerciser == 'function-enter':
+            if c == '\r':
+                self.exerciser = 'head'
+                self.emit(row(9, 'Enter head number: ') + row(10) + END)
+        elif self.exerciser == 'head':
+            if c in '12':
+                self.head = int(c)
+                self.exerciser = 'head-enter'
+                self.emit(row(9, 'Enter head number: %s' % c) +
+                          row(10, ' Press Enter') + END)
+        elif self.exerciser == 'head-enter':
+            if c == '\r':
+                self.exerciser = 'continue'
+                self.stream = self.eeprom_lines()
+        elif self.exerciser == 'continue':
+            if c == '\r':
+                self.exerciser = 'function'
+                s = row(8, 'Select function: ')
+                s += ''.join(row(i) for i in range(9, 20))
+                self.emit(s + END)
+
+    def checksum_lines(self):
+        block = self.menus()[1][0]
+        memory = self.memories['abcd'[self.sel[0]]]
+        checksums = ROM_CHECKSUMS.get(block, ACQ_CHECKSUMS)
+
+        yield row(5, '    ROUTINE      INDEX  FAULTS  ADDRES  EXPECT  ACTUAL')
+        for i, (routine, addr, size) in enumerate(checksums):
+            if addr is None:
+                addr, expect, actual = 0x428800, 0x00f0, 0x00f0
+            elif block in ROM_CHECKSUMS:
+                data = memory.read(addr & ~1, size * 2)[addr & 1::2]
+                expect, actual = checksum_test(data, self.checksum)
+            else:
+                expect, actual = checksum_test(memory.read(addr, size),
+                                               self.checksum)
+            yield row(7 + i, '%s) %-14s %-4s          %06X    %04X    %04X' % (
+                chr(ord('a') + i), routine,
+                'pass' if expect == actual else 'fail',
+                addr, expect, actual))
+
+        self.running = False
+        yield self.status_row() + END
+
+    def eeprom_lines(self):
+        acq = self.menus()[1][0]
+        slot = (2 if acq == 'Acq 2' else 0) + self.head
+        data = self.modules.get(slot, b'\xff' * 128)
+        if slot > self.acqs * 2:
+            data = b'\xff' * 128
+        words = struct.unpack('>64H', data)
+        yield row(10)
+        for i in range(8):
+            yield row(11 + i, '  ' + ''.join(
+                '%04X ' % _ for _ in words[i * 8:i * 8 + 8]))
+        yield row(19, 'Select ENTER to continue') + END
+
+    # Low-Level Hardware Debugger
+
+    def debugger_rows(self):
+        s = row(3, ' (o) Operation Read   (m) Memory/IO Memory   '
+                '(x) 8/16   %u ' % self.width)
+        s += row(4, ' (s) Start %06X   (l) Length %06X ' % (
+            self.start, self.length))
+        return s
+
+    def enter_debugger(self):
+        self.screen = 'debugger'
+        s = ESC + '[2J'
+        s += row(1, ' Low-Level Hardware Debugger   %s' % self.menus()[0][0])
+        s += self.debugger_rows()
+        s += self.soft_keys()
+        s += self.status_row()
+        self.emit(s + END)
+
+    def debugger_key(self, c, now):
+        if self.entry is not None:
+            if c == '\r':
+                value = int(self.entry[1] or '0', 16)
+                if self.entry[0] == 's':
+                    self.start = value
+                else:
+                    self.length = value
+                self.entry = None
+                self.emit(self.debugger_rows() + row(5) + END)
+            elif c in '0123456789abcdefABCDEF':
+                if now - self.last_digit < self.digit_gap:
+                    # Typed faster than the instrument can keep up with
+                    self.dropped += 1
+                    return
+                self.last_digit = now
+                self.entry[1] += c
+                self.emit(c)
+            return
+
+        if c in 'sl':
+            self.entry = [ c, '' ]
+            self.last_digit = 0
+            self.emit(row(5, ' %s: ' % (
+                'Start address' if c == 's' else 'Length')))
+        elif c == 'x':
+            self.width = 16 if self.width == 8 else 8
+            self.emit(self.debugger_rows() + END)
+        elif c == 'T':
+            self.running = True
+            self.stream = self.dump_lines()
+        elif c == 'X':
+            self.stream = None
+            self.screen = 'menu'
+            self.running = False
+            self.redraw()
+
+    def dump_lines(self):
+        mem = self.memories['abcd'[self.sel[0]]]
+        yield self.status_row() + ESC + '[7;20r' + ESC + '[20;1H'
+        addr = self.start
+        left = self.length
+        while left > 0:
+            if self.width == 16:
+                n = min(left, 8)
+                values = ' '.join('%04X' % _ for _ in mem.words(addr, n))
+                step = n * 2
+            else:
+                n = min(left, 16)
+                values = ' '.join('%02X' % _ for _ in mem.read(addr, n))
+                step = n
+            if self.random.random() < self.stall:
+                return
+            if self.corrupt and self.random.random() < self.corrupt:
+                # A wrong digit which still looks like a hex digit
+                i = self.random.choice([ _ for _ in range(len(values))
+                                         if values[_] != ' ' ])
+                values = (values[:i] + '%X' % (int(values[i], 16) ^ 1) +
+                          values[i + 1:])
+            if self.random.random() >= self.line_loss:
+                yield '\r\nRM %06X %s  %s[K' % (addr, values, ESC)
+            addr += step
+            left -= n
+        self.running = False
+        yield ESC + '[r' + self.status_row() + END
+
+class Simulator():
+    """Serve an Instrument on the master side of a pseudo terminal.
+
+    All emulated delays are multiplied by time_scale, so 0.01 runs the
+    instrument a hundred times faster than real time and 0 runs it as
+    fast as the pseudo terminal allows.
+    """
+
+    def __init__(self, instrument, time_scale = 1.0, latency = 0.05,
+                 settle = 0.0):
+        self.instrument = instrument
+        self.time_scale = time_scale
+        self.latency = latency
+        self.settle = settle
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.name = os.ttyname(self.slave)
+        fl = fcntl.fcntl(self.master, fcntl.F_GETFL)
+        fcntl.fcntl(self.master, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+        self.pending = b''
+        self.tx_free_at = 0
+
+        # Statistics
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def client_baudrate(self):
+        attrs = termios.tcgetattr(self.master)
+        return BAUDRATES.get(attrs[5], 0)
+
+    def garble(self, data):
+        return bytes(0x80 | (b * 7 + 0x11) & 0xff for b in data)
+
+    def byte_time(self):
+        return 10.0 / self.instrument.baudrate * self.time_scale
+
+    def receive(self):
+        try:
+            data = os.read(self.master, 1024)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EIO):
+                return
+            raise
+        self.bytes_in += len(data)
+        if self.client_baudrate() != self.instrument.baudrate:
+            return
+        now = time.time()
+        if self.settle and self.instrument.mode == 'test' and (
+                self.pending or now < self.tx_free_at +
+                self.settle * self.time_scale):
+            # Keys sent while the screen is being updated are lost
+            self.instrument.dropped += len(data)
+            return
+        for c in data.decode('latin-1'):
+            self.instrument.key(c, now)
+        if self.instrument.out:
+            self.tx_free_at = max(self.tx_free_at,
+                                  now + self.latency * self.time_scale)
+
+    def transmit(self):
+        if not self.pending:
+            s = self.instrument.output()
+            if not s:
+                return
+            self.pending = s.encode('latin-1')
+            if self.client_baudrate() != self.instrument.baudrate:
+                self.pending = self.garble(self.pending)
+
+        now = time.time()
+        if now < self.tx_free_at:
+            return
+
+        # Send in small pieces so that keys are still handled while
+        # a long dump is being transmitted
+        n = 64
+        if self.time_scale:
+            n = max(1, min(n, int(0.02 / self.byte_time())))
+        try:
+            n = os.write(self.master, self.pending[:n])
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+        self.bytes_out += n
+        self.pending = self.pending[n:]
+        self.tx_free_at = max(self.tx_free_at, now) + n * self.byte_time()
+
+    def poll(self, timeout = 0.1):
+        busy = self.pending or self.instrument.out or self.instrument.stream
+        if busy:
+            timeout = min(timeout, max(0, self.tx_free_at - time.time()))
+        wlist = [ self.master ] if busy else []
+        r, w, x = select.select([ self.master ], wlist, [], timeout)
+        if r:
+            self.receive()
+        self.transmit()
+
+    def serve(self):
+        while 1:
+            self.poll()
+
+def main():
+    parser = OptionParser()
+    parser.add_option('-m', '--model', dest = 'model', default = '11801B',
+                      help = "model to simulate: %s" % ', '.join(MODELS))
+    parser.add_option('--main-baudrate', dest = 'main_baudrate',
+                      type = 'int', default = 9600,
+                      help = "baudrate in GPIB mode (default 9600)")
+    parser.add_option('--test-baudrate', dest = 'test_baudrate',
+                      type = 'int', default = 9600,
+                      help = "initial baudrate in test mode (default 9600)")
+    parser.add_option('-s', '--time-scale', dest = 'time_scale',
+                      type = 'float', default = 1.0,
+                      help = "multiply all emulated delays with SCALE",
+                      metavar = "SCALE")
+    parser.add_option('-l', '--latency', dest = 'latency',
+                      type = 'float', default = 0.05,
+                      help = "delay before responding to a key")
+    parser.add_option('--menu-delay', dest = 'menu_delay',
+                      type = 'float', default = 5.0,
+                      help = "time to draw the menu after TEST MAN")
+    parser.add_option('--digit-gap', dest = 'digit_gap',
+                      type = 'float', default = 0.0,
+                      help = "drop hex digits typed faster than this")
+    parser.add_option('--settle', dest = 'settle',
+                      type = 'float', default = 0.0,
+                      help = "drop keys sent this soon after a screen update")
+    parser.add_option('--line-loss', dest = 'line_loss',
+                      type = 'float', default = 0.0,
+                      help = "lose dumped lines with this probability")
+    parser.add_option('--stall', dest = 'stall',
+                      type = 'float', default = 0.0,
+                      help = "stop a dump after a line with this probability")
+    parser.add_option('--corrupt', dest = 'corrupt',
+                      type = 'float', default = 0.0,
+                      help = "change a digit in a dumped line with this "
+                      "probability")
+    parser.add_option('--checksum', dest = 'checksum', default = 'sum',
+                      help = "how the ROM Checksum tests calculate ACTUAL: "
+                      "sum (default), like romtool.py guesses, or crc, "
+                      "which romtool.py gets wrong")
+
+    (options, args) = parser.parse_args()
+
+    if options.model not in MODELS:
+        print("error: unknown model %s" % repr(options.model),
+              file = sys.stderr)
+        sys.exit(1)
+    if options.checksum not in ('sum', 'crc'):
+        print("error: unknown checksum %s" % repr(options.checksum),
+              file = sys.stderr)
+        sys.exit(1)
+
+    instrument = Instrument(
+        options.model,
+        main_baudrate = options.main_baudrate,
+        test_baudrate = options.test_baudrate,
+        menu_delay = options.menu_delay * options.time_scale,
+        digit_gap = options.digit_gap * options.time_scale,
+        line_loss = options.line_loss, stall = options.stall,
+        corrupt = options.corrupt, checksum = options.checksum)
+    sim = Simulator(instrument, time_scale = options.time_scale,
+                    latency = options.latency, settle = options.settle)
+
+    print(sim.name, flush = True)
+
+    try:
+        sim.serve()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#! /usr/bin/python3
+"""One entry point for all the tools.
+
+    ./tektool.py backup /dev/ttyUSB0
+    ./tektool.py module -i module.bin
+    ./tektool.py rom export exp-fc0000.hex A18-U800-EXP-4_04.bin A18-U900-EXP-4_04.bin
+
+Each command runs the main() of one of the scripts with the rest of
+the arguments.  A script is only imported when its command is run, so
+"module" doesn't have to wait for pyserial, pexpect and NumPy to be
+imported.  startup.py measures how long each command takes to start.
+"""
+
+import os
+import sys
+import importlib
+
+# Name of each command, the script which does it and what it is for
+COMMANDS = [
+    ('backup', 'backup', "back up an instrument over the serial port"),
+    ('fleet', 'fleet', "back up several instruments at the same time"),
+    ('replay', 'replay', "replay a capture made with backup --capture"),
+    ('module', 'moduletool', "convert and check sampling head EEPROMs"),
+    ('rom', 'romtool', "split, interleave and convert EPROM images"),
+    ('archive', 'archive', "look in the archive of images"),
+    ('plan', 'dumpplan', "show the dump plan for a model"),
+]
+
+def usage(prog, f):
+    print("usage: %s COMMAND [options] ..." % prog, file = f)
+    print(file = f)
+    for name, script, desc in COMMANDS:
+        print("  %-10s %s" % (name, desc), file = f)
+    print(file = f)
+    print("Use \"%s COMMAND --help\" for the options of a command." % prog,
+          file = f)
+
+def main():
+    prog = os.path.basename(sys.argv[0])
+    scripts = dict((_[0], _[1]) for _ in COMMANDS)
+
+    if len(sys.argv) < 2:
+        usage(prog, sys.stderr)
+        sys.exit(2)
+
+    cmd = sys.argv[1]
+    if cmd in ('-h', '--help'):
+        usage(prog, sys.stdout)
+        return
+    if cmd not in scripts:
+        print("%s: unknown command %s" % (prog, repr(cmd)), file = sys.stderr)
+        usage(prog, sys.stderr)
+        sys.exit(2)
+
+    module = importlib.import_module(scripts[cmd])
+
+    # The usage of the command shows up as "tektool.py backup"
+    sys.argv = [ '%s %s' % (prog, cmd) ] + sys.argv[2:]
+    module.main()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The modules are scripts in the top directory, not a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,68 @@
+import os
+import datetime
+import tempfile
+import unittest
+
+from archive import (Archive, add_snapshot, snapshot_history,
+                     rebuild_snapshots, NVRAM_INDEX)
+
+UNIT = 'TEK-11801B-B021111'
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.archive = Archive(os.path.join(self.tmp.name, 'ARCHIVE'))
+        self.time = datetime.datetime(2026, 1, 1)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def add(self, data, start = 0x3e0000):
+        self.time += datetime.timedelta(hours = 1)
+        return add_snapshot(self.archive, bytes(data), UNIT, 'a', start,
+                            time = self.time, block_size = 16)
+
+    def history(self, start = 0x3e0000):
+        return list(rebuild_snapshots(self.archive, snapshot_history(
+            self.archive, UNIT, 'a', start)))
+
+    def test_changed_blocks(self):
+        images = [ bytearray(range(64)) ]
+        images.append(bytearray(images[-1]))
+        images[-1][20] = 0xff
+        images.append(bytearray(images[-1]))
+        images.append(bytearray(images[-1]))
+        images[-1][0] = images[-1][63] = 0xff
+
+        records = [ self.add(_) for _ in images ]
+        self.assertEqual([ [ _[0] for _ in r['blocks'] ] for r in records ],
+                         [ [ 0, 16, 32, 48 ], [ 16 ], [], [ 0, 48 ] ])
+
+        history = self.history()
+        self.assertEqual([ _[1] for _ in history ],
+                         [ bytes(_) for _ in images ])
+
+    def test_other_nvram(self):
+        self.add(bytes(32))
+        record = self.add(bytes(range(32)), start = 0x10000)
+        self.assertEqual(len(record['blocks']), 2)
+        self.assertEqual(len(self.history()), 1)
+
+    def test_size_changed(self):
+        self.add(bytes(32))
+        record = self.add(bytes(48))
+        self.assertEqual(len(record['blocks']), 3)
+        self.assertEqual(self.history()[-1][1], bytes(48))
+
+    def test_does_not_add_up(self):
+        self.add(bytes(32))
+        self.add(b'\x01' + bytes(31))
+        record = self.archive.records(NVRAM_INDEX)[-1]
+        fn = self.archive.object_fn(record['blocks'][0][1])
+        with open(fn, 'wb') as f:
+            f.write(bytes(16))
+        with self.assertRaises(ValueError):
+            self.history()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+
+from dumpplan import (find_plan, plan_fn, load_plan, schedule, fit,
+                      estimate, group, SWITCH_COST, REGION_COST, MODULE_COST)
+
+SUBSYSTEMS = { 'EXP' : 'V4.04', 'DSY' : 'V4.00', 'TBC' : 'V4.03',
+               'ACQM1' : 'V9.02' }
+
+def mem(subsystem, start, count = 0x1000, priority = 1):
+    return { 'kind' : 'mem', 'subsystem' : subsystem, 'start' : start,
+             'count' : count, 'priority' : priority }
+
+def module(slot, priority = 1):
+    return { 'kind' : 'module', 'slot' : slot, 'priority' : priority }
+
+class PlanTest(unittest.TestCase):
+    def test_find_plan(self):
+        self.assertEqual(find_plan('11801C'), plan_fn('11801B'))
+        self.assertEqual(find_plan('11802B'), plan_fn('11802'))
+        with self.assertRaises(ValueError):
+            find_plan('11801')
+
+    def test_load_plan(self):
+        items = load_plan(find_plan('11801B'), SUBSYSTEMS)
+
+        # Slots 3 and 4 need ACQM2
+        self.assertEqual([ _['slot'] for _ in items if _['kind'] == 'module' ],
+                         [ 1, 2 ])
+        tbc = [ _ for _ in items if _.get('start') == 0xc0000 ]
+        self.assertEqual(tbc[0]['files'], [ 'A5-U300-TBC-V4_03.bin',
+                                            'A5-U400-TBC-V4_03.bin' ])
+        self.assertEqual(tbc[0]['byte_order'], '<')
+
+    def test_nvram_first(self):
+        items = load_plan(find_plan('11801B'), SUBSYSTEMS)
+        order = schedule(items)
+        first = [ _ for _ in order if _['priority'] == 1 ]
+        self.assertEqual(order[:len(first)], first)
+        self.assertEqual(set((_['subsystem'], _['start'])
+                             for _ in first if _['kind'] == 'mem'),
+                         set([ ('a', 0x3e0000), ('c', 0x10000) ]))
+
+class ScheduleTest(unittest.TestCase):
+    def test_groups(self):
+        items = [ mem('a', 0x2000), mem('c', 0x1000), mem('a', 0x1000),
+                  module(1), mem('c', 0), module(2, priority = 0) ]
+        order = schedule(items)
+        self.assertEqual([ (group(_), _.get('start', _.get('slot')))
+                           for _ in order ],
+                         [ ('module', 2), ('module', 1),
+                           ('a', 0x1000), ('a', 0x2000),
+                           ('c', 0), ('c', 0x1000) ])
+
+    def test_current(self):
+        items = [ mem('a', 0), mem('c', 0) ]
+        self.assertEqual(schedule(items, current = 'c')[0]['subsystem'], 'c')
+
+    def test_estimate(self):
+        self.assertEqual(estimate(mem('a', 0, 4000), 40),
+                         SWITCH_COST + REGION_COST + 100)
+        self.assertEqual(estimate(mem('a', 0, 4000), 40, last = 'a'),
+                         REGION_COST + 100)
+        self.assertEqual(estimate(module(1), 40, last = 'module'),
+                         MODULE_COST)
+        item = dict(mem('a', 0, 4000), left = 0)
+        self.assertEqual(estimate(item, 40), 0)
+
+    def test_fit(self):
+        order = [ mem('a', 0, 4000), mem('a', 0x1000, 40000),
+                  mem('a', 0x20000, 400) ]
+        selected, skipped = fit(order, 40, None)
+        self.assertEqual((selected, skipped), (order, []))
+
+        # The second one doesn't fit but the cheaper third one does
+        budget = SWITCH_COST + 2 * REGION_COST + 100 + 10
+        selected, skipped = fit(order, 40, budget)
+        self.assertEqual(selected, [ order[0], order[2] ])
+        self.assertEqual(skipped, [ order[1] ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+
+from backup import Journal, ROW_SIZE
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.fn = os.path.join(self.tmp.name, 'mem-a-00fc0000.bin')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def dump(self, blocks):
+        """Commit each block and return the journal"""
+
+        journal = Journal(self.fn, 0xfc0000, '<', interval = 1000)
+        journal.resume()
+        journal.open()
+        for block in blocks:
+            journal.write(block)
+            journal.commit()
+        journal.close()
+        return journal
+
+    def append(self, data):
+        with open(self.fn, 'ab') as f:
+            f.write(data)
+
+    def test_resume_after_checkpoint(self):
+        self.dump([ b'\x11' * 64, b'\x22' * 32 ])
+
+        # Written after the last checkpoint, then interrupted
+        self.append(b'\x33' * 40)
+
+        journal = Journal(self.fn, 0xfc0000, '<')
+        self.assertEqual(journal.resume(), 96)
+        self.assertEqual(journal.state['next'], 0xfc0000 + 96)
+        self.assertEqual(os.path.getsize(self.fn), 96)
+
+    def test_bad_block(self):
+        self.dump([ b'\x11' * 64, b'\x22' * 32 ])
+        with open(self.fn, 'r+b') as f:
+            f.seek(70)
+            f.write(b'\0')
+
+        journal = Journal(self.fn, 0xfc0000, '<')
+        self.assertEqual(journal.resume(), 64)
+        self.assertEqual(len(journal.state['blocks']), 1)
+        with open(self.fn, 'rb') as f:
+            self.assertEqual(f.read(), b'\x11' * 64)
+
+    def test_continue(self):
+        self.dump([ b'\x11' * 64 ])
+        self.append(b'\x33' * 8)
+        journal = self.dump([ b'\x22' * 32 ])
+        self.assertEqual(journal.state['length'], 96)
+        with open(self.fn, 'rb') as f:
+            self.assertEqual(f.read(), b'\x11' * 64 + b'\x22' * 32)
+
+    def test_no_journal(self):
+        self.append(b'\x11' * (3 * ROW_SIZE + 5))
+        journal = Journal(self.fn, 0xfc0000, '<')
+        self.assertEqual(journal.resume(), 3 * ROW_SIZE)
+        self.assertEqual(os.path.getsize(self.fn), 3 * ROW_SIZE)
+
+    def test_other_dump(self):
+        self.dump([ b'\x11' * 40 ])
+
+        # A journal for another start is ignored, whole rows are kept
+        journal = Journal(self.fn, 0xf80000, '<')
+        self.assertEqual(journal.resume(), 2 * ROW_SIZE)
+
+if __name__ == '__main__':
+    unittest.main()
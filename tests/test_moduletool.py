@@ -0,0 +1,49 @@
+import os
+import tempfile
+import unittest
+
+from moduletool import read_images, write_images, image_checksums
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'EXAMPLE-MODULES')
+FNS = [ os.path.join(EXAMPLES, _)
+        for _ in ('SD-24-B020024.bin', 'SD-26-B020026.bin') ]
+
+class ModuleToolTest(unittest.TestCase):
+    def test_checksums(self):
+        images, errors = read_images(FNS, 'big')
+        self.assertEqual(errors, [ None, None ])
+        stored, calculated = image_checksums(images)
+        self.assertEqual(list(stored), [ 0x1038, 0x0dfd ])
+        self.assertEqual(list(stored), list(calculated))
+
+    def test_bad_checksum(self):
+        images, errors = read_images(FNS, 'big')
+        images[0, 0] ^= 0x01
+        stored, calculated = image_checksums(images)
+        self.assertNotEqual(stored[0], calculated[0])
+        self.assertEqual(stored[1], calculated[1])
+
+    def test_round_trip(self):
+        images, errors = read_images(FNS, 'big')
+        with tempfile.TemporaryDirectory() as tmp:
+            for fmt in ('little', 'text'):
+                fns = [ os.path.join(tmp, fmt, '%u' % _)
+                        for _ in range(len(FNS)) ]
+                write_images(images, fns, fmt)
+                again, errors = read_images(fns, fmt)
+                self.assertEqual(errors, [ None, None ])
+                self.assertEqual(again.tobytes(), images.tobytes())
+
+    def test_errors(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn = os.path.join(tmp, 'short.bin')
+            with open(fn, 'wb') as f:
+                f.write(b'\0' * 127)
+            images, errors = read_images([ fn, FNS[0] ], 'big')
+            self.assertEqual(errors[0], "file must be 128 bytes")
+            self.assertIsNone(errors[1])
+            self.assertEqual(images[0].tobytes(), b'\xff' * 128)
+
+if __name__ == '__main__':
+    unittest.main()
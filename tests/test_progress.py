@@ -0,0 +1,16 @@
+import unittest
+
+from backup import format_eta
+
+class FormatEtaTest(unittest.TestCase):
+    def test_unknown(self):
+        self.assertEqual(format_eta(None), '-:--:--')
+
+    def test_format(self):
+        self.assertEqual(format_eta(3725.9), '1:02:05')
+
+    def test_negative(self):
+        self.assertEqual(format_eta(-42), '0:00:00')
+
+if __name__ == '__main__':
+    unittest.main()
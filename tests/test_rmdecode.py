@@ -0,0 +1,42 @@
+import unittest
+
+from rmdecode import RMDecoder
+
+ROW = b'RM 0E0000 EB32 BE4E A2FB 71C8 0BC7 47B7 1E95 4827'
+DATA = bytes.fromhex('EB32BE4EA2FB71C80BC747B71E954827')
+
+class RMDecoderTest(unittest.TestCase):
+    def test_escape_on_the_line(self):
+        rows = RMDecoder('>').feed(b'\r\n' + ROW + b'  \033[K')
+        self.assertEqual(rows, [ (0xe0000, DATA) ])
+
+    def test_escape_after_newline(self):
+        rows = RMDecoder('>').feed(ROW + b'\r\n\033[K')
+        self.assertEqual(rows, [ (0xe0000, DATA) ])
+
+    def test_little_endian(self):
+        rows = RMDecoder('<').feed(ROW + b'\r\n\033[K')
+        self.assertEqual(rows[0][1][:2], b'\x32\xeb')
+
+    def test_irregular_spacing(self):
+        row = b'RM  0E0000 EB32  BE4E A2FB    71C8 0BC7 47B7   1E95  4827'
+        stream = row + b'\r\n\033[K' + ROW + b'\r\n\033[K'
+        rows = RMDecoder('>').feed(stream)
+        self.assertEqual(rows, [ (0xe0000, DATA) ] * 2)
+
+    def test_split(self):
+        decoder = RMDecoder('>')
+        stream = (ROW + b'\r\n\033[K') * 3
+        rows = []
+        for i in range(len(stream)):
+            rows += decoder.feed(stream[i : i + 1])
+        self.assertEqual(rows, [ (0xe0000, DATA) ] * 3)
+
+    def test_incomplete(self):
+        decoder = RMDecoder('>')
+        self.assertEqual(decoder.feed(ROW[:-2]), [])
+        self.assertEqual(decoder.feed(ROW[-2:] + b'\r\n'), [])
+        self.assertEqual(decoder.feed(b'\033[K'), [ (0xe0000, DATA) ])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import io
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from romtool import (interleave_arrays, split_array, interleave_files,
+                     split_file, write_ihex, read_ihex, write_srec,
+                     read_srec, export_files, import_files)
+
+DATA = bytes(range(256)) * 16
+
+class SplitTest(unittest.TestCase):
+    def test_split_words(self):
+        array = np.frombuffer(bytes(range(8)), dtype = 'B')
+        even, odd = split_array(array, 2, width = 2)
+        self.assertEqual(even.tobytes(), bytes([ 0, 1, 4, 5 ]))
+        self.assertEqual(odd.tobytes(), bytes([ 2, 3, 6, 7 ]))
+
+    def test_interleave_words(self):
+        array = np.frombuffer(DATA, dtype = 'B')
+        parts = split_array(array, 2, width = 2)
+        again = interleave_arrays(*[ _.reshape(-1) for _ in parts ],
+                                  width = 2)
+        self.assertEqual(again.tobytes(), DATA)
+
+    def test_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fn, a, b, c = [ os.path.join(tmp, _) for _ in 'fabc' ]
+            with open(fn, 'wb') as f:
+                f.write(DATA)
+
+            # A small chunk size to go through more than one chunk
+            split_file(fn, a, b, width = 2, chunk_size = 100)
+            with open(a, 'rb') as f:
+                self.assertEqual(f.read(4), bytes([ 0, 1, 4, 5 ]))
+            interleave_files(c, a, b, width = 2, chunk_size = 100)
+            with open(c, 'rb') as f:
+                self.assertEqual(f.read(), DATA)
+
+    def test_not_whole_words(self):
+        array = np.frombuffer(bytes(6), dtype = 'B')
+        with self.assertRaises(ValueError):
+            split_array(array, 2, width = 2)
+
+def join(records):
+    """The data of a list of (address, data) records and its address"""
+
+    records = list(records)
+    data = b''
+    for a, d in records:
+        if a != records[0][0] + len(data):
+            raise ValueError("gap at 0x%x" % a)
+        data += d
+    return records[0][0], data
+
+class FormatTest(unittest.TestCase):
+    def test_ihex(self):
+        # Crosses a 64k boundary, which needs an extended address
+        f = io.StringIO()
+        write_ihex(f, [ (0, DATA[:1000]), (1000, DATA[1000:]) ],
+                   address = 0xffc00)
+        self.assertIn(':020000040010EA\n', f.getvalue())
+        self.assertTrue(f.getvalue().endswith(':00000001FF\n'))
+        f.seek(0)
+        self.assertEqual(join(read_ihex(f)), (0xffc00, DATA))
+
+    def test_srec(self):
+        for address, kind in ((0x100, 'S1'), (0xfc0000, 'S2'),
+                              (0x1000000, 'S3')):
+            f = io.StringIO()
+            write_srec(f, [ (0, DATA) ], address, len(DATA), b'test')
+            self.assertEqual(f.getvalue().splitlines()[1][:2], kind)
+            f.seek(0)
+            self.assertEqual(join(read_srec(f)), (address, DATA))
+
+    def test_bad_record(self):
+        f = io.StringIO()
+        write_ihex(f, [ (0, DATA[:16]) ])
+        line = f.getvalue().splitlines()[0]
+        line = line[:9] + ('1' if line[9] != '1' else '2') + line[10:]
+        with self.assertRaises(ValueError):
+            list(read_ihex(io.StringIO(line)))
+
+    def test_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            a, b, c, d = [ os.path.join(tmp, _) for _ in 'abcd' ]
+            with open(a, 'wb') as f:
+                f.write(DATA[:2048])
+            with open(b, 'wb') as f:
+                f.write(DATA[2048:])
+            for ext in '.hex', '.s28':
+                out = os.path.join(tmp, 'image' + ext)
+                export_files(out, a, b, address = 0xe0000, width = 2)
+                import_files(out, c, d, address = 0xe0000, width = 2)
+                for x, y in (a, c), (b, d):
+                    with open(x, 'rb') as f, open(y, 'rb') as g:
+                        self.assertEqual(f.read(), g.read())
+
+if __name__ == '__main__':
+    unittest.main()
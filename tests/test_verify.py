@@ -0,0 +1,21 @@
+import unittest
+
+from backup import error_bound
+
+class ErrorBoundTest(unittest.TestCase):
+    def test_no_bad_rows(self):
+        # The rule of three, about 3 / n
+        self.assertAlmostEqual(error_bound(168, 0), 3 / 168, places = 3)
+
+    def test_all_bad(self):
+        self.assertEqual(error_bound(10, 10), 1.0)
+
+    def test_large(self):
+        # math.comb(n, i) as a float overflows for these
+        for n, k in [ (16384, 200), (2000, 400), (100000, 5000) ]:
+            bound = error_bound(n, k)
+            self.assertGreater(bound, k / n)
+            self.assertLess(bound, 1.5 * k / n)
+
+if __name__ == '__main__':
+    unittest.main()